@@ -1,6 +1,7 @@
 
-import React, { createContext, useReducer, ReactNode, useEffect } from 'react';
+import React, { createContext, useReducer, ReactNode, useEffect, useCallback, useRef } from 'react';
 import { Action, CartItem, Product, User, View } from '../types';
+import api from '../services/api';
 
 export interface FilterOptions {
   priceRange: { min: number; max: number };
@@ -25,9 +26,10 @@ export interface AppState {
 const getInitialState = (): AppState => {
   try {
     // Clear localStorage if it contains invalid data
+    let cart: CartItem[] = [];
     try {
       const storedCart = localStorage.getItem('cart');
-      if (storedCart) JSON.parse(storedCart);
+      if (storedCart) cart = JSON.parse(storedCart);
       
       const storedUser = localStorage.getItem('user');
       if (storedUser) JSON.parse(storedUser);
@@ -45,7 +47,7 @@ const getInitialState = (): AppState => {
       currentProductId: null,
       user: null,
       token: null,
-      cart: [],
+      cart: Array.isArray(cart) ? cart : [],
       searchQuery: '',
       filteredProducts: [],
       filterOptions: {
@@ -211,6 +213,8 @@ const appReducer = (state: AppState, action: Action): AppState => {
         };
     case 'CLEAR_CART':
         return {...state, cart: []};
+    case 'SET_CART':
+        return {...state, cart: action.payload};
     default:
       return state;
   }
@@ -224,13 +228,70 @@ export const AppContext = createContext<{
   dispatch: () => null,
 });
 
+// Mirrors cart changes to the server-side cart, which checkout, cart reminders and price-drop alerts use.
+// Best effort: the local cart stays what the user sees, and checkout still sends its items.
+const syncCart = (action: Action, token: string | null) => {
+  if (!token) return;
+  let request: Promise<unknown> | null = null;
+  switch (action.type) {
+    case 'ADD_TO_CART':
+      request = api.addCartItem(action.payload.id, 1, token);
+      break;
+    case 'UPDATE_CART_QUANTITY':
+      request = action.payload.quantity > 0
+        ? api.updateCartItem(action.payload.productId, action.payload.quantity, token)
+        : api.removeCartItem(action.payload.productId, token);
+      break;
+    case 'REMOVE_FROM_CART':
+      request = api.removeCartItem(action.payload, token);
+      break;
+    case 'CLEAR_CART':
+      request = api.replaceCart([], token);
+      break;
+  }
+  request?.catch((error) => console.warn('Cart sync failed:', error));
+};
+
+// On login: lines only the server has (added on another device) join the local cart, local lines win
+// where both have a product, and the server cart is replaced with the result
+const mergeCarts = async (local: CartItem[], token: string): Promise<CartItem[]> => {
+  const server = await api.getCart(token);
+  const merged = [...local];
+  for (const line of server.items) {
+    if (!merged.some(item => item.id === line.product_id)) {
+      merged.push({ id: line.product_id, name: line.name, price: Number(line.price), image: line.image, quantity: line.quantity });
+    }
+  }
+  await api.replaceCart(merged.map(item => ({ product_id: item.id, quantity: item.quantity })), token);
+  return merged;
+};
+
 export const AppProvider: React.FC<{ children: ReactNode }> = ({ children }) => {
-  const [state, dispatch] = useReducer(appReducer, initialState);
+  const [state, baseDispatch] = useReducer(appReducer, initialState);
+  const tokenRef = useRef(state.token);
+  tokenRef.current = state.token;
+
+  const dispatch = useCallback((action: Action) => {
+    baseDispatch(action);
+    syncCart(action, tokenRef.current);
+  }, []);
 
   useEffect(() => {
     localStorage.setItem('cart', JSON.stringify(state.cart));
   }, [state.cart]);
 
+  const cartRef = useRef(state.cart);
+  cartRef.current = state.cart;
+
+  useEffect(() => {
+    if (!state.token) return;
+    let cancelled = false;
+    mergeCarts(cartRef.current, state.token)
+      .then(merged => { if (!cancelled) baseDispatch({ type: 'SET_CART', payload: merged }); })
+      .catch((error) => console.warn('Cart sync failed:', error));
+    return () => { cancelled = true; };
+  }, [state.token]);
+
   return (
     <AppContext.Provider value={{ state, dispatch }}>
       {children}
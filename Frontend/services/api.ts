@@ -10,6 +10,10 @@ interface ApiResponse<T = any> {
   data?: T;
 }
 
+// place_order attempts: each is abandoned after ORDER_TIMEOUT_MS and retried with the same Idempotency-Key
+const ORDER_TIMEOUT_MS = 8000;
+const ORDER_RETRIES = 2;
+
 const handleResponse = async <T>(response: Response): Promise<T> => {
   const data = await response.json();
   if (!response.ok) {
@@ -18,11 +22,32 @@ const handleResponse = async <T>(response: Response): Promise<T> => {
   return data;
 };
 
+// Paged endpoints (/products with filters, /orders) return at most one page and name the next one in
+// X-Next-Cursor; follow it until the last page so callers still get the whole list
+const fetchAllPages = async <T>(url: string, init?: RequestInit): Promise<T[]> => {
+  const items: T[] = [];
+  let cursor: string | null = null;
+  do {
+    const separator = url.includes('?') ? '&' : '?';
+    const pageUrl: string = cursor ? `${url}${separator}cursor=${encodeURIComponent(cursor)}` : url;
+    const response = await fetch(pageUrl, init);
+    items.push(...await handleResponse<T[]>(response));
+    cursor = response.headers.get('X-Next-Cursor');
+  } while (cursor);
+  return items;
+};
+
 interface LoginCredentials {
   username: string;
   password: string;
 }
 
+interface ServerCart {
+  items: { product_id: number; name: string; image: string; quantity: number; price: number; price_when_added: number; stock: number }[];
+  total: number;
+  version: number;
+}
+
 interface StockMovement {
   productId: number;
   quantity: number;
@@ -35,8 +60,7 @@ const api = {
     const url = category 
       ? `${API_BASE_URL}/products?category=${encodeURIComponent(category)}`
       : `${API_BASE_URL}/products`;
-    const response = await fetch(url);
-    return handleResponse<Product[]>(response);
+    return fetchAllPages<Product>(url);
   },
 
   getStockLevels: async () => {
@@ -67,6 +91,13 @@ const api = {
     return handleResponse<Product[]>(response);
   },
 
+  searchProducts: async (query: string, category?: string): Promise<Product[]> => {
+    const params = new URLSearchParams({ q: query });
+    if (category) params.set('category', category);
+    const response = await fetch(`${API_BASE_URL}/products/search?${params}`);
+    return handleResponse<Product[]>(response);
+  },
+
   getProductById: async (id: number): Promise<Product> => {
     const response = await fetch(`${API_BASE_URL}/products/${id}`);
     return handleResponse<Product>(response);
@@ -110,24 +141,101 @@ const api = {
   },
 
   placeOrder: async (orderData: { user_id: number; items: { product_id: number; quantity: number; price: number }[] }, token: string): Promise<{ order_id: number; message: string; total_price: number }> => {
-    const response = await fetch(`${API_BASE_URL}/place_order`, {
+    // Every attempt sends the same key, so a retry after a timeout returns the first order instead of placing another
+    const idempotencyKey = crypto.randomUUID();
+    for (let attempt = 0; ; attempt++) {
+      const controller = new AbortController();
+      const timer = setTimeout(() => controller.abort(), ORDER_TIMEOUT_MS);
+      let response: Response;
+      try {
+        response = await fetch(`${API_BASE_URL}/place_order`, {
+          method: 'POST',
+          headers: {
+            'Content-Type': 'application/json',
+            'Authorization': `Bearer ${token}`,
+            'Idempotency-Key': idempotencyKey,
+          },
+          body: JSON.stringify(orderData),
+          // Carries the read-your-writes cookie so the next order history read sees this order
+          credentials: 'include',
+          signal: controller.signal,
+        });
+      } catch (error) {
+        // Timeout or network failure: the order may exist or not, and the key makes retrying safe either way
+        if (attempt >= ORDER_RETRIES) {
+          throw error;
+        }
+        continue;
+      } finally {
+        clearTimeout(timer);
+      }
+      // 5xx, or 409 with Retry-After while the first attempt is still running; other errors are final
+      const retryable = response.status >= 500 || (response.status === 409 && response.headers.has('Retry-After'));
+      if (retryable && attempt < ORDER_RETRIES) {
+        await new Promise((resolve) => setTimeout(resolve, 500 * (attempt + 1)));
+        continue;
+      }
+      return handleResponse<{ order_id: number; message: string; total_price: number }>(response);
+    }
+  },
+
+  // Server-side cart: the backend keeps it per user and writes it to the database in the background.
+  // credentials: 'include' carries the cart_v cookie, so whichever worker answers sees the latest change.
+  getCart: async (token: string): Promise<ServerCart> => {
+    const response = await fetch(`${API_BASE_URL}/cart`, {
+      headers: { 'Authorization': `Bearer ${token}` },
+      credentials: 'include',
+    });
+    return handleResponse<ServerCart>(response);
+  },
+
+  replaceCart: async (items: { product_id: number; quantity: number }[], token: string): Promise<ServerCart> => {
+    const response = await fetch(`${API_BASE_URL}/cart`, {
+      method: 'PUT',
+      headers: { 'Content-Type': 'application/json', 'Authorization': `Bearer ${token}` },
+      body: JSON.stringify({ items }),
+      credentials: 'include',
+    });
+    return handleResponse<ServerCart>(response);
+  },
+
+  addCartItem: async (productId: number, quantity: number, token: string): Promise<ServerCart> => {
+    const response = await fetch(`${API_BASE_URL}/cart/items`, {
       method: 'POST',
-      headers: {
-        'Content-Type': 'application/json',
-        'Authorization': `Bearer ${token}`,
-      },
-      body: JSON.stringify(orderData),
+      headers: { 'Content-Type': 'application/json', 'Authorization': `Bearer ${token}` },
+      body: JSON.stringify({ product_id: productId, quantity }),
+      credentials: 'include',
+    });
+    return handleResponse<ServerCart>(response);
+  },
+
+  updateCartItem: async (productId: number, quantity: number, token: string): Promise<ServerCart> => {
+    const response = await fetch(`${API_BASE_URL}/cart/items/${productId}`, {
+      method: 'PUT',
+      headers: { 'Content-Type': 'application/json', 'Authorization': `Bearer ${token}` },
+      body: JSON.stringify({ quantity }),
+      credentials: 'include',
+    });
+    return handleResponse<ServerCart>(response);
+  },
+
+  removeCartItem: async (productId: number, token: string): Promise<ServerCart> => {
+    const response = await fetch(`${API_BASE_URL}/cart/items/${productId}`, {
+      method: 'DELETE',
+      headers: { 'Authorization': `Bearer ${token}` },
+      credentials: 'include',
     });
-    return handleResponse<{ order_id: number; message: string; total_price: number }>(response);
+    return handleResponse<ServerCart>(response);
   },
 
   getOrderHistory: async (token: string): Promise<Order[]> => {
-    const response = await fetch(`${API_BASE_URL}/orders`, {
+    // Largest page the server allows (ORDERS_MAX_PAGE_SIZE), so long histories take few round trips
+    return fetchAllPages<Order>(`${API_BASE_URL}/orders?limit=200`, {
       headers: {
         'Authorization': `Bearer ${token}`,
       },
+      credentials: 'include',
     });
-    return handleResponse<Order[]>(response);
   },
 
   cancelOrder: async (orderId: number, token: string): Promise<{ message: string }> => {
@@ -137,6 +245,7 @@ const api = {
         'Authorization': `Bearer ${token}`,
         'Content-Type': 'application/json',
       },
+      credentials: 'include',
     });
     return handleResponse<{ message: string }>(response);
   },
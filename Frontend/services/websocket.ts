@@ -1,10 +1,13 @@
 let socket: WebSocket | null = null;
 let reconnectTimer: NodeJS.Timeout;
 
+// The push gateway (push_gateway.py) runs beside the API on its own port
+const WS_BASE_URL = import.meta.env.VITE_WS_URL || 'ws://localhost:5001';
+
 export const connectWebSocket = (userId: string) => {
     if (socket) return;
 
-    socket = new WebSocket(`ws://localhost:5000/ws/${userId}`);
+    socket = new WebSocket(`${WS_BASE_URL}/ws/${userId}`);
 
     socket.onmessage = (event) => {
         const data = JSON.parse(event.data);
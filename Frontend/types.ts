@@ -69,6 +69,7 @@ export type Action =
   | { type: 'UPDATE_CART_QUANTITY'; payload: { productId: number; quantity: number } }
   | { type: 'REMOVE_FROM_CART'; payload: number }
   | { type: 'CLEAR_CART' }
+  | { type: 'SET_CART'; payload: CartItem[] }
   | { type: 'SET_SEARCH_QUERY'; payload: string }
   | { type: 'SET_FILTER_OPTIONS'; payload: Partial<FilterOptions> }
   | { type: 'TOGGLE_FILTERS'; payload?: boolean };
@@ -2,6 +2,7 @@
 
 interface ImportMetaEnv {
   readonly VITE_API_URL: string
+  readonly VITE_WS_URL?: string
   readonly VITE_API_KEY?: string
   readonly GEMINI_API_KEY?: string
 }
@@ -1,54 +1,135 @@
 ﻿# -*- coding: utf-8 -*-
-from flask import Flask, request, jsonify, g
+from flask import Blueprint, Flask, current_app, request, jsonify, g
 from flask_cors import CORS
-import mysql.connector
+from werkzeug.middleware.proxy_fix import ProxyFix
+import hmac
 import logging
 import os
+import time
 from datetime import datetime
 from dotenv import load_dotenv
 
-# Load environment variables from .env file
+# Load environment variables from .env file before any module reads its settings
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(message)s")
+from db_pool import get_pool, PoolTimeout
+from db_replicas import get_replica_router
+from cart_store import CartOutOfStock, InvalidCartItem, get_cart_alerts, get_cart_store
+from idempotency import MAX_KEY_LENGTH, IdempotencyBusy, get_idempotency_store, request_fingerprint
+from logging_setup import configure_logging
+import metrics
+import profiling
+import responses
+import push_events
+import sales_analytics
+from mailer import get_dispatcher
+from password_hashing import HashingBusy, get_hasher
+from catalog_cache import catalog_cache, product_cache
+from checkout import InvalidOrder, OutOfStock, normalize_items, place_order_tx
+from stock_reservations import get_reservation_engine, restock, take_escrow
+from order_history import (fetch_archived_history, fetch_order_history, iter_archived_history, iter_order_history,
+                           parse_history_args)
+import stock_ledger
+from stock_ledger import MOVEMENT_TYPES, get_low_stock_index
+from catalog_query import (IN_STOCK, InvalidQuery, PRODUCT_COLUMNS, SELLABLE_STOCK, parse_product_filters,
+                           build_products_query, encode_cursor)
+from product_search import get_search_index, parse_search_args
+
 logger = logging.getLogger(__name__)
 
 from itsdangerous import URLSafeTimedSerializer
-import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'default-secret-key-change-in-production')
-serializer = URLSafeTimedSerializer(app.config['SECRET_KEY'])
+api = Blueprint("api", __name__)
+
+READ_PIN_COOKIE = "db_pin"
+CART_VERSION_COOKIE = "cart_v"
+
+def create_app():
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'default-secret-key-change-in-production')
+
+    # Behind a TLS-terminating proxy (Railway, a load balancer) trust its X-Forwarded-* headers, so
+    # request.is_secure and remote_addr describe the client rather than the proxy hop
+    proxy_hops = int(os.getenv('PROXY_FIX_HOPS', '0'))
+    if proxy_hops > 0:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxy_hops, x_proto=proxy_hops, x_host=proxy_hops)
+
+    # Structured, queue-backed logging with request ids and per-route sampling
+    configure_logging(app)
+    # Request, query, bcrypt and checkout instrumentation served on /metrics
+    metrics.init_app(app)
+    # orjson serialization, gzip/brotli negotiation and streamed collections
+    responses.init_app(app)
+    # Opt-in stack profiles (X-Debug-Profile or PROFILE_SAMPLE_RATE) and the slow-query log
+    profiling.init_app(app)
+
+    # Get CORS origins from environment or use defaults
+    cors_origins = os.getenv('CORS_ORIGINS', 'http://localhost:5173,http://localhost:3002,http://localhost:3000,http://localhost:3001').split(',')
+    CORS(app, resources={r"/*": {"origins": cors_origins}},
+         allow_headers=["Content-Type", "Authorization", "Accept", "X-Admin-Token", "Idempotency-Key",
+                        "X-Debug-Profile"],
+         expose_headers=["ETag", "X-Next-Cursor", "X-Request-ID", "Idempotent-Replayed", "X-Profile-Id"],
+         methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
+         supports_credentials=True)
+
+    app.teardown_appcontext(close_db)
+    app.register_blueprint(api)
+
+    metrics.registry.register_collector(pool_gauges)
+    metrics.registry.register_collector(email_gauges)
+    metrics.registry.register_collector(product_cache_gauges)
+    metrics.registry.register_collector(replica_gauges)
+    metrics.registry.register_collector(idempotency_gauges)
+    metrics.registry.register_collector(cart_gauges)
+    metrics.registry.register_collector(profiling_gauges)
+    metrics.registry.register_collector(sales_rollup_gauges)
+    return app
 
-# Get CORS origins from environment or use defaults
-cors_origins = os.getenv('CORS_ORIGINS', 'http://localhost:5173,http://localhost:3002,http://localhost:3000,http://localhost:3001').split(',')
-CORS(app, resources={r"/*": {"origins": cors_origins}},
-     allow_headers=["Content-Type", "Authorization", "Accept"],
-     methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-     supports_credentials=True)
+def warm_worker(app):
+    """Prepare a freshly forked worker before it takes traffic.
+
+    Opens the worker's own database connections and fills the catalog
+    cache and search index, so the first requests don't pay for it. Any
+    failure is logged and left to the lazy paths to retry.
+    """
+    started = time.perf_counter()
+    try:
+        get_pool().prefill(int(os.getenv('DB_POOL_WARM', '2')))
+        router = get_replica_router()
+        if router is not None:
+            # Put healthy replicas in rotation now rather than after the checker's first pass
+            router.check_all()
+            router.start()
+        alerts = get_cart_alerts()
+        if alerts is not None:
+            alerts.start()
+        reservations = get_reservation_engine()
+        if reservations is not None:
+            # Its first pass returns stock that a killed predecessor still held in escrow
+            reservations.start()
+        with app.app_context():
+            catalog_cache.get(load_catalog_body)
+            cursor = get_db().cursor(dictionary=True)
+            index = get_search_index()
+            try:
+                index.ensure_built(cursor)
+            finally:
+                cursor.close()
+            index.start()
+        logger.info("Worker %s warmed up in %.0f ms", os.getpid(), (time.perf_counter() - started) * 1000)
+    except Exception as e:
+        logger.error("Worker warm-up failed, caches will fill on demand: %s", e)
+
+def get_serializer():
+    return URLSafeTimedSerializer(current_app.config['SECRET_KEY'])
 
 def send_reset_email(email: str, reset_url: str) -> bool:
+    # Builds the message and hands it to the background dispatcher; delivery happens off the request thread
     try:
-        # Get email configuration from environment variables
-        email_host = os.getenv('EMAIL_HOST', 'smtp.gmail.com')
-        email_port = int(os.getenv('EMAIL_PORT', '587'))
-        email_username = os.getenv('EMAIL_USERNAME')
-        email_password = os.getenv('EMAIL_PASSWORD')
         email_from = os.getenv('EMAIL_FROM')
-        
-        # Debug logging
-        logger.info(f"Email Configuration:")
-        logger.info(f"Host: {email_host}")
-        logger.info(f"Port: {email_port}")
-        logger.info(f"Username: {email_username}")
-        logger.info(f"From: {email_from}")
-        logger.info(f"Password length: {len(email_password) if email_password else 0}")
-        logger.info(f"Sending to: {email}")
-
-        if not all([email_username, email_password, email_from]):
+        if not email_from:
             logger.error("Missing email configuration")
             return False
 
@@ -73,77 +154,272 @@ def send_reset_email(email: str, reset_url: str) -> bool:
         """
         
         msg.attach(MIMEText(body, 'plain'))
-        
-        try:
-            logger.info("Attempting to connect to SMTP server...")
-            with smtplib.SMTP(email_host, email_port, timeout=10) as server:
-                logger.info("Connected to SMTP server")
-                
-                logger.info("Starting TLS...")
-                server.starttls()  # Enable TLS
-                logger.info("TLS started")
-                
-                logger.info("Attempting login...")
-                server.login(email_username, email_password)
-                logger.info("Login successful")
-                
-                logger.info("Sending message...")
-                server.send_message(msg)
-                logger.info(f"Password reset email sent successfully to {email}")
-                return True
-                
-        except smtplib.SMTPAuthenticationError as auth_error:
-            logger.error(f"SMTP Authentication failed: {auth_error}")
-            logger.error("Please check your EMAIL_USERNAME and EMAIL_PASSWORD in .env")
-            return False
-        except smtplib.SMTPConnectError as conn_error:
-            logger.error(f"SMTP Connection failed: {conn_error}")
-            logger.error("Please check your EMAIL_HOST and EMAIL_PORT in .env")
-            return False
-        except smtplib.SMTPException as smtp_error:
-            logger.error(f"SMTP error while sending email: {smtp_error}")
-            return False
-        except TimeoutError:
-            logger.error("Connection timed out. Please check your internet connection.")
-            return False
+        return get_dispatcher().enqueue(msg)
             
     except Exception as e:
-        logger.error(f"Error in send_reset_email: {e}")
+        logger.error("Error in send_reset_email: %s", e)
         return False
 
 def get_db():
+    # Borrow a connection from this worker's pool for the rest of the request
     if not hasattr(g, "db"):
         try:
-            g.db = mysql.connector.connect(
-                host=os.getenv('DB_HOST', 'localhost'),
-                user=os.getenv('DB_USER', 'ecommerce_user'),
-                password=os.getenv('DB_PASSWORD', 'ecommerce123'),
-                database=os.getenv('DB_NAME', 'ecommerce')
-            )
-            if not g.db.is_connected():
-                raise Exception("Failed to connect to database")
-            logger.info("Successfully connected to database")
+            started = time.perf_counter()
+            g.db = get_pool().acquire()
+            metrics.observe("db_connection_acquire_seconds", time.perf_counter() - started)
+        except PoolTimeout as e:
+            logger.error("Database pool exhausted: %s", e)
+            raise
         except Exception as e:
-            logger.error(f"Database connection error: {str(e)}")
+            logger.error("Database connection error: %s", e)
             raise
     return g.db
 
-@app.teardown_appcontext
+def reads_pinned(router, user_id):
+    # Keyed by string: ids come from the token as ints but from JSON bodies as either
+    if router.pinned(str(user_id)):
+        return True
+    # Set by pin_reads() on this client's last write, which another worker may have served
+    try:
+        until = float(request.cookies.get(READ_PIN_COOKIE, 0))
+    except ValueError:
+        return False
+    now = time.time()
+    return now < until <= now + router.pin_seconds
+
+def get_read_db(user_id=None):
+    # Read-only queries go to a replica unless this request or this user needs the primary
+    if "db" in g:
+        return g.db
+    if "read_db" in g:
+        return g.read_db
+    router = get_replica_router()
+    if router is None:
+        return get_db()
+    conn = replica = None
+    if user_id is None or not reads_pinned(router, user_id):
+        conn, replica = router.acquire()
+    if conn is None:
+        metrics.inc("db_reads_total", ("primary",))
+        return get_db()
+    metrics.inc("db_reads_total", (replica.name,))
+    g.read_db = conn
+    return conn
+
+def cookie_flags():
+    # Secure + SameSite=None so a frontend on another site (Vercel) sends the cookie back on credentialed fetches;
+    # COOKIE_SECURE=auto follows the request scheme, which needs PROXY_FIX_HOPS behind a TLS proxy
+    secure = os.getenv('COOKIE_SECURE', 'auto').lower()
+    secure = request.is_secure if secure == 'auto' else secure == 'true'
+    samesite = os.getenv('COOKIE_SAMESITE') or ("None" if secure else "Lax")
+    return {"httponly": True, "secure": secure, "samesite": samesite}
+
+def pin_reads(response, user_id):
+    # Read-your-writes: this user's next reads skip the replicas until they have caught up
+    router = get_replica_router()
+    if router is None:
+        return response
+    router.pin(str(user_id))
+    response.set_cookie(READ_PIN_COOKIE, str(int(time.time() + router.pin_seconds)),
+                        max_age=int(router.pin_seconds), **cookie_flags())
+    return response
+
 def close_db(error):
-    if hasattr(g, "db"):
-        try:
-            if g.db.is_connected():
-                g.db.close()
-                logger.info("Database connection closed")
-        except Exception as e:
-            logger.error(f"Error closing database connection: {str(e)}")
+    for name in ("db", "read_db"):
+        db = g.pop(name, None)
+        if db is not None:
+            try:
+                # Returns the connection to the pool rather than closing the socket
+                db.close()
+            except Exception as e:
+                logger.error("Error releasing database connection: %s", e)
+
+@api.route("/pool_stats")
+def pool_stats():
+    return jsonify(get_pool().stats())
+
+@api.route("/replica_stats")
+def replica_stats():
+    router = get_replica_router()
+    return jsonify(router.stats() if router is not None else [])
+
+@api.route("/product_cache_stats")
+def product_cache_stats():
+    return jsonify(product_cache.info())
+
+@api.route("/email_stats")
+def email_stats():
+    return jsonify(get_dispatcher().metrics())
+
+def pool_gauges():
+    stats = get_pool().stats()
+    return {
+        "db_pool_open_connections": {"help": "Open pooled connections.", "value": stats["open"]},
+        "db_pool_checked_out": {"help": "Connections currently lent to requests.", "value": stats["checked_out"]},
+        "db_pool_timeouts": {"help": "Acquire attempts that timed out.", "value": stats["timeouts"]},
+    }
+
+def email_gauges():
+    stats = get_dispatcher().metrics()
+    return {
+        "email_queue_depth": {"help": "Emails waiting to be sent.", "value": stats["queued"]},
+        "email_sent": {"help": "Emails delivered.", "value": stats["sent"]},
+        "email_failed": {"help": "Emails abandoned after retries.", "value": stats["failed"]},
+    }
+
+def product_cache_gauges():
+    stats = product_cache.info()
+    return {
+        "product_cache_hits": {"help": "/products/<id> lookups served from cache.", "value": stats["hits"]},
+        "product_cache_misses": {"help": "/products/<id> lookups that queried the database.", "value": stats["misses"]},
+        "product_cache_coalesced": {"help": "/products/<id> lookups that waited on another request's query.",
+                                    "value": stats["coalesced"]},
+        "product_cache_size": {"help": "Products held in the cache.", "value": stats["size"]},
+    }
+
+def replica_gauges():
+    router = get_replica_router()
+    if router is None:
+        return {}
+    stats = router.stats()
+    lags = [replica["lag_seconds"] for replica in stats if replica["lag_seconds"] is not None]
+    return {
+        "db_replicas_in_rotation": {"help": "Replicas currently serving reads.",
+                                    "value": sum(1 for replica in stats if replica["in_rotation"])},
+        "db_replica_max_lag_seconds": {"help": "Highest replication lag seen on the last check.",
+                                       "value": max(lags) if lags else 0},
+    }
+
+def cart_gauges():
+    stats = get_cart_store().info()
+    return {
+        "carts_cached": {"help": "Carts held in this worker's cart store.", "value": stats["carts"]},
+        "carts_dirty": {"help": "Cart changes not yet written to the database.", "value": stats["dirty"]},
+        "cart_flush_dropped": {"help": "Cart writes given up on after retries or a full buffer.",
+                               "value": stats["dropped"]},
+        "cart_version_conflicts": {"help": "Cart writes skipped because another worker stored a newer cart.",
+                                   "value": stats["conflicts"]},
+    }
+
+def idempotency_gauges():
+    stats = get_idempotency_store().info()
+    return {
+        "idempotent_replays": {"help": "/place_order retries answered with the stored response.",
+                               "value": stats["replayed"]},
+        "idempotent_waits": {"help": "/place_order duplicates that waited for the original in this worker.",
+                             "value": stats["waited"]},
+    }
+
+def profiling_gauges():
+    return {
+        "slow_queries_logged": {"help": "Slow statements held in this worker's slow-query log.",
+                                "value": len(profiling.slow_queries.entries())},
+    }
+
+def sales_rollup_gauges():
+    stats = sales_analytics.rollup_stats()
+    return {
+        "sales_rollup_pending": {"help": "Placed or cancelled orders not yet added to the sales rollups.",
+                                 "value": stats["pending"]},
+        "sales_rollup_dropped": {"help": "Orders left out of the sales rollups after failed writes (backfill repairs them).",
+                                 "value": stats["dropped"]},
+    }
+
+@api.route("/metrics")
+def prometheus_metrics():
+    return current_app.response_class(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+def admin_denied(allow_open=True):
+    # Closed unless ADMIN_TOKEN is configured and sent; ADMIN_OPEN=true opens it for local development
+    token = os.getenv('ADMIN_TOKEN')
+    if not token:
+        if allow_open and os.getenv('ADMIN_OPEN', 'false').lower() == 'true':
+            return None
+        return jsonify({"error": "Admin access is not configured"}), 403
+    if not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), token):
+        return jsonify({"error": "Admin token required"}), 403
+    return None
+
+def profile_denied():
+    # Profiles and slow queries show request paths, SQL and plans: the admin token or a signed
+    # X-Debug-Profile header (PROFILE_SECRET), never ADMIN_OPEN
+    if profiling.verify_token(os.getenv('PROFILE_SECRET'), request.headers.get(profiling.PROFILE_HEADER)):
+        return None
+    return admin_denied(allow_open=False)
+
+def password_busy_response():
+    response = jsonify({"error": "Server is busy, please try again shortly"})
+    response.headers["Retry-After"] = "1"
+    return response, 503
+
+@api.route("/admin/profiles")
+def list_profiles():
+    denied = profile_denied()
+    if denied:
+        return denied
+    return jsonify(profiling.profiles.summaries())
+
+@api.route("/admin/profiles/<profile_id>")
+def get_profile(profile_id):
+    denied = profile_denied()
+    if denied:
+        return denied
+    profile = profiling.profiles.get(profile_id)
+    if profile is None:
+        return jsonify({"error": "Profile not found"}), 404
+    if request.args.get("format") == "folded":
+        # Collapsed stacks for flamegraph.pl or speedscope
+        body = "".join(f"{stack} {count}\n" for stack, count in profile["stacks"].items())
+        return current_app.response_class(body, mimetype="text/plain")
+    return jsonify(profile)
+
+@api.route("/admin/slow_queries")
+def slow_queries():
+    denied = profile_denied()
+    if denied:
+        return denied
+    return jsonify(profiling.slow_queries.entries())
+
+def analytics_query(report, parse_options=None):
+    # Revenue and sales figures: only with the configured admin token, never ADMIN_OPEN
+    denied = admin_denied(allow_open=False)
+    if denied:
+        return denied
+    try:
+        since, until = sales_analytics.parse_range(request.args)
+        options = parse_options(request.args) if parse_options else ()
+    except InvalidQuery as e:
+        return jsonify({"error": str(e)}), 400
+    cursor = get_read_db().cursor(dictionary=True)
+    try:
+        return jsonify(report(cursor, since, until, *options))
+    except Exception as e:
+        logger.error("Error reading sales rollups: %s", e)
+        return jsonify({"error": "Failed to fetch analytics"}), 500
+    finally:
+        cursor.close()
+
+# Reports read the daily rollups, so their cost depends on the days asked for, not the number of orders
+@api.route("/admin/analytics/summary")
+def analytics_summary():
+    return analytics_query(sales_analytics.sales_summary)
+
+@api.route("/admin/analytics/daily")
+def analytics_daily():
+    return analytics_query(sales_analytics.daily_sales)
+
+@api.route("/admin/analytics/categories")
+def analytics_categories():
+    return analytics_query(sales_analytics.category_sales)
 
-import bcrypt
+@api.route("/admin/analytics/top_products")
+def analytics_top_products():
+    return analytics_query(sales_analytics.top_products, sales_analytics.parse_top_args)
 
-@app.route("/add_user", methods=["POST"])
+@api.route("/add_user", methods=["POST"])
 def add_user():
     try:
-        logger.info("Received registration request")
+        logger.debug("Received registration request")
         data = request.get_json()
         if not data:
             logger.error("No JSON data received")
@@ -152,10 +428,6 @@ def add_user():
         username = data.get("username", "").strip()
         email = data.get("email", "").strip()
         password = data.get("password", "")
-        
-        # Hash the password
-        salt = bcrypt.gensalt()
-        hashed_password = bcrypt.hashpw(password.encode('utf-8'), salt)
 
         if not username or not email or not password:
             logger.error("Missing required fields")
@@ -167,33 +439,39 @@ def add_user():
         try:
             cursor.execute("SELECT id FROM users WHERE username = %s OR email = %s", (username, email))
             if cursor.fetchone():
-                logger.warning(f"User {username} or email {email} already exists")
+                logger.warning("User %s or email %s already exists", username, email)
                 return jsonify({"error": "Username or email already exists"}), 409
 
+            # Hash only once the request is known to be valid
+            hashed_password = get_hasher().hash(password)
+
             query = "INSERT INTO users (username, email, password) VALUES (%s, %s, %s)"
             cursor.execute(query, (username, email, hashed_password))
             db.commit()
             
-            logger.info(f"Successfully registered user: {username}")
+            logger.info("Successfully registered user: %s", username)
             return jsonify({
                 "message": "User registered successfully",
                 "user": {"username": username, "email": email}
             }), 201
 
+        except HashingBusy as e:
+            logger.warning("Registration rejected: %s", e)
+            return password_busy_response()
         except Exception as e:
-            logger.error(f"Database error: {e}")
+            logger.error("Database error: %s", e)
             return jsonify({"error": str(e)}), 500
         finally:
             cursor.close()
 
     except Exception as e:
-        logger.error(f"Registration error: {e}")
+        logger.error("Registration error: %s", e)
         return jsonify({"error": "An unexpected error occurred"}), 500
 
-@app.route("/login", methods=["POST"])
+@api.route("/login", methods=["POST"])
 def login():
     try:
-        logger.info("Received login request")
+        logger.debug("Received login request")
         data = request.get_json()
         if not data:
             logger.error("No JSON data received")
@@ -214,10 +492,21 @@ def login():
                          (username,))
             user = cursor.fetchone()
             
-            if user and bcrypt.checkpw(password.encode('utf-8'), user['password'].encode('utf-8')):
+            hasher = get_hasher()
+            if user and hasher.verify(password, user['password']):
+                if hasher.needs_rehash(user['password']):
+                    # Upgrade the stored hash to the configured cost factor; skipped when the pool is busy
+                    try:
+                        cursor.execute("UPDATE users SET password = %s WHERE id = %s",
+                                       (hasher.hash(password), user['id']))
+                        db.commit()
+                        logger.info("Rehashed password for user %s at cost %s", user['id'], hasher.rounds)
+                    except HashingBusy:
+                        logger.info("Deferred rehash for user %s", user['id'])
+
                 # User authenticated successfully
                 access_token = f"mock_token_{user['id']}"  # In production, use proper JWT tokens
-                logger.info(f"Login successful for user: {username}")
+                logger.info("Login successful for user: %s", username)
                 return jsonify({
                     "user": {
                         "id": user["id"],
@@ -227,54 +516,306 @@ def login():
                     "access_token": access_token
                 })
             
-            logger.warning(f"Failed login attempt for user: {username}")
+            logger.warning("Failed login attempt for user: %s", username)
             return jsonify({"error": "Invalid username or password"}), 401
 
+        except HashingBusy as e:
+            logger.warning("Login rejected: %s", e)
+            return password_busy_response()
         except Exception as e:
-            logger.error(f"Database error during login: {e}")
+            logger.error("Database error during login: %s", e)
             return jsonify({"error": "Database error occurred"}), 500
         finally:
             cursor.close()
 
     except Exception as e:
-        logger.error(f"Login error: {e}")
+        logger.error("Login error: %s", e)
         return jsonify({"error": "An unexpected error occurred"}), 500
 
-@app.route("/products", methods=["GET"])
+def load_catalog_body():
+    # Cache fills read the primary: a snapshot from a lagging replica would be served until the next change
+    db = get_db()
+    cursor = db.cursor(dictionary=True)
+    try:
+        # Get all products with their basic information
+        cursor.execute(f"SELECT {PRODUCT_COLUMNS} FROM products WHERE {IN_STOCK} ORDER BY id DESC")
+        products = cursor.fetchall()
+        logger.info("Loaded %s products into catalog cache", len(products))
+        return responses.dumps(products)
+    finally:
+        cursor.close()
+
+def get_products_page(filters):
+    db = get_read_db()
+    cursor = db.cursor(dictionary=True)
+    try:
+        sql, params = build_products_query(filters)
+        cursor.execute(sql, params)
+        products = cursor.fetchall()
+    except Exception as e:
+        logger.error("Database error while fetching products: %s", e)
+        return jsonify({"error": "Failed to fetch products"}), 500
+    finally:
+        cursor.close()
+
+    response = jsonify(products[:filters["limit"]])
+    if len(products) > filters["limit"]:
+        response.headers["X-Next-Cursor"] = encode_cursor(filters["sort"], products[filters["limit"] - 1])
+    return response
+
+@api.route("/products", methods=["GET"])
 def get_products():
     try:
-        logger.info("Fetching products")
-        db = get_db()
+        logger.debug("Fetching products")
+
+        try:
+            filters = parse_product_filters(request.args)
+        except InvalidQuery as e:
+            return jsonify({"error": str(e)}), 400
+
+        if filters is not None:
+            return get_products_page(filters)
+
+        stream = responses.stream_format()
+        if stream:
+            # Straight from a server-side cursor, bypassing the cached snapshot
+            cursor = get_read_db().cursor(dictionary=True)
+            cursor.execute(f"SELECT {PRODUCT_COLUMNS} FROM products WHERE {IN_STOCK} ORDER BY id DESC")
+            return responses.streamed_response(responses.cursor_batches(cursor), stream)
+
+        try:
+            snapshot = catalog_cache.get(load_catalog_body)
+        except Exception as e:
+            logger.error("Database error while fetching products: %s", e)
+            return jsonify({"error": "Failed to fetch products"}), 500
+
+        response = responses.cached_response(snapshot)
+        # Clients may keep the body but must revalidate before reusing it
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+
+    except Exception as e:
+        logger.error("Error in get_products: %s", e)
+        return jsonify({"error": "An unexpected error occurred"}), 500
+
+def load_product_body(product_id):
+    db = get_db()
+    cursor = db.cursor(dictionary=True)
+    try:
+        cursor.execute(f"SELECT {PRODUCT_COLUMNS} FROM products WHERE id = %s", (product_id,))
+        product = cursor.fetchone()
+        return responses.dumps(product) if product else None
+    finally:
+        cursor.close()
+
+def refresh_search_index(index):
+    # Syncs and rebuilds run on the index's own thread; a request only builds it when there is nothing to serve yet
+    index.start()
+    if index.built():
+        return True
+    cursor = get_db().cursor(dictionary=True)
+    try:
+        index.ensure_built(cursor)
+        return True
+    except Exception as e:
+        logger.error("Failed to refresh search index: %s", e)
+        return False
+    finally:
+        cursor.close()
+
+@api.route("/products/search", methods=["GET"])
+def search_products():
+    try:
+        try:
+            params = parse_search_args(request.args)
+        except InvalidQuery as e:
+            return jsonify({"error": str(e)}), 400
+
+        index = get_search_index()
+        if not refresh_search_index(index) and not len(index):
+            return jsonify({"error": "Search is temporarily unavailable"}), 503
+
+        return jsonify(index.search(params["q"], params["category"], params["min_price"],
+                                    params["max_price"], params["limit"]))
+
+    except Exception as e:
+        logger.error("Error in search_products: %s", e)
+        return jsonify({"error": "An unexpected error occurred"}), 500
+
+@api.route("/products/<int:product_id>", methods=["GET"])
+def get_product(product_id):
+    try:
+        try:
+            entry = product_cache.get(product_id, load_product_body)
+        except Exception as e:
+            logger.error("Database error while fetching product %s: %s", product_id, e)
+            return jsonify({"error": "Failed to fetch product"}), 500
+
+        if entry.body is None:
+            return jsonify({"error": "Product not found"}), 404
+
+        response = responses.cached_response(entry)
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+
+    except Exception as e:
+        logger.error("Error in get_product: %s", e)
+        return jsonify({"error": "An unexpected error occurred"}), 500
+
+@api.route("/api/products/stock", methods=["GET"])
+def get_stock_levels():
+    try:
+        db = get_read_db()
         cursor = db.cursor(dictionary=True)
+        try:
+            cursor.execute(f"SELECT id, {SELLABLE_STOCK} AS stock FROM products ORDER BY id")
+            levels = [{"productId": row["id"], "quantity": row["stock"]} for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+        return jsonify(levels)
+
+    except Exception as e:
+        logger.error("Error fetching stock levels: %s", e)
+        return jsonify({"error": "Failed to fetch stock levels"}), 500
 
+@api.route("/api/products/stock/<int:product_id>", methods=["PUT"])
+def update_stock(product_id):
+    try:
+        denied = admin_denied()
+        if denied:
+            return denied
 
+        data = request.get_json(silent=True) or {}
+        movement_type = data.get("movement_type")
+        reason = str(data.get("reason") or "")
         try:
-            # Get all products with their basic information
+            change = int(data.get("quantity_change"))
+        except (TypeError, ValueError):
+            return jsonify({"error": "quantity_change must be an integer"}), 400
+        if movement_type not in MOVEMENT_TYPES:
+            return jsonify({"error": f"movement_type must be one of: {', '.join(MOVEMENT_TYPES)}"}), 400
+        # "in" and "out" give a direction to the amount; "adjustment" applies it as a signed correction
+        if movement_type == "in":
+            change = abs(change)
+        elif movement_type == "out":
+            change = -abs(change)
+        if change == 0:
+            return jsonify({"error": "quantity_change must not be zero"}), 400
+
+        db = get_db()
+        cursor = db.cursor(dictionary=True)
+
+        try:
+            cursor.execute("START TRANSACTION")
+            cursor.execute("SELECT name, stock FROM products WHERE id = %s FOR UPDATE", (product_id,))
+            product = cursor.fetchone()
+            if not product:
+                db.rollback()
+                return jsonify({"error": "Product not found"}), 404
+
+            # Units the reservation engines hold are for sale too, so a removal may have to come out of them
             cursor.execute("""
-                SELECT id, name, description, price, stock, image, category 
-                FROM products
-                WHERE stock > 0
-                ORDER BY id DESC
-            """)
-            products = cursor.fetchall()
-            
-            logger.info(f"Found {len(products)} products")
-            return jsonify(products)
+                SELECT owner, quantity FROM stock_escrow
+                WHERE product_id = %s AND quantity > 0
+                ORDER BY owner
+                FOR UPDATE
+            """, (product_id,))
+            held = [(row["owner"], row["quantity"]) for row in cursor.fetchall()]
+            sellable = product["stock"] + sum(quantity for _, quantity in held)
+            new_stock = sellable + change
+            if new_stock < 0:
+                db.rollback()
+                return jsonify({"error": f"Only {sellable} units in stock"}), 409
+
+            column_stock = product["stock"] + change
+            if column_stock < 0:
+                take_escrow(cursor, product_id, held, -column_stock)
+                column_stock = 0
+            cursor.execute("UPDATE products SET stock = %s WHERE id = %s", (column_stock, product_id))
+            # Manual changes are rare, so their ledger row commits with the change itself
+            stock_ledger.insert_movements(cursor, [stock_ledger.movement(product_id, change, movement_type, reason)])
+            db.commit()
+
+            catalog_cache.bump()
+            product_cache.invalidate([product_id])
+            get_search_index().update_stock(product_id, new_stock)
+            get_low_stock_index().note(product_id, new_stock)
+            push_events.stock_changed({product_id: {"name": product["name"], "stock": new_stock}})
+            logger.info("Stock for product %s changed by %s (%s)", product_id, change, movement_type)
+
+            return jsonify({
+                "success": True,
+                "message": "Stock updated successfully",
+                "productId": product_id,
+                "quantity": new_stock
+            })
 
         except Exception as e:
-            logger.error(f"Database error while fetching products: {e}")
-            return jsonify({"error": "Failed to fetch products"}), 500
+            db.rollback()
+            logger.error("Database error while updating stock: %s", e)
+            return jsonify({"error": "Failed to update stock"}), 500
         finally:
             cursor.close()
 
     except Exception as e:
-        logger.error(f"Error in get_products: {e}")
+        logger.error("Error in update_stock: %s", e)
         return jsonify({"error": "An unexpected error occurred"}), 500
 
-@app.route("/forgot-password", methods=["POST"])
+@api.route("/api/products/stock/movements", methods=["GET"])
+def get_stock_movements():
+    try:
+        try:
+            limit, product_id, before = stock_ledger.parse_movement_args(request.args)
+        except InvalidQuery as e:
+            return jsonify({"error": str(e)}), 400
+
+        db = get_read_db()
+        cursor = db.cursor(dictionary=True)
+
+        stream = responses.stream_format()
+        if stream:
+            # Full export: rows are streamed in batches instead of being built into one response
+            sql, params = stock_ledger.movements_query(product_id, before)
+            cursor.execute(sql, params)
+            return responses.streamed_response(
+                responses.cursor_batches(cursor, stock_ledger.format_movement), stream)
+
+        try:
+            movements, next_cursor = stock_ledger.fetch_movements(cursor, limit, product_id, before)
+        except Exception as e:
+            logger.error("Database error while fetching stock movements: %s", e)
+            return jsonify({"error": "Failed to fetch stock movements"}), 500
+        finally:
+            cursor.close()
+
+        response = jsonify(movements)
+        if next_cursor:
+            response.headers["X-Next-Cursor"] = next_cursor
+        return response
+
+    except Exception as e:
+        logger.error("Error in get_stock_movements: %s", e)
+        return jsonify({"error": "An unexpected error occurred"}), 500
+
+@api.route("/api/products/stock/low", methods=["GET"])
+def get_low_stock_products():
+    try:
+        db = get_db()
+        cursor = db.cursor(dictionary=True)
+        try:
+            products = get_low_stock_index().get(cursor)
+        finally:
+            cursor.close()
+        return jsonify(products)
+
+    except Exception as e:
+        logger.error("Error fetching low stock products: %s", e)
+        return jsonify({"error": "Failed to fetch low stock products"}), 500
+
+@api.route("/forgot-password", methods=["POST"])
 def forgot_password():
     try:
-        logger.info("Received forgot password request")
+        logger.debug("Received forgot password request")
         data = request.get_json()
         
         if not data:
@@ -286,7 +827,7 @@ def forgot_password():
             logger.error("No email provided")
             return jsonify({"error": "Email is required"}), 400
             
-        logger.info(f"Processing forgot password request for email: {email}")
+        logger.info("Processing forgot password request for email: %s", email)
         
         db = get_db()
         cursor = db.cursor(dictionary=True)
@@ -298,13 +839,13 @@ def forgot_password():
             
             if not user:
                 # Don't reveal whether the email exists
-                logger.info(f"No user found with email: {email}")
+                logger.info("No user found with email: %s", email)
                 return jsonify({
                     "message": "If your email is registered, you will receive a password reset link"
                 }), 200
             
             # Generate reset token
-            token = serializer.dumps(email, salt='password-reset-salt')
+            token = get_serializer().dumps(email, salt='password-reset-salt')
             
             # Create reset URL
             frontend_url = os.getenv('FRONTEND_URL', 'http://localhost:5173')
@@ -313,112 +854,192 @@ def forgot_password():
             try:
                 # Send reset email
                 if send_reset_email(email, reset_url):
-                    logger.info(f"Password reset email sent successfully to {email}")
+                    logger.info("Password reset email queued for %s", email)
                     return jsonify({
                         "message": "If your email is registered, you will receive a password reset link"
                     }), 200
                 else:
-                    logger.error(f"Failed to send reset email to {email}")
-                    return jsonify({"error": "Failed to send reset email"}), 500
+                    logger.error("Failed to queue reset email to %s", email)
+                    return jsonify({"error": "Failed to send reset email"}), 503
                     
             except Exception as e:
-                logger.error(f"Error sending reset email: {e}")
+                logger.error("Error sending reset email: %s", e)
                 return jsonify({"error": "Failed to send reset email"}), 500
                 
         except Exception as e:
-            logger.error(f"Database error during forgot password: {e}")
+            logger.error("Database error during forgot password: %s", e)
             return jsonify({"error": "An error occurred while processing your request"}), 500
         finally:
             cursor.close()
             
     except Exception as e:
-        logger.error(f"Forgot password error: {e}")
+        logger.error("Forgot password error: %s", e)
         return jsonify({"error": "An unexpected error occurred"}), 500
 
-@app.route("/place_order", methods=["POST"])
+def idempotency_busy_response(message):
+    response = jsonify({"error": message})
+    response.headers["Retry-After"] = "1"
+    return response, 409
+
+def replayed_response(stored, fingerprint):
+    if stored.fingerprint != fingerprint:
+        return jsonify({"error": "Idempotency-Key was already used for a different order"}), 422
+    response = current_app.response_class(stored.body, status=stored.status, mimetype="application/json")
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+@api.route("/place_order", methods=["POST"])
 def place_order():
     try:
-        logger.info("Received order placement request")
+        logger.debug("Received order placement request")
         data = request.get_json()
         if not data:
             logger.error("No JSON data received")
             return jsonify({"error": "No data provided"}), 400
 
         user_id = data.get("user_id")
-        items = data.get("items", [])
-        
-        if not user_id or not items:
+        if not user_id:
             logger.error("Missing required fields")
             return jsonify({"error": "Missing required fields"}), 400
 
-        db = get_db()
-        cursor = db.cursor(dictionary=True)
+        idempotency_key = request.headers.get("Idempotency-Key")
+        if idempotency_key is None:
+            return checkout(user_id, data.get("items", []))
 
+        if not 0 < len(idempotency_key) <= MAX_KEY_LENGTH:
+            return jsonify({"error": f"Idempotency-Key must be 1 to {MAX_KEY_LENGTH} characters"}), 400
         try:
-            # Start transaction
-            cursor.execute("START TRANSACTION")
-            
-            # Calculate total price and validate stock
-            total_price = 0
-            for item in items:
-                cursor.execute("""
-                    SELECT price, stock FROM products 
-                    WHERE id = %s AND stock >= %s
-                """, (item["product_id"], item["quantity"]))
-                product = cursor.fetchone()
-                
-                if not product:
-                    raise Exception(f"Product {item['product_id']} not available in requested quantity")
-                
-                total_price += product["price"] * item["quantity"]
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            return jsonify({"error": "user_id must be an integer"}), 400
 
-            # Create order
-            cursor.execute("""
-                INSERT INTO orders (user_id, total_price, status) 
-                VALUES (%s, %s, 'pending')
-            """, (user_id, total_price))
-            
-            order_id = cursor.lastrowid
-
-            # Add order items and update stock
-            for item in items:
-                cursor.execute("""
-                    INSERT INTO order_items (order_id, product_id, quantity, price_at_time)
-                    SELECT %s, %s, %s, price FROM products WHERE id = %s
-                """, (order_id, item["product_id"], item["quantity"], item["product_id"]))
-                
-                cursor.execute("""
-                    UPDATE products 
-                    SET stock = stock - %s 
-                    WHERE id = %s
-                """, (item["quantity"], item["product_id"]))
+        store = get_idempotency_store()
+        fingerprint = request_fingerprint(user_id, data)
+        try:
+            # Duplicates reaching this worker wait here for the first request's outcome
+            with store.in_flight(user_id, idempotency_key):
+                cursor = get_db().cursor(dictionary=True)
+                try:
+                    stored = store.lookup(cursor, user_id, idempotency_key)
+                finally:
+                    cursor.close()
+                if stored is not None:
+                    # Before the cart is read: a retry of a cart checkout finds it already emptied
+                    logger.info("Replaying order response for user %s", user_id)
+                    return replayed_response(stored, fingerprint)
+                return checkout(user_id, data.get("items", []), (store, idempotency_key, fingerprint))
+        except IdempotencyBusy as e:
+            return idempotency_busy_response(str(e))
 
-            # Commit transaction
-            db.commit()
-            logger.info(f"Order {order_id} placed successfully for user {user_id}")
-            
-            return jsonify({
-                "message": "Order placed successfully",
-                "order_id": order_id,
-                "total_price": float(total_price)
-            }), 201
+    except Exception as e:
+        logger.error("Order placement error: %s", e)
+        return jsonify({"error": "An unexpected error occurred"}), 500
+
+def checkout(user_id, items, idempotency=None):
+    if not items:
+        # No items sent: check out the server-side cart, whose lines were validated as they were added
+        try:
+            items = get_cart_store().items(int(user_id), cart_min_version())
+        except (TypeError, ValueError):
+            return jsonify({"error": "user_id must be an integer"}), 400
+        if not items:
+            logger.error("Missing required fields")
+            return jsonify({"error": "Missing required fields"}), 400
+    return create_order(user_id, items, idempotency)
+
+def create_order(user_id, items, idempotency=None):
+    db = get_db()
+    cursor = db.cursor(dictionary=True)
+    reservations = get_reservation_engine()
+    reservation = None
+
+    try:
+        if reservations is not None:
+            # Take the units from this worker's escrow before any row is locked
+            reservation = reservations.reserve(normalize_items(items))
+
+        # Start transaction
+        cursor.execute("START TRANSACTION")
+
+        if idempotency is not None:
+            store, idempotency_key, fingerprint = idempotency
+            # Before any product lock: a duplicate on another worker blocks here until this one finishes
+            if not store.claim(cursor, user_id, idempotency_key, fingerprint):
+                db.rollback()
+                stored = store.lookup(cursor, user_id, idempotency_key)
+                if stored is None:
+                    # The other request's row expired or vanished in between; a retry settles it
+                    return idempotency_busy_response("Idempotency-Key is being reused, please retry")
+                return replayed_response(stored, fingerprint)
 
+        # Lock, validate and decrement every product in a fixed number of statements
+        order_id, total_price, quantities, remaining = place_order_tx(cursor, user_id, items, reserved=reservation is not None)
+
+        body = responses.dumps({
+            "message": "Order placed successfully",
+            "order_id": order_id,
+            "total_price": float(total_price)
+        })
+        if idempotency is not None:
+            stored = store.complete(cursor, user_id, idempotency_key, fingerprint, 201, body)
+
+        # Commit transaction
+        if reservation is not None:
+            reservations.commit(reservation, cursor, db.commit)
+        else:
+            db.commit()
+        if idempotency is not None:
+            store.committed(user_id, idempotency_key, stored)
+            store.purge_expired(db)
+        catalog_cache.bump()
+        product_cache.invalidate(quantities)
+        metrics.inc("checkout_outcomes_total", ("placed",))
+        stock_ledger.record_order(order_id, quantities)
+        sales_analytics.record_order(order_id)
+        push_events.order_status_changed(user_id, order_id, "pending")
+        try:
+            # Ordered units leave the cart; written behind like any other cart change
+            get_cart_store().checked_out(int(user_id), quantities)
         except Exception as e:
-            # Rollback transaction on error
-            db.rollback()
-            logger.error(f"Error placing order: {e}")
-            return jsonify({"error": str(e)}), 500
-        finally:
-            cursor.close()
+            logger.warning("Failed to clear cart of user %s: %s", user_id, e)
+        if remaining:
+            low_stock = get_low_stock_index()
+            search_index = get_search_index()
+            for product_id, product in remaining.items():
+                low_stock.note(product_id, product["stock"])
+                search_index.update_stock(product_id, product["stock"])
+            push_events.stock_changed(remaining)
+        logger.info("Order %s placed successfully for user %s", order_id, user_id)
+        
+        response = current_app.response_class(body, status=201, mimetype="application/json")
+        return pin_reads(response, user_id)
 
+    except InvalidOrder as e:
+        db.rollback()
+        metrics.inc("checkout_outcomes_total", ("invalid",))
+        return jsonify({"error": str(e)}), 400
+    except OutOfStock as e:
+        db.rollback()
+        metrics.inc("checkout_outcomes_total", ("out_of_stock",))
+        logger.info("Order rejected for user %s: %s", user_id, e)
+        return jsonify({"error": str(e)}), 409
     except Exception as e:
-        logger.error(f"Order placement error: {e}")
-        return jsonify({"error": "An unexpected error occurred"}), 500
+        # Rollback transaction on error
+        db.rollback()
+        metrics.inc("checkout_outcomes_total", ("rolled_back",))
+        logger.error("Error placing order: %s", e)
+        return jsonify({"error": str(e)}), 500
+    finally:
+        if reservation is not None:
+            # No-op once committed; otherwise the units go back to the escrow
+            reservations.cancel(reservation)
+        cursor.close()
 
-@app.route("/orders", methods=["GET"])
+
+@api.route("/orders", methods=["GET"])
 def get_orders():
     try:
-        logger.info("Received order history request")
+        logger.debug("Received order history request")
         
         # Get user ID from Authorization header
         auth_header = request.headers.get('Authorization')
@@ -432,66 +1053,56 @@ def get_orders():
         except:
             return jsonify({"error": "Invalid token format"}), 401
         
-        db = get_db()
+        # ?archived=1 pages through the orders order_archive.py moved out to segment files
+        archived = request.args.get("archived", "").lower() in ("1", "true")
+        fetch_page, iter_pages = ((fetch_archived_history, iter_archived_history) if archived
+                                  else (fetch_order_history, iter_order_history))
+        try:
+            limit, after = parse_history_args(request.args, archived)
+        except InvalidQuery as e:
+            return jsonify({"error": str(e)}), 400
+
+        db = get_read_db(user_id)
         cursor = db.cursor(dictionary=True)
 
+        stream = responses.stream_format()
+        if stream:
+            # Whole history, fetched page by page so memory stays flat
+            def batches():
+                try:
+                    yield from iter_pages(cursor, user_id)
+                finally:
+                    cursor.close()
+            return responses.streamed_response(batches(), stream)
+
         try:
-            # Get all orders for the user
-            cursor.execute("""
-                SELECT o.id, o.total_price, o.status, o.order_date
-                FROM orders o
-                WHERE o.user_id = %s
-                ORDER BY o.order_date DESC
-            """, (user_id,))
-            
-            orders = cursor.fetchall()
-            
-            # Format the response
-            formatted_orders = []
-            for order in orders:
-                # Get order items for this order
-                cursor.execute("""
-                    SELECT oi.product_id, oi.quantity, oi.price_at_time
-                    FROM order_items oi
-                    WHERE oi.order_id = %s
-                """, (order["id"],))
-                
-                items = cursor.fetchall()
-                
-                formatted_items = []
-                for item in items:
-                    formatted_items.append({
-                        "product_id": item["product_id"],
-                        "quantity": item["quantity"],
-                        "price": float(item["price_at_time"])
-                    })
-                
-                formatted_orders.append({
-                    "id": order["id"],
-                    "user_id": user_id,
-                    "total_price": float(order["total_price"]),
-                    "status": order["status"],
-                    "created_at": order["order_date"].isoformat() if order["order_date"] else None,
-                    "items": formatted_items
-                })
-            
-            logger.info(f"Found {len(formatted_orders)} orders for user {user_id}")
-            return jsonify(formatted_orders)
+            # One query for the page of orders and one for all of their items
+            # (archived: one for the index entries, then only the segment bytes the page needs)
+            formatted_orders, next_cursor = fetch_page(cursor, user_id, limit, after)
 
+            logger.info("Found %s orders for user %s", len(formatted_orders), user_id)
+            response = jsonify(formatted_orders)
+            if next_cursor:
+                response.headers["X-Next-Cursor"] = next_cursor
+            return response
+
+        except OSError as e:
+            logger.error("Order archive unreadable: %s", e)
+            return jsonify({"error": "Archived orders are temporarily unavailable"}), 503
         except Exception as e:
-            logger.error(f"Database error while fetching orders: {e}")
+            logger.error("Database error while fetching orders: %s", e)
             return jsonify({"error": "Failed to fetch orders"}), 500
         finally:
             cursor.close()
 
     except Exception as e:
-        logger.error(f"Error in get_orders: {e}")
+        logger.error("Error in get_orders: %s", e)
         return jsonify({"error": "An unexpected error occurred"}), 500
 
-@app.route("/orders/<int:order_id>/cancel", methods=["POST"])
+@api.route("/orders/<int:order_id>/cancel", methods=["POST"])
 def cancel_order(order_id):
     try:
-        logger.info(f"Received order cancellation request for order {order_id}")
+        logger.debug("Received order cancellation request for order %s", order_id)
         
         # Get user ID from Authorization header
         auth_header = request.headers.get('Authorization')
@@ -534,51 +1145,210 @@ def cancel_order(order_id):
             # Start transaction
             cursor.execute("START TRANSACTION")
             
-            # Update order status to cancelled
+            # Update order status to cancelled, unless a concurrent request got there first
             cursor.execute("""
                 UPDATE orders 
                 SET status = 'cancelled' 
-                WHERE id = %s
+                WHERE id = %s AND status = 'pending'
             """, (order_id,))
+            if cursor.rowcount != 1:
+                db.rollback()
+                return jsonify({"error": "Order is no longer pending"}), 409
             
-            # Restore product stock
+            # Restore product stock: every product in one statement, the reservation engine's group release
+            restored = {}
             for item in order_items:
-                cursor.execute("""
-                    UPDATE products 
-                    SET stock = stock + %s 
-                    WHERE id = %s
-                """, (item["quantity"], item["product_id"]))
+                restored[item["product_id"]] = restored.get(item["product_id"], 0) + item["quantity"]
+            if restored:
+                restock(cursor, restored)
             
             db.commit()
-            logger.info(f"Order {order_id} cancelled successfully by user {user_id}")
+            catalog_cache.bump()
+            reservations = get_reservation_engine()
+            if reservations is not None:
+                reservations.restocked(restored)
+            product_cache.invalidate(restored)
+            stock_ledger.record_order(order_id, restored, "in", "order cancelled")
+            sales_analytics.record_cancellation(order_id)
+            get_low_stock_index().mark_changed(restored)
+            push_events.order_status_changed(user_id, order_id, "cancelled")
+            logger.info("Order %s cancelled successfully by user %s", order_id, user_id)
             
-            return jsonify({"message": "Order cancelled successfully"}), 200
+            return pin_reads(jsonify({"message": "Order cancelled successfully"}), user_id), 200
 
         except Exception as e:
             db.rollback()
-            logger.error(f"Database error while cancelling order: {e}")
+            logger.error("Database error while cancelling order: %s", e)
             return jsonify({"error": "Failed to cancel order"}), 500
         finally:
             cursor.close()
 
     except Exception as e:
-        logger.error(f"Error in cancel_order: {e}")
+        logger.error("Error in cancel_order: %s", e)
+        return jsonify({"error": "An unexpected error occurred"}), 500
+
+def bearer_user_id():
+    # Same mock token as /orders: "mock_token_<user id>"
+    auth_header = request.headers.get('Authorization')
+    if not auth_header or not auth_header.startswith('Bearer '):
+        return None
+    try:
+        return int(auth_header.split(' ')[1].split('_')[2])
+    except (IndexError, ValueError):
+        return None
+
+def cart_min_version():
+    # The version this client saw last, possibly from another worker; older local copies are reloaded
+    try:
+        return int(request.cookies.get(CART_VERSION_COOKIE, 0))
+    except ValueError:
+        return 0
+
+def cart_product(product_id):
+    index = get_search_index()
+    refresh_search_index(index)
+    return index.get(product_id)
+
+def cart_response(version, lines, status=200):
+    items = []
+    total = 0
+    for product_id, line in sorted(lines.items()):
+        product = get_search_index().get(product_id) or {}
+        price = product.get("price", line.price)
+        total += price * line.quantity
+        items.append({
+            "product_id": product_id,
+            "name": product.get("name"),
+            "image": product.get("image"),
+            "quantity": line.quantity,
+            "price": price,
+            "price_when_added": line.price,
+            "stock": product.get("stock"),
+        })
+    response = jsonify({"items": items, "total": total, "version": version})
+    response.status_code = status
+    response.set_cookie(CART_VERSION_COOKIE, str(version), max_age=86400, **cookie_flags())
+    return response
+
+@api.route("/cart", methods=["GET"])
+def get_cart():
+    try:
+        user_id = bearer_user_id()
+        if user_id is None:
+            return jsonify({"error": "Missing or invalid authorization token"}), 401
+        version, lines = get_cart_store().view(user_id, cart_min_version())
+        return cart_response(version, lines)
+    except Exception as e:
+        logger.error("Error in get_cart: %s", e)
+        return jsonify({"error": "An unexpected error occurred"}), 500
+
+@api.route("/cart", methods=["PUT"])
+def replace_cart():
+    # The client's whole cart, e.g. after logging in with items added while logged out; [] empties it
+    try:
+        user_id = bearer_user_id()
+        if user_id is None:
+            return jsonify({"error": "Missing or invalid authorization token"}), 401
+        items = (request.get_json(silent=True) or {}).get("items")
+        if not isinstance(items, list):
+            return jsonify({"error": "items must be a list"}), 400
+        lines = []
+        for item in items:
+            try:
+                product_id = int(item["product_id"])
+            except (KeyError, TypeError, ValueError):
+                return jsonify({"error": "Each item needs a numeric product_id and quantity"}), 400
+            product = cart_product(product_id)
+            if product is None:
+                return jsonify({"error": f"Product {product_id} not found"}), 404
+            lines.append((product, item.get("quantity")))
+        try:
+            version, lines = get_cart_store().replace(user_id, lines, cart_min_version())
+        except CartOutOfStock as e:
+            return jsonify({"error": str(e)}), 409
+        except InvalidCartItem as e:
+            return jsonify({"error": str(e)}), 400
+        return cart_response(version, lines)
+    except Exception as e:
+        logger.error("Error in replace_cart: %s", e)
+        return jsonify({"error": "An unexpected error occurred"}), 500
+
+@api.route("/cart/items", methods=["POST"])
+def add_cart_item():
+    try:
+        user_id = bearer_user_id()
+        if user_id is None:
+            return jsonify({"error": "Missing or invalid authorization token"}), 401
+        data = request.get_json(silent=True) or {}
+        try:
+            product_id = int(data.get("product_id"))
+        except (TypeError, ValueError):
+            return jsonify({"error": "product_id must be an integer"}), 400
+        product = cart_product(product_id)
+        if product is None:
+            return jsonify({"error": "Product not found"}), 404
+        try:
+            version, lines = get_cart_store().add(user_id, product, data.get("quantity", 1), cart_min_version())
+        except CartOutOfStock as e:
+            return jsonify({"error": str(e)}), 409
+        except InvalidCartItem as e:
+            return jsonify({"error": str(e)}), 400
+        return cart_response(version, lines, 201)
+    except Exception as e:
+        logger.error("Error in add_cart_item: %s", e)
+        return jsonify({"error": "An unexpected error occurred"}), 500
+
+@api.route("/cart/items/<int:product_id>", methods=["PUT"])
+def update_cart_item(product_id):
+    try:
+        user_id = bearer_user_id()
+        if user_id is None:
+            return jsonify({"error": "Missing or invalid authorization token"}), 401
+        data = request.get_json(silent=True) or {}
+        product = cart_product(product_id)
+        if product is None:
+            return jsonify({"error": "Product not found"}), 404
+        try:
+            version, lines = get_cart_store().set_quantity(user_id, product, data.get("quantity"), cart_min_version())
+        except CartOutOfStock as e:
+            return jsonify({"error": str(e)}), 409
+        except InvalidCartItem as e:
+            return jsonify({"error": str(e)}), 400
+        return cart_response(version, lines)
+    except Exception as e:
+        logger.error("Error in update_cart_item: %s", e)
+        return jsonify({"error": "An unexpected error occurred"}), 500
+
+@api.route("/cart/items/<int:product_id>", methods=["DELETE"])
+def remove_cart_item(product_id):
+    try:
+        user_id = bearer_user_id()
+        if user_id is None:
+            return jsonify({"error": "Missing or invalid authorization token"}), 401
+        version, lines = get_cart_store().remove(user_id, product_id, cart_min_version())
+        return cart_response(version, lines)
+    except Exception as e:
+        logger.error("Error in remove_cart_item: %s", e)
         return jsonify({"error": "An unexpected error occurred"}), 500
 
-@app.route("/")
+@api.route("/")
 def home():
     return jsonify({
         "status": "running",
         "cors_allowed_origins": ["http://localhost:3000", "http://localhost:3001", "http://localhost:3002", "http://localhost:5173"]
     })
 
-@app.route("/test")
+@api.route("/test")
 def test():
     return jsonify({"message": "Backend is running"})
 
 if __name__ == "__main__":
+    # Development server only; production runs gunicorn -c gunicorn.conf.py
+    app = create_app()
     # Get port from environment variable (Railway/Heroku) or default to 5000
     port = int(os.getenv('PORT', 5000))
     # Use debug=False in production
     debug = os.getenv('FLASK_ENV') == 'development'
+    if os.getenv('SEARCH_WARM_ON_START', 'true').lower() == 'true':
+        warm_worker(app)
     app.run(host='0.0.0.0', port=port, debug=debug)
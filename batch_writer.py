@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import collections
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class BatchWriter:
+    """Buffers items in memory and hands them to ``flush`` in batches from a background thread.
+
+    add() only appends to a bounded deque, so the caller never waits on the
+    write. A batch is flushed once ``max_batch`` items are waiting or
+    ``interval`` seconds after the first one arrived. A failed flush is
+    retried with backoff up to ``max_retries`` times, then the batch is
+    dropped and counted. Anything still buffered when the process dies is
+    lost, so only use this for data that may lag or go missing.
+    """
+
+    def __init__(self, flush, name, max_batch=500, interval=0.5, queue_size=50000,
+                 max_retries=3, backoff=0.5):
+        self.flush = flush
+        self.name = name
+        self.max_batch = max_batch
+        self.interval = interval
+        self.queue_size = queue_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self._items = collections.deque()
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._flushing = False
+        self._draining = 0
+        self._thread = None
+        self.stats = {"written": 0, "dropped": 0, "batches": 0, "failed_flushes": 0}
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def add(self, item):
+        return self.extend((item,))
+
+    def extend(self, items):
+        self.start()
+        with self._cond:
+            if len(self._items) + len(items) > self.queue_size:
+                self.stats["dropped"] += len(items)
+                logger.warning("%s buffer full, dropped %s items", self.name, len(items))
+                return False
+            # Wake the flusher for the first item too: it waits without a timeout while the buffer is empty
+            was_empty = not self._items
+            self._items.extend(items)
+            if was_empty or len(self._items) >= self.max_batch:
+                self._cond.notify_all()
+        return True
+
+    def pending(self):
+        with self._cond:
+            return len(self._items) + (1 if self._flushing else 0)
+
+    def drain(self, timeout=5.0):
+        # Wait until everything added so far has been flushed (or given up on)
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._draining += 1
+            self._cond.notify_all()
+            try:
+                while (self._items or self._flushing) and self._thread is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+            finally:
+                self._draining -= 1
+        return True
+
+    def stop(self, timeout=5.0):
+        self.drain(timeout)
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._items and not self._stopping:
+                self._cond.wait()
+            if not self._items:
+                return None
+            # Give the batch a chance to fill before paying for a round trip
+            deadline = time.monotonic() + self.interval
+            while len(self._items) < self.max_batch and not (self._stopping or self._draining):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = [self._items.popleft() for _ in range(min(self.max_batch, len(self._items)))]
+            self._flushing = True
+            return batch
+
+    def _write(self, batch):
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.flush(batch)
+                self.stats["written"] += len(batch)
+                self.stats["batches"] += 1
+                return
+            except Exception as e:
+                self.stats["failed_flushes"] += 1
+                if attempt == self.max_retries:
+                    logger.error("%s dropped a batch of %s items after %s attempts: %s",
+                                 self.name, len(batch), attempt + 1, e)
+                    self.stats["dropped"] += len(batch)
+                    return
+                logger.warning("%s flush failed (attempt %s), retrying: %s", self.name, attempt + 1, e)
+                time.sleep(self.backoff * (2 ** attempt))
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                self._write(batch)
+            finally:
+                with self._cond:
+                    self._flushing = False
+                    self._cond.notify_all()
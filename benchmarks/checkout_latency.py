@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""Checkout latency against cart size: per-item statements vs. set-based place_order.
+
+Every checkout runs inside a transaction that is rolled back, so the
+benchmark can be pointed at any database that has a user and enough
+in-stock products without changing its data. Connection settings come
+from the same DB_* environment variables as the app.
+
+    python benchmarks/checkout_latency.py --sizes 1,5,10,20,50 --iterations 30
+    python benchmarks/checkout_latency.py --rtt-ms 0.5   # simulate a remote DB
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mysql.connector
+from dotenv import load_dotenv
+
+from checkout import place_order_tx
+from db_pool import db_connect_args
+
+
+class CountingCursor:
+    # Counts round-trips and optionally adds a fixed network delay to each one
+    def __init__(self, cursor, rtt):
+        self._cursor = cursor
+        self._rtt = rtt
+        self.statements = 0
+
+    def execute(self, sql, params=None):
+        self.statements += 1
+        if self._rtt:
+            time.sleep(self._rtt)
+        return self._cursor.execute(sql, params)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+def legacy_place_order(cursor, user_id, items):
+    # The per-item implementation place_order used before the set-based rewrite
+    total_price = 0
+    for item in items:
+        cursor.execute("""
+            SELECT price, stock FROM products
+            WHERE id = %s AND stock >= %s
+        """, (item["product_id"], item["quantity"]))
+        product = cursor.fetchone()
+        if not product:
+            raise Exception(f"Product {item['product_id']} not available in requested quantity")
+        total_price += product["price"] * item["quantity"]
+
+    cursor.execute("""
+        INSERT INTO orders (user_id, total_price, status)
+        VALUES (%s, %s, 'pending')
+    """, (user_id, total_price))
+    order_id = cursor.lastrowid
+
+    for item in items:
+        cursor.execute("""
+            INSERT INTO order_items (order_id, product_id, quantity, price_at_time)
+            SELECT %s, %s, %s, price FROM products WHERE id = %s
+        """, (order_id, item["product_id"], item["quantity"], item["product_id"]))
+        cursor.execute("""
+            UPDATE products
+            SET stock = stock - %s
+            WHERE id = %s
+        """, (item["quantity"], item["product_id"]))
+    return order_id
+
+
+def set_based_place_order(cursor, user_id, items):
+    return place_order_tx(cursor, user_id, items)[0]
+
+
+def run_checkout(db, impl, user_id, items, rtt):
+    cursor = CountingCursor(db.cursor(dictionary=True), rtt)
+    started = time.perf_counter()
+    try:
+        cursor.execute("START TRANSACTION")
+        impl(cursor, user_id, items)
+        elapsed = time.perf_counter() - started
+    finally:
+        db.rollback()
+        cursor.close()
+    return elapsed, cursor.statements
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1,5,10,20,50", help="comma-separated cart sizes")
+    parser.add_argument("--iterations", type=int, default=30)
+    parser.add_argument("--rtt-ms", type=float, default=0.0, help="artificial delay per statement")
+    parser.add_argument("--json", dest="json_path", help="also write results to this file")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    rtt = args.rtt_ms / 1000.0
+    db = mysql.connector.connect(**db_connect_args())
+    cursor = db.cursor(dictionary=True)
+    cursor.execute("SELECT id FROM users ORDER BY id LIMIT 1")
+    user = cursor.fetchone()
+    cursor.execute("SELECT id FROM products WHERE stock > 0 ORDER BY id LIMIT %s", (max(sizes),))
+    product_ids = [row["id"] for row in cursor.fetchall()]
+    cursor.close()
+    db.rollback()
+
+    if not user or len(product_ids) < max(sizes):
+        sys.exit(f"Need a user and at least {max(sizes)} in-stock products (found {len(product_ids)})")
+
+    results = []
+    print(f"{'items':>5} {'impl':>10} {'stmts':>6} {'p50 ms':>9} {'p95 ms':>9}")
+    for size in sizes:
+        items = [{"product_id": pid, "quantity": 1} for pid in product_ids[:size]]
+        for name, impl in (("per-item", legacy_place_order), ("set-based", set_based_place_order)):
+            samples = []
+            statements = 0
+            for _ in range(args.iterations):
+                elapsed, statements = run_checkout(db, impl, user["id"], items, rtt)
+                samples.append(elapsed * 1000)
+            row = {
+                "cart_size": size,
+                "impl": name,
+                "statements": statements,
+                "p50_ms": round(statistics.median(samples), 3),
+                "p95_ms": round(percentile(samples, 95), 3),
+            }
+            results.append(row)
+            print(f"{size:>5} {name:>10} {statements:>6} {row['p50_ms']:>9.2f} {row['p95_ms']:>9.2f}")
+
+    db.close()
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({"rtt_ms": args.rtt_ms, "iterations": args.iterations, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""Drive mixed traffic against the API and report throughput and latency per endpoint.
+
+Targets a running server over HTTP (--base-url) or, with --in-process,
+calls the Flask app directly through its test client so no server or
+network is involved. Either way the database behind the app must be
+seeded first (benchmarks/seed.py). Results can be saved as JSON and
+compared against an earlier run.
+
+    python benchmarks/loadtest.py --base-url http://localhost:5000 --concurrency 32 --duration 60 \\
+        --output results/$(git rev-parse --short HEAD).json --compare results/baseline.json
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from seed import BENCH_PASSWORD
+
+DEFAULT_MIX = "products=50,orders=20,place_order=15,login=10,cancel=5"
+
+
+class HttpClient:
+    # One persistent keep-alive connection per worker thread
+    def __init__(self, base_url, timeout):
+        parts = urlsplit(base_url)
+        conn_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+        self._connect = lambda: conn_class(parts.hostname, parts.port, timeout=timeout)
+        self._conn = self._connect()
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        payload = None
+        if body is not None:
+            payload = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        try:
+            self._conn.request(method, path, payload, headers)
+            response = self._conn.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError):
+            self._conn.close()
+            self._conn = self._connect()
+            raise
+        return response.status, data
+
+
+class InProcessClient:
+    def __init__(self, app):
+        self._client = app.test_client()
+
+    def request(self, method, path, body=None, headers=None):
+        response = self._client.open(path, method=method, json=body, headers=headers or {})
+        return response.status_code, response.get_data()
+
+
+class VirtualUser:
+    def __init__(self, client, user, product_ids, rng):
+        self.client = client
+        self.user = user
+        self.product_ids = product_ids
+        self.rng = rng
+        self.token = f"mock_token_{user['id']}"
+        self.open_orders = []
+
+    def auth(self):
+        return {"Authorization": f"Bearer {self.token}"}
+
+    def products(self):
+        return self.client.request("GET", "/products")
+
+    def login(self):
+        return self.client.request("POST", "/login", {"username": self.user["username"], "password": BENCH_PASSWORD})
+
+    def orders(self):
+        return self.client.request("GET", "/orders", headers=self.auth())
+
+    def place_order(self):
+        lines = self.rng.sample(self.product_ids, k=min(len(self.product_ids), self.rng.randint(1, 4)))
+        items = [{"product_id": pid, "quantity": self.rng.randint(1, 2)} for pid in lines]
+        status, data = self.client.request("POST", "/place_order", {"user_id": self.user["id"], "items": items},
+                                           headers=self.auth())
+        if status == 201:
+            self.open_orders.append(json.loads(data)["order_id"])
+        return status, data
+
+    def cancel(self):
+        if not self.open_orders:
+            return self.place_order()
+        order_id = self.open_orders.pop()
+        return self.client.request("POST", f"/orders/{order_id}/cancel", headers=self.auth())
+
+
+def parse_mix(spec):
+    mix = {}
+    for pair in spec.split(","):
+        name, _, weight = pair.partition("=")
+        mix[name.strip()] = float(weight)
+    return mix
+
+
+def load_fixtures(limit_users, limit_products):
+    import mysql.connector
+    from db_pool import db_connect_args
+
+    db = mysql.connector.connect(**db_connect_args())
+    cursor = db.cursor(dictionary=True)
+    cursor.execute("SELECT id, username FROM users WHERE username LIKE 'bench_user_%%' ORDER BY id LIMIT %s",
+                   (limit_users,))
+    users = cursor.fetchall()
+    cursor.execute("SELECT id FROM products WHERE stock > 10 ORDER BY id LIMIT %s", (limit_products,))
+    product_ids = [row["id"] for row in cursor.fetchall()]
+    db.close()
+    if not users or not product_ids:
+        sys.exit("No bench users or products found; run benchmarks/seed.py first")
+    return users, product_ids
+
+
+def percentile(ordered, pct):
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return round(ordered[index] * 1000, 2)
+
+
+def run(args):
+    users, product_ids = load_fixtures(args.users, args.products)
+    mix = parse_mix(args.mix)
+    names, weights = list(mix), list(mix.values())
+
+    if args.in_process:
+        from app import create_app
+        app = create_app()
+        make_client = lambda: InProcessClient(app)
+    else:
+        make_client = lambda: HttpClient(args.base_url, args.timeout)
+
+    samples = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.duration
+    remaining = [args.requests] if args.requests else None
+
+    def worker(index):
+        rng = random.Random(args.seed + index)
+        vu = VirtualUser(make_client(), users[index % len(users)], product_ids, rng)
+        local = {name: [] for name in names}
+        local_errors = {name: 0 for name in names}
+        while time.monotonic() < deadline:
+            if remaining is not None:
+                with lock:
+                    if remaining[0] <= 0:
+                        break
+                    remaining[0] -= 1
+            name = rng.choices(names, weights)[0]
+            started = time.perf_counter()
+            try:
+                status, _ = getattr(vu, name)()
+                ok = status < 500 and status != 429
+            except Exception:
+                ok = False
+            local[name].append(time.perf_counter() - started)
+            if not ok:
+                local_errors[name] += 1
+        with lock:
+            for name in names:
+                samples[name].extend(local[name])
+                errors[name] += local_errors[name]
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    endpoints = {}
+    for name in names:
+        ordered = sorted(samples[name])
+        endpoints[name] = {
+            "requests": len(ordered),
+            "errors": errors[name],
+            "rps": round(len(ordered) / elapsed, 1),
+            "p50_ms": percentile(ordered, 50),
+            "p95_ms": percentile(ordered, 95),
+            "p99_ms": percentile(ordered, 99),
+        }
+    total = sum(len(s) for s in samples.values())
+    return {
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "commit": git_commit(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        "elapsed_s": round(elapsed, 2),
+        "total_requests": total,
+        "total_rps": round(total / elapsed, 1),
+        "endpoints": endpoints,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(result, baseline=None):
+    print(f"{result['total_requests']} requests in {result['elapsed_s']}s ({result['total_rps']} req/s)")
+    print(f"{'endpoint':<12} {'reqs':>7} {'err':>5} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for name, stats in result["endpoints"].items():
+        line = (f"{name:<12} {stats['requests']:>7} {stats['errors']:>5} {stats['rps']:>8} "
+                f"{stats['p50_ms'] or '-':>8} {stats['p95_ms'] or '-':>8} {stats['p99_ms'] or '-':>8}")
+        old = (baseline or {}).get("endpoints", {}).get(name)
+        if old and old.get("p95_ms") and stats["p95_ms"]:
+            change = (stats["p95_ms"] - old["p95_ms"]) / old["p95_ms"] * 100
+            line += f"   p95 {change:+.1f}% vs {baseline.get('commit') or 'baseline'}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--base-url", default="http://localhost:5000")
+    parser.add_argument("--in-process", action="store_true", help="call the Flask app directly, no HTTP")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds to run")
+    parser.add_argument("--requests", type=int, default=0, help="stop after this many requests (0 = no limit)")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="endpoint weights, e.g. " + DEFAULT_MIX)
+    parser.add_argument("--users", type=int, default=1000, help="number of bench users to act as")
+    parser.add_argument("--products", type=int, default=500, help="number of products to order from")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write results JSON here")
+    parser.add_argument("--compare", help="baseline results JSON to diff against")
+    args = parser.parse_args()
+
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    result = run(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
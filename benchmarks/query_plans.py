@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""EXPLAIN every query the API issues and fail on full scans.
+
+Drives each endpoint once through the Flask test client against a seeded
+database (benchmarks/seed.py), records every statement via the pool's
+query listener, then runs EXPLAIN on each distinct SELECT, UPDATE and
+DELETE with the parameters it was actually issued with. Exits non-zero
+when a plan reads a whole table or index (type ALL or index) of at least
+--min-rows estimated rows, unless the query is listed in INTENTIONAL_SCANS.
+Filesorts and temporary tables are reported as warnings.
+
+Row estimates depend on data volume, so run it against a database seeded
+at realistic size, after `python migrate.py`:
+
+    python benchmarks/query_plans.py --min-rows 1000
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import uuid
+from urllib.parse import quote
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mysql.connector
+from dotenv import load_dotenv
+
+from catalog_query import IN_STOCK, PRODUCT_COLUMNS, SELLABLE_STOCK
+from seed import BENCH_PASSWORD
+
+# Queries that read everything on purpose: pattern -> why that is acceptable
+INTENTIONAL_SCANS = {
+    "^" + re.escape(f"SELECT {PRODUCT_COLUMNS} FROM products WHERE {IN_STOCK} ORDER BY id DESC") + "$":
+        "full catalog snapshot, built once and served from the catalog cache",
+    "^" + re.escape(f"SELECT {PRODUCT_COLUMNS} FROM products") + "$":
+        "search index rebuild, every SEARCH_REBUILD_INTERVAL seconds per worker",
+    "^" + re.escape(f"SELECT id, {SELLABLE_STOCK} AS stock FROM products ORDER BY id") + "$":
+        "admin stock export of every product",
+}
+
+EXPLAINABLE = ("SELECT", "UPDATE", "DELETE")
+
+
+def normalize(sql):
+    return re.sub(r"\s+", " ", sql).strip()
+
+
+def capture(statements):
+    def listener(statement, params, seconds):
+        sql = normalize(statement)
+        if sql.upper().startswith(EXPLAINABLE) and sql not in statements:
+            statements[sql] = params
+    return listener
+
+
+def load_fixtures(db):
+    cursor = db.cursor(dictionary=True)
+    cursor.execute("SELECT id, username FROM users WHERE username LIKE 'bench_user_%%' ORDER BY id LIMIT 1")
+    user = cursor.fetchone()
+    # A user with order history, so /orders and its items query run too
+    cursor.execute("SELECT user_id FROM orders ORDER BY id DESC LIMIT 1")
+    with_orders = cursor.fetchone()
+    cursor.execute("SELECT id, category FROM products WHERE stock > 10 ORDER BY id DESC LIMIT 3")
+    products = cursor.fetchall()
+    cursor.execute("SELECT COUNT(*) AS n FROM products")
+    product_count = cursor.fetchone()["n"]
+    cursor.close()
+    if not user or len(products) < 3:
+        sys.exit("No bench users or products found; run benchmarks/seed.py first")
+    return user, with_orders["user_id"] if with_orders else user["id"], products, product_count
+
+
+def drive(client, user, history_user_id, products):
+    """Issue one request per endpoint shape; returns the responses that failed."""
+    auth = {"Authorization": f"Bearer mock_token_{user['id']}"}
+    admin = {"X-Admin-Token": os.getenv('ADMIN_TOKEN', '')}
+    category = quote(products[0]["category"] or "")
+    product_id = products[0]["id"]
+    requests = [
+        ("POST", "/login", {"username": user["username"], "password": BENCH_PASSWORD}, {}),
+        ("GET", "/products", None, {}),
+        ("GET", "/products?stream=1", None, {}),
+        ("GET", "/products?limit=20", None, {}),
+        ("GET", f"/products?category={category}&limit=20", None, {}),
+        ("GET", f"/products?category={category}&sort=price_low&limit=20", None, {}),
+        ("GET", f"/products?category={category}&sort=name&limit=20", None, {}),
+        ("GET", "/products?sort=price_high&min_price=10&max_price=200&limit=20", None, {}),
+        ("GET", "/products?sort=name&limit=20", None, {}),
+        ("GET", f"/products/{product_id}", None, {}),
+        ("GET", "/products/search?q=bench", None, {}),
+        ("GET", "/orders?limit=20", None, {"Authorization": f"Bearer mock_token_{history_user_id}"}),
+        ("GET", "/orders?archived=1&limit=20", None, {"Authorization": f"Bearer mock_token_{history_user_id}"}),
+        ("GET", "/api/products/stock", None, admin),
+        ("GET", "/api/products/stock/low", None, admin),
+        ("GET", "/api/products/stock/movements?limit=50", None, admin),
+        ("GET", f"/api/products/stock/movements?product_id={product_id}&limit=50", None, admin),
+        ("PUT", f"/api/products/stock/{product_id}",
+         {"movement_type": "in", "quantity_change": 1, "reason": "query plan check"}, admin),
+        ("PUT", f"/api/products/stock/{product_id}",
+         {"movement_type": "out", "quantity_change": 1, "reason": "query plan check"}, admin),
+    ]
+
+    failures = []
+    for method, path, body, headers in requests:
+        response = client.open(path, method=method, json=body, headers=headers)
+        response.get_data()
+        if response.status_code >= 400:
+            failures.append(f"{method} {path}: {response.status_code}")
+
+    # Then follow each paginated endpoint onto its second page, which adds the cursor predicates
+    for path, headers in (("/products?sort=price_low&limit=20", {}), ("/products?limit=20", {}),
+                          ("/orders?limit=1", {"Authorization": f"Bearer mock_token_{history_user_id}"}),
+                          ("/api/products/stock/movements?limit=1", admin)):
+        response = client.get(path, headers=headers)
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor:
+            client.get(f"{path}&cursor={cursor}", headers=headers).get_data()
+
+    items = [{"product_id": product["id"], "quantity": 1} for product in products]
+    # Keyed, so the idempotency lookup and claim are explained too
+    response = client.post("/place_order", json={"user_id": user["id"], "items": items},
+                           headers=dict(auth, **{"Idempotency-Key": uuid.uuid4().hex}))
+    if response.status_code == 201:
+        order_id = response.get_json()["order_id"]
+        response = client.post(f"/orders/{order_id}/cancel", headers=auth)
+        if response.status_code != 200:
+            failures.append(f"POST /orders/{order_id}/cancel: {response.status_code}")
+    else:
+        failures.append(f"POST /place_order: {response.status_code}")
+    return failures
+
+
+def explain(db, sql, params):
+    cursor = db.cursor(dictionary=True)
+    try:
+        cursor.execute(f"EXPLAIN {sql}", params)
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+def intentional(sql):
+    for pattern, reason in INTENTIONAL_SCANS.items():
+        if re.match(pattern, sql):
+            return reason
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--min-rows", type=int, default=1000,
+                        help="flag full scans estimated to read at least this many rows")
+    parser.add_argument("--json", action="store_true", help="print every plan as JSON")
+    args = parser.parse_args()
+
+    load_dotenv()
+    import db_pool
+    from app import create_app
+
+    db = mysql.connector.connect(**db_pool.db_connect_args())
+    user, history_user_id, products, product_count = load_fixtures(db)
+    if product_count < args.min_rows:
+        print(f"warning: only {product_count} products; seed more rows or plans may not reflect production")
+
+    statements = {}
+    db_pool.add_query_listener(capture(statements))
+    app = create_app()
+    failures = drive(app.test_client(), user, history_user_id, products)
+    for failure in failures:
+        print(f"request failed: {failure}")
+
+    problems, warnings, report = [], [], []
+    for sql, params in statements.items():
+        plan = explain(db, sql, params)
+        report.append({"sql": sql, "plan": plan})
+        reason = intentional(sql)
+        for row in plan:
+            access, estimate, extra = row.get("type"), row.get("rows") or 0, row.get("Extra") or ""
+            if access in ("ALL", "index") and estimate >= args.min_rows:
+                if reason:
+                    print(f"allowed  {access:5} ~{estimate} rows on {row['table']} ({reason})\n         {sql}")
+                else:
+                    problems.append(f"{access:5} ~{estimate} rows on {row['table']}\n         {sql}")
+            if not reason and ("Using filesort" in extra or "Using temporary" in extra):
+                warnings.append(f"{extra} on {row['table']}\n         {sql}")
+    db.close()
+
+    if args.json:
+        print(json.dumps(report, indent=2, default=str))
+    for warning in warnings:
+        print(f"warning  {warning}")
+    for problem in problems:
+        print(f"FULLSCAN {problem}")
+    print(f"{len(statements)} distinct statements explained, {len(problems)} full scans, {len(warnings)} warnings")
+    sys.exit(1 if problems or failures else 0)
+
+
+if __name__ == "__main__":
+    main()
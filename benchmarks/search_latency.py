@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""Build the product search index over a synthetic catalog and time queries.
+
+No database needed: rows are generated in memory with the same columns
+as the products table.
+
+    python benchmarks/search_latency.py --products 100000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from product_search import SearchIndex
+
+ADJECTIVES = ["classic", "slim", "elegant", "casual", "summer", "leather", "designer", "wool", "vintage",
+              "oversized", "cropped", "linen", "silk", "denim", "cotton", "tailored", "knitted", "pleated"]
+NOUNS = ["shirt", "jeans", "dress", "t-shirt", "jacket", "handbag", "sunglasses", "coat", "sneakers",
+         "skirt", "hoodie", "blazer", "scarf", "boots", "cardigan", "chinos", "loafers", "beanie"]
+CATEGORIES = ["Men's", "Women's", "Accessories"]
+
+QUERIES = [
+    ("leather jacket", {}),
+    ("lether jaket", {}),
+    ("sli", {}),
+    ("silk dress", {"category": "Women's", "max_price": Decimal("100")}),
+    ("wool", {}),
+    ("vintage denim jeans", {"min_price": Decimal("50")}),
+    ("xyzzy", {}),
+]
+
+
+class RowsCursor:
+    # Just enough of a DB cursor for SearchIndex.refresh()
+    def __init__(self, rows):
+        self.rows = rows
+
+    def execute(self, sql, params=()):
+        pass
+
+    def fetchone(self):
+        return {"last_id": 0, "now": None}
+
+    def fetchall(self):
+        return self.rows
+
+
+def generate(count, rng):
+    rows = []
+    for product_id in range(1, count + 1):
+        rows.append({
+            "id": product_id,
+            "name": f"{rng.choice(ADJECTIVES)} {rng.choice(ADJECTIVES)} {rng.choice(NOUNS)} {rng.randint(1, 5000)}",
+            "description": " ".join(rng.choice(ADJECTIVES + NOUNS) for _ in range(12)),
+            "price": Decimal(rng.randint(500, 30000)) / 100,
+            "stock": rng.randint(0, 50),
+            "image": "",
+            "category": rng.choice(CATEGORIES),
+        })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--products", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rows = generate(args.products, random.Random(args.seed))
+    index = SearchIndex()
+    started = time.perf_counter()
+    index.refresh(RowsCursor(rows))
+    print(f"built index over {len(index)} products in {time.perf_counter() - started:.2f}s")
+
+    for query, filters in QUERIES:
+        timings = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            results = index.search(query, limit=args.limit, **filters)
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        print(f"{query!r:24} {len(results):3} hits  p50 {statistics.median(timings):6.2f} ms  "
+              f"p99 {timings[int(len(timings) * 0.99) - 1]:6.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""Seed a database with synthetic users, products and orders for load testing.
+
+Same as `python catalog_tool.py generate`. Rows are written with chunked
+multi-row INSERTs and committed per chunk, so millions of orders load in
+minutes and memory stays flat. Use a dedicated database: --truncate wipes
+every table first.
+
+    python benchmarks/seed.py --users 5000 --products 2000 --orders 1000000
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+
+# loadtest.py and query_plans.py import BENCH_PASSWORD from here
+from catalog_tool import BENCH_PASSWORD, add_generate_arguments, generate
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_generate_arguments(parser)
+    generate(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
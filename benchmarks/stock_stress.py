@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""Concurrency stress test for the stock reservation engine.
+
+Several ReservationEngine instances (standing in for gunicorn workers)
+share one in-memory products table and hammer a handful of hot SKUs from
+many threads. Some checkouts fail before commit, and some reservations are
+abandoned so they have to expire. At the end the first engine is killed
+without returning its escrow, another one reconciles it back, the rest
+are stopped, and the run fails unless stock never went negative and, for
+every product, initial stock == final stock + units sold.
+
+    python benchmarks/stock_stress.py --workers 4 --threads 64 --seconds 10
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from checkout import OutOfStock
+from stock_reservations import ReservationEngine
+
+
+class InMemoryStockTable:
+    """The products table and the stock_escrow table, with row locks modelled by one mutex."""
+
+    def __init__(self, stock, claim_latency):
+        self.stock = dict(stock)
+        self.lowest = min(stock.values())
+        self.claim_latency = claim_latency
+        self.escrow = {}
+        self.heartbeats = {}
+        self.lock = threading.Lock()
+
+
+class InMemoryStockStore:
+    # Same arithmetic as MySQLStockStore, one instance per engine like one owner per worker
+    def __init__(self, table, owner):
+        self.table = table
+        self.owner = owner
+
+    def claim(self, product_id, wanted, fair_share):
+        if self.table.claim_latency:
+            time.sleep(self.table.claim_latency)
+        table = self.table
+        with table.lock:
+            stock = table.stock[product_id]
+            if stock <= 0:
+                return 0
+            granted = min(stock, max(wanted, min(fair_share, stock // 4)))
+            table.stock[product_id] = stock - granted
+            table.lowest = min(table.lowest, table.stock[product_id])
+            key = (self.owner, product_id)
+            table.escrow[key] = table.escrow.get(key, 0) + granted
+            table.heartbeats[self.owner] = time.monotonic()
+            return granted
+
+    def consume(self, cursor, quantities):
+        # ``cursor`` is the order transaction's undo log, replayed if its commit fails
+        table = self.table
+        with table.lock:
+            if any(table.escrow.get((self.owner, pid), 0) < quantity for pid, quantity in quantities.items()):
+                return False
+            for pid, quantity in quantities.items():
+                table.escrow[(self.owner, pid)] -= quantity
+                cursor.append((self.owner, pid, quantity))
+            return True
+
+    def rollback(self, cursor):
+        with self.table.lock:
+            for owner, pid, quantity in cursor:
+                self.table.escrow[(owner, pid)] += quantity
+
+    def release(self, returns):
+        table = self.table
+        with table.lock:
+            for product_id, quantity in returns.items():
+                key = (self.owner, product_id)
+                returned = min(quantity, table.escrow.get(key, 0))
+                table.stock[product_id] += returned
+                table.escrow[key] = table.escrow.get(key, 0) - returned
+
+    def heartbeat(self):
+        table = self.table
+        with table.lock:
+            table.heartbeats[self.owner] = time.monotonic()
+            return {pid for (owner, pid) in table.escrow if owner == self.owner}
+
+    def reconcile(self, stale_after):
+        table = self.table
+        recovered = {}
+        with table.lock:
+            now = time.monotonic()
+            for (owner, pid), quantity in list(table.escrow.items()):
+                if owner != self.owner and now - table.heartbeats.get(owner, 0) >= stale_after:
+                    table.stock[pid] += quantity
+                    recovered[pid] = recovered.get(pid, 0) + quantity
+                    del table.escrow[(owner, pid)]
+        return recovered
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=4, help="engines sharing the store")
+    parser.add_argument("--threads", type=int, default=64)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--products", type=int, default=3, help="number of hot SKUs")
+    parser.add_argument("--stock", type=int, default=20000, help="initial units per SKU")
+    parser.add_argument("--chunk", type=int, default=50)
+    parser.add_argument("--claim-latency-ms", type=float, default=1.0, help="simulated DB round-trip per claim")
+    args = parser.parse_args()
+
+    initial = {pid: args.stock for pid in range(1, args.products + 1)}
+    table = InMemoryStockTable(initial, args.claim_latency_ms / 1000.0)
+    engines = [ReservationEngine(InMemoryStockStore(table, f"worker-{index}"), chunk_size=args.chunk, ttl=0.2,
+                                 idle_release=0.1, sweep_interval=0.05, heartbeat_interval=0.05, stale_after=60.0)
+               for index in range(args.workers)]
+
+    sold = {pid: 0 for pid in initial}
+    totals = {"placed": 0, "out_of_stock": 0, "failed_commit": 0, "abandoned": 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.seconds
+
+    def shopper(index):
+        rng = random.Random(index)
+        engine = engines[index % len(engines)]
+        local_sold = {pid: 0 for pid in initial}
+        local = dict.fromkeys(totals, 0)
+        while time.monotonic() < deadline:
+            cart = {pid: rng.randint(1, 3) for pid in rng.sample(sorted(initial), rng.randint(1, len(initial)))}
+            try:
+                reservation = engine.reserve(cart)
+            except OutOfStock:
+                local["out_of_stock"] += 1
+                continue
+            roll = rng.random()
+            if roll < 0.02:
+                # Client vanished: leave it for the expiry sweep
+                local["abandoned"] += 1
+                continue
+            if roll < 0.07:
+                undo = []
+
+                def failing_commit():
+                    engine.store.rollback(undo)
+                    raise RuntimeError("simulated deadlock")
+                try:
+                    engine.commit(reservation, undo, failing_commit)
+                except RuntimeError:
+                    local["failed_commit"] += 1
+                engine.cancel(reservation)
+                continue
+            try:
+                engine.commit(reservation, [], lambda: None)
+            except OutOfStock:
+                local["out_of_stock"] += 1
+                continue
+            local["placed"] += 1
+            for pid, quantity in cart.items():
+                local_sold[pid] += quantity
+        with lock:
+            for pid in sold:
+                sold[pid] += local_sold[pid]
+            for key in totals:
+                totals[key] += local[key]
+
+    for engine in engines:
+        engine.start()
+    started = time.monotonic()
+    threads = [threading.Thread(target=shopper, args=(i,)) for i in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    # Kill the first worker: its sweeper stops and nothing it holds goes back to the table
+    engines[0]._stopped.set()
+    time.sleep(0.3)
+    held = sum(quantity for (owner, _), quantity in table.escrow.items() if owner == "worker-0")
+    table.heartbeats["worker-0"] = float("-inf")
+    recovered = sum(engines[-1].reconcile().values()) if len(engines) > 1 else 0
+    print(f"killed worker-0 holding {held} escrowed units, {recovered} reconciled back")
+    for engine in engines[1:]:
+        engine.stop()
+    if len(engines) == 1:
+        engines[0].stop()
+
+    print(f"{totals['placed']} checkouts in {elapsed:.1f}s ({totals['placed'] / elapsed:.0f}/s), "
+          f"{totals['out_of_stock']} out of stock, {totals['failed_commit']} failed commits, "
+          f"{totals['abandoned']} abandoned")
+    print(f"claims: {sum(e.stats['claims'] for e in engines)}, expired: {sum(e.stats['expired'] for e in engines)}")
+
+    ok = table.lowest >= 0
+    for pid, units in initial.items():
+        balance = table.stock[pid] + sold[pid]
+        status = "ok" if balance == units else "MISMATCH"
+        ok = ok and balance == units
+        print(f"product {pid}: initial {units} = remaining {table.stock[pid]} + sold {sold[pid]} [{status}]")
+    print(f"lowest stock observed: {table.lowest}")
+    if not ok:
+        sys.exit("stock invariant violated")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,533 @@
+# -*- coding: utf-8 -*-
+import atexit
+import collections
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from decimal import Decimal
+
+import push_events
+from batch_writer import BatchWriter
+from db_pool import get_pool
+
+logger = logging.getLogger(__name__)
+
+ALERT_LOCK_NAME = "ecommerce_cart_alerts"
+
+
+class InvalidCartItem(ValueError):
+    pass
+
+
+class CartOutOfStock(InvalidCartItem):
+    pass
+
+
+class CartLine:
+    __slots__ = ("quantity", "price", "added_at")
+
+    def __init__(self, quantity, price, added_at):
+        self.quantity = quantity
+        # Price when the product went into the cart; the alert job compares against it
+        self.price = price
+        self.added_at = added_at
+
+
+class Cart:
+    __slots__ = ("user_id", "lines", "version", "updated_at", "dirty", "loaded_at")
+
+    def __init__(self, user_id, lines=None, version=0, updated_at=None):
+        self.user_id = user_id
+        self.lines = lines or {}
+        self.version = version
+        self.updated_at = updated_at
+        self.dirty = False
+        self.loaded_at = time.monotonic()
+
+    def items(self):
+        return [{"product_id": product_id, "quantity": line.quantity}
+                for product_id, line in sorted(self.lines.items())]
+
+
+def _placeholders(values):
+    return ", ".join(["%s"] * len(values))
+
+
+def load_cart(cursor, user_id):
+    cursor.execute("SELECT version, updated_at FROM carts WHERE user_id = %s", (user_id,))
+    row = cursor.fetchone()
+    if row is None:
+        return Cart(user_id)
+    cursor.execute("""
+        SELECT product_id, quantity, price_seen, added_at FROM cart_items
+        WHERE user_id = %s
+    """, (user_id,))
+    lines = {item["product_id"]: CartLine(item["quantity"], item["price_seen"], item["added_at"])
+             for item in cursor.fetchall()}
+    return Cart(user_id, lines, row["version"], row["updated_at"])
+
+
+def write_carts(cursor, snapshots):
+    """Write {user_id: (version, updated_at, lines)} in the open transaction; returns the users skipped.
+
+    A user is skipped when the table already holds a newer version of
+    their cart, written by another worker. Existing lines keep their
+    price_seen, which the alert job lowers after a price drop.
+    """
+    user_ids = sorted(snapshots)
+    cursor.execute(f"SELECT user_id, version FROM carts WHERE user_id IN ({_placeholders(user_ids)}) FOR UPDATE",
+                   user_ids)
+    skipped = {user_id for user_id, version in cursor.fetchall() if version >= snapshots[user_id][0]}
+    writable = [user_id for user_id in user_ids if user_id not in skipped]
+    if not writable:
+        return skipped
+
+    cart_params = []
+    for user_id in writable:
+        version, updated_at, _ = snapshots[user_id]
+        cart_params.extend([user_id, version, updated_at])
+    cursor.execute(f"""
+        INSERT INTO carts (user_id, version, updated_at)
+        VALUES {", ".join(["(%s, %s, %s)"] * len(writable))}
+        ON DUPLICATE KEY UPDATE version = VALUES(version), updated_at = VALUES(updated_at), reminded_at = NULL
+    """, cart_params)
+
+    keep, line_params = [], []
+    for user_id in writable:
+        for product_id, quantity, price, added_at in snapshots[user_id][2]:
+            keep.append((user_id, product_id))
+            line_params.extend([user_id, product_id, quantity, price, added_at])
+    where = f"user_id IN ({_placeholders(writable)})"
+    delete_params = list(writable)
+    if keep:
+        where += f" AND (user_id, product_id) NOT IN ({', '.join(['(%s, %s)'] * len(keep))})"
+        delete_params.extend(value for pair in keep for value in pair)
+    cursor.execute(f"DELETE FROM cart_items WHERE {where}", delete_params)
+    if keep:
+        cursor.execute(f"""
+            INSERT INTO cart_items (user_id, product_id, quantity, price_seen, added_at)
+            VALUES {", ".join(["(%s, %s, %s, %s, %s)"] * len(keep))}
+            ON DUPLICATE KEY UPDATE quantity = VALUES(quantity)
+        """, line_params)
+    return skipped
+
+
+class CartStore:
+    """Process-local carts, written to MySQL behind the requests that change them.
+
+    Mutations change the in-memory cart and mark it dirty. The first
+    change to a clean cart queues its user on a BatchWriter, so any number
+    of clicks before the next flush become one write of the cart's latest
+    state. Flushes happen every ``flush_interval`` seconds, for up to
+    ``max_batch`` carts per transaction.
+
+    Every change stamps the cart with a new version, a microsecond
+    timestamp. The caller hands the version back to the client, which
+    returns it with its next request. If another worker served the last
+    change, this worker's copy is older than that version, so it reloads
+    the cart from MySQL. It waits up to ``stale_wait`` seconds for the
+    other worker's flush to land. Clean copies are also reloaded after
+    ``ttl`` seconds. When two workers changed the same cart, the newer
+    version wins. Unflushed changes are lost if the worker dies.
+    """
+
+    def __init__(self, max_entries=50000, ttl=30.0, stale_wait=2.0, max_quantity=99,
+                 flush_interval=1.0, max_batch=200):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stale_wait = stale_wait
+        self.max_quantity = max_quantity
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._carts = collections.OrderedDict()
+        self._queued = set()
+        self.writer = BatchWriter(self._flush, "cart-writer", max_batch=max_batch, interval=flush_interval)
+        self.stats = {"loads": 0, "stale_loads": 0, "conflicts": 0, "mutations": 0}
+
+    def _load(self, user_id, min_version):
+        deadline = time.monotonic() + self.stale_wait
+        db = get_pool().acquire()
+        cursor = db.cursor(dictionary=True)
+        try:
+            while True:
+                cart = load_cart(cursor, user_id)
+                db.rollback()
+                # Not there yet: the worker that served the last change has not flushed it
+                if cart.version >= min_version or time.monotonic() >= deadline:
+                    break
+                time.sleep(0.05)
+        finally:
+            cursor.close()
+            db.close()
+        with self._lock:
+            self.stats["loads"] += 1
+            if cart.version < min_version:
+                self.stats["stale_loads"] += 1
+        return cart
+
+    def _current(self, cart, min_version):
+        # Called with the lock held: a cached copy that can be served without reloading
+        return cart is not None and cart.version >= min_version and (
+            cart.dirty or time.monotonic() - cart.loaded_at < self.ttl)
+
+    def get(self, user_id, min_version=0):
+        with self._lock:
+            cart = self._carts.get(user_id)
+            if self._current(cart, min_version):
+                self._carts.move_to_end(user_id)
+                return cart
+        loaded = self._load(user_id, min_version)
+        with self._lock:
+            cart = self._carts.get(user_id)
+            # Unflushed local changes newer than what was stored stay; anything else is replaced
+            if cart is None or not cart.dirty or cart.version < loaded.version:
+                cart = self._carts[user_id] = loaded
+            cart.loaded_at = time.monotonic()
+            self._carts.move_to_end(user_id)
+            self._evict()
+            return cart
+
+    def _evict(self):
+        # Oldest clean carts first; dirty ones stay until they are flushed
+        excess = len(self._carts) - self.max_entries
+        if excess <= 0:
+            return
+        for user_id in [user_id for user_id, cart in self._carts.items() if not cart.dirty][:excess]:
+            del self._carts[user_id]
+
+    def _changed(self, cart):
+        # Called with the lock held
+        cart.version = max(cart.version + 1, time.time_ns() // 1000)
+        cart.updated_at = datetime.now()
+        cart.dirty = True
+        self.stats["mutations"] += 1
+        if cart.user_id not in self._queued:
+            self._queued.add(cart.user_id)
+            return True
+        return False
+
+    def _queue(self, user_id):
+        if not self.writer.add(user_id):
+            # Buffer full: leave the cart dirty so its next change queues it again
+            with self._lock:
+                self._queued.discard(user_id)
+
+    def _mutate(self, user_id, min_version, change):
+        # ``change`` returns whether it changed the cart; one that didn't keeps its version and isn't written
+        cart = self.get(user_id, min_version)
+        with self._lock:
+            # Evicted or replaced since get() returned: change whatever copy is current
+            cart = self._carts.setdefault(user_id, cart)
+            queue = change(cart) and self._changed(cart)
+            version, lines = cart.version, dict(cart.lines)
+        if queue:
+            self._queue(user_id)
+        return version, lines
+
+    def view(self, user_id, min_version=0):
+        """(version, {product_id: CartLine}) for reading outside the lock."""
+        cart = self.get(user_id, min_version)
+        with self._lock:
+            return cart.version, dict(cart.lines)
+
+    def items(self, user_id, min_version=0):
+        cart = self.get(user_id, min_version)
+        with self._lock:
+            return cart.items()
+
+    def _check_quantity(self, quantity):
+        if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity < 0:
+            raise InvalidCartItem("quantity must be a non-negative integer")
+        if quantity > self.max_quantity:
+            raise InvalidCartItem(f"At most {self.max_quantity} of one product per cart")
+
+    def add(self, user_id, product, quantity=1, min_version=0):
+        """Add ``quantity`` of ``product`` (a catalog row with id, price and stock)."""
+        self._check_quantity(quantity)
+        if quantity == 0:
+            raise InvalidCartItem("quantity must be positive")
+
+        def change(cart):
+            line = cart.lines.get(product["id"])
+            total = quantity + (line.quantity if line else 0)
+            self._check_quantity(total)
+            if total > product["stock"]:
+                raise CartOutOfStock(f"Only {product['stock']} of product {product['id']} in stock")
+            if line is None:
+                cart.lines[product["id"]] = CartLine(total, Decimal(str(product["price"])), datetime.now())
+            else:
+                line.quantity = total
+            return True
+        return self._mutate(user_id, min_version, change)
+
+    def set_quantity(self, user_id, product, quantity, min_version=0):
+        """Set the line for ``product`` to ``quantity``; 0 removes it."""
+        self._check_quantity(quantity)
+        if quantity == 0:
+            return self.remove(user_id, product["id"], min_version)
+        if quantity > product["stock"]:
+            raise CartOutOfStock(f"Only {product['stock']} of product {product['id']} in stock")
+
+        def change(cart):
+            line = cart.lines.get(product["id"])
+            if line is None:
+                cart.lines[product["id"]] = CartLine(quantity, Decimal(str(product["price"])), datetime.now())
+            elif line.quantity == quantity:
+                return False
+            else:
+                line.quantity = quantity
+            return True
+        return self._mutate(user_id, min_version, change)
+
+    def replace(self, user_id, lines, min_version=0):
+        """Make the cart hold exactly ``lines``, [(product, quantity)]; lines kept keep their price_seen."""
+        wanted = {}
+        for product, quantity in lines:
+            self._check_quantity(quantity)
+            if quantity == 0:
+                raise InvalidCartItem("quantity must be positive")
+            if quantity > product["stock"]:
+                raise CartOutOfStock(f"Only {product['stock']} of product {product['id']} in stock")
+            wanted[product["id"]] = (product, quantity)
+
+        def change(cart):
+            changed = False
+            for product_id in [product_id for product_id in cart.lines if product_id not in wanted]:
+                del cart.lines[product_id]
+                changed = True
+            for product_id, (product, quantity) in wanted.items():
+                line = cart.lines.get(product_id)
+                if line is None:
+                    cart.lines[product_id] = CartLine(quantity, Decimal(str(product["price"])), datetime.now())
+                elif line.quantity != quantity:
+                    line.quantity = quantity
+                else:
+                    continue
+                changed = True
+            return changed
+        return self._mutate(user_id, min_version, change)
+
+    def remove(self, user_id, product_id, min_version=0):
+        return self._mutate(user_id, min_version, lambda cart: cart.lines.pop(product_id, None) is not None)
+
+    def checked_out(self, user_id, quantities):
+        """Take the units of a placed order ({product_id: quantity}) out of the cached cart.
+
+        Runs after every order while the request still holds its
+        connection, so it never loads a cart: one this worker has not
+        cached, or whose copy is due a reload, is left alone. Nothing is
+        queued for writing unless a line actually changes.
+        """
+        with self._lock:
+            cart = self._carts.get(user_id)
+            if not self._current(cart, 0):
+                return False
+            changed = False
+            for product_id, quantity in quantities.items():
+                line = cart.lines.get(product_id)
+                if line is None:
+                    continue
+                if line.quantity <= quantity:
+                    del cart.lines[product_id]
+                else:
+                    line.quantity -= quantity
+                changed = True
+            queue = changed and self._changed(cart)
+        if queue:
+            self._queue(user_id)
+        return changed
+
+    def _flush(self, user_ids):
+        with self._lock:
+            snapshots = {}
+            for user_id in set(user_ids):
+                self._queued.discard(user_id)
+                cart = self._carts.get(user_id)
+                if cart is not None and cart.dirty:
+                    snapshots[user_id] = (cart.version, cart.updated_at, [
+                        (product_id, line.quantity, line.price, line.added_at)
+                        for product_id, line in sorted(cart.lines.items())
+                    ])
+        if not snapshots:
+            return
+
+        db = get_pool().acquire()
+        cursor = db.cursor()
+        try:
+            skipped = write_carts(cursor, snapshots)
+            db.commit()
+        except Exception:
+            db.rollback()
+            # Still dirty: the BatchWriter retries this batch, and a later change requeues it after that
+            raise
+        finally:
+            cursor.close()
+            db.close()
+
+        with self._lock:
+            for user_id, (version, _, _) in snapshots.items():
+                cart = self._carts.get(user_id)
+                if cart is None or cart.version != version:
+                    continue
+                if user_id in skipped:
+                    # Another worker stored a newer cart; drop ours so the next read loads that one
+                    del self._carts[user_id]
+                    self.stats["conflicts"] += 1
+                else:
+                    cart.dirty = False
+
+    def info(self):
+        with self._lock:
+            dirty = sum(1 for cart in self._carts.values() if cart.dirty)
+            return dict(self.stats, carts=len(self._carts), dirty=dirty, **self.writer.stats)
+
+
+def scan_carts(cursor, abandon_after):
+    """One set-based pass over every saved cart; returns the events to publish once it commits.
+
+    A single join finds both the lines of carts untouched for
+    ``abandon_after`` seconds and not yet reminded, and the lines whose
+    product now costs less than when it was added. Two updates then mark
+    them in the same transaction, so no cart is reported twice.
+    """
+    cursor.execute("""
+        SELECT c.user_id, ci.product_id, ci.quantity, ci.price_seen, p.name, p.price,
+               (c.reminded_at IS NULL AND c.updated_at < NOW() - INTERVAL %s SECOND) AS abandoned
+        FROM carts c
+        JOIN cart_items ci ON ci.user_id = c.user_id
+        JOIN products p ON p.id = ci.product_id
+        WHERE (c.reminded_at IS NULL AND c.updated_at < NOW() - INTERVAL %s SECOND)
+           OR p.price < ci.price_seen
+    """, (int(abandon_after), int(abandon_after)))
+    reminders, drops = {}, []
+    for row in cursor.fetchall():
+        if row["abandoned"]:
+            cart = reminders.setdefault(row["user_id"], {"itemCount": 0, "total": Decimal("0")})
+            cart["itemCount"] += row["quantity"]
+            cart["total"] += row["price"] * row["quantity"]
+        if row["price"] < row["price_seen"]:
+            drops.append(row)
+
+    events = [(f"user:{user_id}", "CART_REMINDER", {"itemCount": cart["itemCount"], "total": float(cart["total"])})
+              for user_id, cart in reminders.items()]
+    events.extend((f"user:{row['user_id']}", "PRICE_DROP", {
+        "productId": row["product_id"],
+        "productName": row["name"],
+        "oldPrice": float(row["price_seen"]),
+        "newPrice": float(row["price"]),
+    }) for row in drops)
+
+    if reminders:
+        user_ids = sorted(reminders)
+        cursor.execute(f"UPDATE carts SET reminded_at = NOW() WHERE user_id IN ({_placeholders(user_ids)})",
+                       user_ids)
+    if drops:
+        pairs = [(row["user_id"], row["product_id"]) for row in drops]
+        cursor.execute(f"""
+            UPDATE cart_items ci JOIN products p ON p.id = ci.product_id
+            SET ci.price_seen = p.price
+            WHERE (ci.user_id, ci.product_id) IN ({", ".join(["(%s, %s)"] * len(pairs))})
+              AND p.price < ci.price_seen
+        """, [value for pair in pairs for value in pair])
+    return events
+
+
+class CartAlertJob:
+    """Runs scan_carts() every ``interval`` seconds in one worker at a time.
+
+    Every worker runs the loop, but a pass only goes ahead in the worker
+    that gets the MySQL named lock, so each alert is published once.
+    """
+
+    def __init__(self, interval=300.0, abandon_after=3600.0):
+        self.interval = interval
+        self.abandon_after = abandon_after
+        self.pid = os.getpid()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stop = threading.Event()
+        self.stats = {"passes": 0, "reminders": 0, "price_drops": 0, "failures": 0}
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="cart-alerts", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                self.stats["failures"] += 1
+                logger.warning("Cart alert pass failed: %s", e)
+
+    def run_once(self):
+        db = get_pool().acquire()
+        cursor = db.cursor(dictionary=True)
+        try:
+            cursor.execute("SELECT GET_LOCK(%s, 0) AS locked", (ALERT_LOCK_NAME,))
+            if cursor.fetchone()["locked"] != 1:
+                return False
+            try:
+                events = scan_carts(cursor, self.abandon_after)
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+            finally:
+                cursor.execute("SELECT RELEASE_LOCK(%s)", (ALERT_LOCK_NAME,))
+                cursor.fetchall()
+            for topic, event_type, payload in events:
+                push_events.publish(topic, event_type, payload)
+            reminders = sum(1 for _, event_type, _ in events if event_type == "CART_REMINDER")
+            self.stats["passes"] += 1
+            self.stats["reminders"] += reminders
+            self.stats["price_drops"] += len(events) - reminders
+            if events:
+                logger.info("Cart alerts: %s reminders, %s price drops", reminders, len(events) - reminders)
+            return True
+        finally:
+            cursor.close()
+            db.close()
+
+
+_store = None
+_alerts = None
+_store_lock = threading.Lock()
+
+
+def get_cart_store():
+    global _store
+    with _store_lock:
+        if _store is None or _store.pid != os.getpid():
+            _store = CartStore(
+                max_entries=int(os.getenv('CART_CACHE_SIZE', '50000')),
+                ttl=float(os.getenv('CART_CACHE_TTL', '30')),
+                stale_wait=float(os.getenv('CART_STALE_WAIT', '2')),
+                max_quantity=int(os.getenv('CART_MAX_QUANTITY', '99')),
+                flush_interval=float(os.getenv('CART_FLUSH_INTERVAL', '1')),
+                max_batch=int(os.getenv('CART_FLUSH_BATCH', '200')),
+            )
+            atexit.register(_store.writer.stop)
+        return _store
+
+
+def get_cart_alerts():
+    """This worker's alert job, or None when push notifications are off."""
+    global _alerts
+    if os.getenv('PUSH_ENABLED', 'false').lower() != 'true':
+        return None
+    with _store_lock:
+        if _alerts is None or _alerts.pid != os.getpid():
+            _alerts = CartAlertJob(
+                interval=float(os.getenv('CART_ALERT_INTERVAL', '300')),
+                abandon_after=float(os.getenv('CART_ABANDON_AFTER', '3600')),
+            )
+        return _alerts
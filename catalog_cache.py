@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+import collections
+import hashlib
+import os
+import threading
+import time
+
+
+class CatalogSnapshot:
+    def __init__(self, version, body, built_at):
+        self.version = version
+        self.body = body
+        self.built_at = built_at
+        # Strong validator: derived from the exact bytes we send
+        self.etag = hashlib.sha1(body).hexdigest()
+        # Compressed copies of body by content encoding, filled on first use
+        self.encoded = {}
+
+
+class CatalogCache:
+    """Process-local copy of the serialized /products response.
+
+    The snapshot is rebuilt when the version counter moves (bump() is called
+    after every committed stock change) or when it is older than ``ttl``
+    seconds, which catches edits made outside the app.
+    """
+
+    def __init__(self, ttl=30.0):
+        self.ttl = ttl
+        self._version = 0
+        self._snapshot = None
+        self._version_lock = threading.Lock()
+        self._build_lock = threading.Lock()
+
+    @property
+    def version(self):
+        return self._version
+
+    def bump(self):
+        with self._version_lock:
+            self._version += 1
+
+    def _is_fresh(self, snapshot):
+        return (snapshot is not None
+                and snapshot.version == self._version
+                and time.monotonic() - snapshot.built_at < self.ttl)
+
+    def get(self, loader):
+        snapshot = self._snapshot
+        if self._is_fresh(snapshot):
+            return snapshot
+
+        # Only one thread rebuilds; the rest wait and reuse its result
+        with self._build_lock:
+            snapshot = self._snapshot
+            if self._is_fresh(snapshot):
+                return snapshot
+            # Read the version before loading so a concurrent bump() forces another rebuild
+            version = self._version
+            snapshot = CatalogSnapshot(version, loader(), time.monotonic())
+            self._snapshot = snapshot
+            return snapshot
+
+
+class _Flight:
+    __slots__ = ("done", "entry", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.entry = None
+        self.error = None
+
+
+class ProductCache:
+    """Bounded LRU of serialized /products/<id> responses with a TTL.
+
+    Entries hold the response bytes (or None for a missing product) and
+    their ETag. Concurrent misses for the same id are coalesced: one
+    thread runs the loader and the others wait for its result, so a burst
+    on a trending product costs one query. invalidate() drops an entry
+    after a committed change. A load that was already running when its
+    id was invalidated is returned to its waiters but not cached.
+    """
+
+    def __init__(self, max_entries=1000, ttl=10.0, wait_timeout=5.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.wait_timeout = wait_timeout
+        self._entries = collections.OrderedDict()
+        self._inflight = {}
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "invalidations": 0, "evictions": 0}
+
+    def get(self, product_id, loader):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(product_id)
+            if entry is not None and entry.built_at + self.ttl > now:
+                self._entries.move_to_end(product_id)
+                self.stats["hits"] += 1
+                return entry
+            flight = self._inflight.get(product_id)
+            if flight is not None:
+                self.stats["coalesced"] += 1
+                leader = False
+            else:
+                flight = self._inflight[product_id] = _Flight()
+                self.stats["misses"] += 1
+                leader = True
+            generation = self._generations.get(product_id, 0)
+
+        if not leader:
+            if not flight.done.wait(self.wait_timeout):
+                raise TimeoutError(f"Timed out waiting for product {product_id} to load")
+            if flight.error is not None:
+                raise flight.error
+            return flight.entry
+
+        try:
+            body = loader(product_id)
+            flight.entry = CatalogSnapshot(generation, body, time.monotonic()) if body is not None \
+                else _MissingProduct(generation)
+            with self._lock:
+                if self._generations.get(product_id, 0) == generation:
+                    self._entries[product_id] = flight.entry
+                    self._entries.move_to_end(product_id)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+                        self.stats["evictions"] += 1
+            return flight.entry
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(product_id, None)
+            flight.done.set()
+
+    def invalidate(self, product_ids):
+        with self._lock:
+            for product_id in product_ids:
+                self._entries.pop(product_id, None)
+                self._generations[product_id] = self._generations.get(product_id, 0) + 1
+            self.stats["invalidations"] += len(product_ids)
+
+    def info(self):
+        with self._lock:
+            return dict(self.stats, size=len(self._entries), inflight=len(self._inflight))
+
+
+class _MissingProduct:
+    # Cached 404, so repeated lookups of a deleted id don't reach the database either
+    __slots__ = ("version", "body", "built_at", "etag")
+
+    def __init__(self, version):
+        self.version = version
+        self.body = None
+        self.etag = None
+        self.built_at = time.monotonic()
+
+
+catalog_cache = CatalogCache(ttl=float(os.getenv('CATALOG_CACHE_TTL', '30')))
+product_cache = ProductCache(max_entries=int(os.getenv('PRODUCT_CACHE_SIZE', '1000')),
+                             ttl=float(os.getenv('PRODUCT_CACHE_TTL', '10')))
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import base64
+import json
+import os
+from decimal import Decimal, InvalidOperation
+
+MAX_PAGE_SIZE = int(os.getenv('PRODUCTS_MAX_PAGE_SIZE', '200'))
+
+# sort key -> (column, direction); id is always the tie-breaker in the same direction
+SORTS = {
+    "newest": ("id", "DESC"),
+    "price_low": ("price", "ASC"),
+    "price_high": ("price", "DESC"),
+    "name": ("name", "ASC"),
+}
+SORT_ALIASES = {"price": "price_low", "price_asc": "price_low", "price_desc": "price_high"}
+
+# Units a product has for sale. With STOCK_RESERVATIONS on, workers move units out of products.stock
+# into stock_escrow ahead of checkouts (see stock_reservations.py); those are still for sale.
+ESCROWED_STOCK = "(SELECT COALESCE(SUM(e.quantity), 0) FROM stock_escrow e WHERE e.product_id = products.id)"
+SELLABLE_STOCK = f"(products.stock + {ESCROWED_STOCK})"
+# SELLABLE_STOCK > 0 without the sum: the stock column never goes negative
+IN_STOCK = ("(products.stock > 0 OR EXISTS "
+            "(SELECT 1 FROM stock_escrow e WHERE e.product_id = products.id AND e.quantity > 0))")
+
+PRODUCT_COLUMNS = f"id, name, description, price, {SELLABLE_STOCK} AS stock, image, category"
+
+
+class InvalidQuery(ValueError):
+    pass
+
+
+def parse_price(value, name):
+    if value in (None, ""):
+        return None
+    try:
+        price = Decimal(value)
+    except InvalidOperation:
+        raise InvalidQuery(f"{name} must be a number")
+    # Decimal accepts NaN and Infinity, which cannot be compared or bound as a price
+    if not price.is_finite():
+        raise InvalidQuery(f"{name} must be a number")
+    if price < 0:
+        raise InvalidQuery(f"{name} must not be negative")
+    return price
+
+
+def encode_cursor(sort, row):
+    column = SORTS[sort][0]
+    value = row[column]
+    if isinstance(value, Decimal):
+        value = str(value)
+    raw = json.dumps([sort, value, row["id"]], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor, sort):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_sort, value, last_id = json.loads(raw)
+        last_id = int(last_id)
+    except (ValueError, TypeError):
+        raise InvalidQuery("Invalid cursor")
+    if cursor_sort != sort:
+        raise InvalidQuery("Cursor does not match the requested sort")
+    column = SORTS[sort][0]
+    if column == "price":
+        value = parse_price(value, "cursor")
+    elif column == "name":
+        if not isinstance(value, str):
+            raise InvalidQuery("Invalid cursor")
+    elif not isinstance(value, int) or isinstance(value, bool):
+        raise InvalidQuery("Invalid cursor")
+    return value, last_id
+
+
+def parse_product_filters(args):
+    """Turn /products query arguments into a filter dict, or None for the full catalog."""
+    known = ("category", "min_price", "max_price", "sort", "limit", "cursor")
+    if not any(args.get(key) for key in known):
+        return None
+
+    sort = args.get("sort") or "newest"
+    sort = SORT_ALIASES.get(sort, sort)
+    if sort not in SORTS:
+        raise InvalidQuery(f"Unsupported sort: {sort}")
+
+    try:
+        limit = int(args.get("limit") or MAX_PAGE_SIZE)
+    except ValueError:
+        raise InvalidQuery("limit must be an integer")
+    if limit < 1:
+        raise InvalidQuery("limit must be positive")
+
+    filters = {
+        "category": args.get("category") or None,
+        "min_price": parse_price(args.get("min_price"), "min_price"),
+        "max_price": parse_price(args.get("max_price"), "max_price"),
+        "sort": sort,
+        "limit": min(limit, MAX_PAGE_SIZE),
+        "after": None,
+    }
+    if args.get("cursor"):
+        filters["after"] = decode_cursor(args["cursor"], sort)
+    return filters
+
+
+def build_products_query(filters):
+    column, direction = SORTS[filters["sort"]]
+    where = [IN_STOCK]
+    params = []
+
+    if filters["category"]:
+        where.append("category = %s")
+        params.append(filters["category"])
+    if filters["min_price"] is not None:
+        where.append("price >= %s")
+        params.append(filters["min_price"])
+    if filters["max_price"] is not None:
+        where.append("price <= %s")
+        params.append(filters["max_price"])
+
+    if filters["after"] is not None:
+        value, last_id = filters["after"]
+        op = ">" if direction == "ASC" else "<"
+        if column == "id":
+            where.append(f"id {op} %s")
+            params.append(last_id)
+        else:
+            # Expanded row comparison so MySQL can seek on the (column, id) index
+            where.append(f"({column} {op} %s OR ({column} = %s AND id {op} %s))")
+            params.extend([value, value, last_id])
+
+    order_by = "id DESC" if column == "id" else f"{column} {direction}, id {direction}"
+    # Fetch one extra row to learn whether another page exists
+    sql = (f"SELECT {PRODUCT_COLUMNS} FROM products WHERE {' AND '.join(where)} "
+           f"ORDER BY {order_by} LIMIT %s")
+    params.append(filters["limit"] + 1)
+    return sql, params
@@ -0,0 +1,482 @@
+# -*- coding: utf-8 -*-
+"""Bulk catalog import/export and synthetic data generation.
+
+    python catalog_tool.py export --output catalog.csv
+    python catalog_tool.py import supplier_feed.ndjson --upsert --resume
+    python catalog_tool.py generate --users 5000 --products 200000 --orders 1000000
+
+Files are CSV (with a header row) or NDJSON, picked by extension or
+--format, and are read and written as streams: memory stays flat however
+large the file is. Columns are sku, name, description, price, stock,
+image and category; export also writes id.
+
+import validates every row and writes rejects, with their line number and
+reason, to <file>.rejects.ndjson. Valid rows are written --chunk at a
+time: as multi-row INSERTs, or with --load-data as LOAD DATA LOCAL INFILE
+batches through a staging table. Each chunk is its own transaction. After
+every commit the number of rows consumed is saved to <file>.checkpoint, so
+--resume continues after the last committed chunk. --upsert updates the
+product with the same sku instead of adding a duplicate. Stock counts
+units the app's reservation engines hold (STOCK_RESERVATIONS), both ways;
+an upsert lowering stock below what they hold only takes effect as they
+release it, so run stock-lowering imports with the app stopped or idle.
+
+generate fills a database with users, products and orders for
+performance testing (see benchmarks/README.md). Users get real bcrypt
+hashes of one shared password at the configured cost; --unique-salts
+hashes every user separately.
+"""
+import argparse
+import csv
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+
+import bcrypt
+import mysql.connector
+import orjson
+from dotenv import load_dotenv
+
+from catalog_query import ESCROWED_STOCK, SELLABLE_STOCK
+from db_pool import db_connect_args
+
+PRODUCT_FIELDS = ("sku", "name", "description", "price", "stock", "image", "category")
+# column -> max length, from database_schema.sql
+MAX_LENGTHS = {"sku": 64, "name": 255, "image": 500, "category": 50}
+MAX_PRICE = Decimal("99999999.99")
+
+BENCH_PASSWORD = "Password123"
+CATEGORIES = ["Men's", "Women's", "Accessories", "Kids", "Shoes"]
+STATUSES = ["pending"] * 6 + ["completed"] * 3 + ["cancelled"]
+
+
+class InvalidRow(ValueError):
+    pass
+
+
+def detect_format(path, explicit):
+    if explicit:
+        return explicit
+    if path.endswith((".ndjson", ".jsonl")):
+        return "ndjson"
+    if path.endswith(".csv"):
+        return "csv"
+    sys.exit(f"Cannot tell the format of {path}; pass --format csv or --format ndjson")
+
+
+def read_rows(f, fmt):
+    """Yield (line number, raw dict) pairs from an open file."""
+    if fmt == "csv":
+        reader = csv.DictReader(f)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_num, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield line_num, InvalidRow(f"invalid JSON: {e}")
+            continue
+        yield line_num, row if isinstance(row, dict) else InvalidRow("expected a JSON object")
+
+
+def _text(row, field, required=False):
+    value = row.get(field)
+    if value is None or (isinstance(value, str) and not value.strip()):
+        if required:
+            raise InvalidRow(f"{field} is required")
+        return None
+    value = str(value).strip()
+    limit = MAX_LENGTHS.get(field)
+    if limit and len(value) > limit:
+        raise InvalidRow(f"{field} is longer than {limit} characters")
+    return value
+
+
+def validate(row, require_sku):
+    """Return the row as a tuple in PRODUCT_FIELDS order, or raise InvalidRow."""
+    if isinstance(row, InvalidRow):
+        raise row
+    try:
+        price = Decimal(str(row.get("price", "")).strip())
+    except InvalidOperation:
+        raise InvalidRow("price must be a number")
+    if not price.is_finite() or price < 0 or price > MAX_PRICE:
+        raise InvalidRow("price must be between 0 and 99999999.99")
+    if price != price.quantize(Decimal("0.01")):
+        raise InvalidRow("price has more than 2 decimal places")
+    stock = row.get("stock")
+    try:
+        stock = int(stock) if stock not in (None, "") else 0
+    except (TypeError, ValueError):
+        raise InvalidRow("stock must be an integer")
+    if stock < 0:
+        raise InvalidRow("stock must not be negative")
+    return (
+        _text(row, "sku", required=require_sku),
+        _text(row, "name", required=True),
+        _text(row, "description"),
+        price,
+        stock,
+        _text(row, "image"),
+        _text(row, "category"),
+    )
+
+
+def upsert_clause(columns, incoming):
+    """ON DUPLICATE KEY UPDATE for ``columns``, where ``incoming(column)`` names the new value."""
+    assignments = []
+    for column in columns:
+        if column == "stock":
+            # The feed states the units for sale. Those the reservation engines hold in stock_escrow are
+            # already out of the column, so only the rest goes back in; escrow beyond the new figure
+            # stays for sale until it is released, which is why stock imports should run with it drained
+            assignments.append(f"stock = GREATEST({incoming(column)} - {ESCROWED_STOCK}, 0)")
+        else:
+            assignments.append(f"{column} = {incoming(column)}")
+    return " ON DUPLICATE KEY UPDATE " + ", ".join(assignments)
+
+
+def insert_rows(cursor, table, columns, rows, upsert_columns=()):
+    placeholders = "(" + ", ".join(["%s"] * len(columns)) + ")"
+    params = [value for row in rows for value in row]
+    sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES {', '.join([placeholders] * len(rows))}"
+    if upsert_columns:
+        sql += upsert_clause(upsert_columns, lambda column: f"VALUES({column})")
+    cursor.execute(sql, params)
+
+
+def _tsv_field(value):
+    # LOAD DATA's default format: tab-separated, backslash escapes, \N for NULL
+    if value is None:
+        return "\\N"
+    return (str(value).replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r").replace("\0", "\\0"))
+
+
+class ChunkWriter:
+    """Writes validated product rows, one transaction per chunk."""
+
+    def __init__(self, db, upsert, load_data):
+        self.db = db
+        self.upsert = upsert
+        self.load_data = load_data
+        self.cursor = db.cursor()
+        if load_data:
+            # Session-private staging table; the real table is then written in one INSERT ... SELECT
+            self.cursor.execute("CREATE TEMPORARY TABLE products_import LIKE products")
+            self.cursor.execute("ALTER TABLE products_import DROP INDEX idx_products_sku")
+
+    def write(self, rows):
+        updated = [field for field in PRODUCT_FIELDS if field != "sku"] if self.upsert else ()
+        if not self.load_data:
+            insert_rows(self.cursor, "products", PRODUCT_FIELDS, rows, updated)
+            return
+        with tempfile.NamedTemporaryFile("w", suffix=".tsv", encoding="utf-8", delete=False) as f:
+            for row in rows:
+                f.write("\t".join(_tsv_field(value) for value in row) + "\n")
+            path = f.name
+        try:
+            self.cursor.execute("DELETE FROM products_import")
+            self.cursor.execute(f"LOAD DATA LOCAL INFILE '{path}' INTO TABLE products_import "
+                                f"CHARACTER SET utf8mb4 ({', '.join(PRODUCT_FIELDS)})")
+            columns = ", ".join(PRODUCT_FIELDS)
+            select = f"SELECT {columns} FROM products_import ORDER BY id"
+            if updated:
+                # Wrapped in a derived table so the update can name the incoming row as new.<column>
+                self.cursor.execute(f"INSERT INTO products ({columns}) SELECT * FROM ({select}) AS new"
+                                    + upsert_clause(updated, lambda column: f"new.{column}"))
+            else:
+                self.cursor.execute(f"INSERT INTO products ({columns}) {select}")
+        finally:
+            os.unlink(path)
+
+    def close(self):
+        self.cursor.close()
+
+
+def load_checkpoint(path, source):
+    if not os.path.exists(path):
+        return 0
+    with open(path) as f:
+        checkpoint = json.load(f)
+    if checkpoint.get("source") != os.path.abspath(source) or checkpoint.get("size") != os.path.getsize(source):
+        sys.exit(f"{path} belongs to a different or changed file; delete it to start over")
+    return checkpoint["rows"]
+
+
+def save_checkpoint(path, source, rows):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"source": os.path.abspath(source), "size": os.path.getsize(source), "rows": rows}, f)
+    os.replace(tmp, path)
+
+
+def import_products(args):
+    fmt = detect_format(args.file, args.format)
+    checkpoint_path = args.file + ".checkpoint"
+    rejects_path = args.file + ".rejects.ndjson"
+    skip = load_checkpoint(checkpoint_path, args.file) if args.resume else 0
+    if skip:
+        print(f"resuming after {skip} rows")
+
+    connect_args = db_connect_args()
+    if args.load_data:
+        connect_args["allow_local_infile"] = True
+    db = None if args.dry_run else mysql.connector.connect(**connect_args)
+    writer = None if args.dry_run else ChunkWriter(db, args.upsert, args.load_data)
+
+    action = "validated" if args.dry_run else "written"
+    consumed = written = rejected = 0
+    started = time.perf_counter()
+    chunk = []
+    with open(args.file, newline="", encoding="utf-8-sig") as f, \
+            open(rejects_path, "a" if args.resume else "w", encoding="utf-8") as rejects:
+
+        def flush():
+            nonlocal written
+            if chunk and writer is not None:
+                try:
+                    writer.write(chunk)
+                    db.commit()
+                except mysql.connector.Error as e:
+                    db.rollback()
+                    sys.exit(f"Chunk ending at row {consumed} failed: {e}\n"
+                             f"Nothing after row {consumed - len(chunk)} was written; fix the cause and rerun with --resume")
+            written += len(chunk)
+            chunk.clear()
+            if writer is not None:
+                # Only rows that are committed (or rejected) count as done
+                save_checkpoint(checkpoint_path, args.file, consumed)
+
+        for line_num, raw in read_rows(f, fmt):
+            consumed += 1
+            if consumed <= skip:
+                continue
+            try:
+                chunk.append(validate(raw, args.upsert))
+            except InvalidRow as e:
+                rejected += 1
+                rejects.write(json.dumps({"line": line_num, "error": str(e),
+                                          "row": raw if isinstance(raw, dict) else None}) + "\n")
+                if args.max_errors is not None and rejected > args.max_errors:
+                    flush()
+                    sys.exit(f"Stopped after {rejected} rejected rows; see {rejects_path}")
+            if len(chunk) >= args.chunk:
+                flush()
+                elapsed = time.perf_counter() - started
+                print(f"  {written} rows {action}, {rejected} rejected ({written / elapsed:.0f} rows/s)", end="\r")
+        flush()
+
+    if writer is not None:
+        writer.close()
+        db.close()
+        os.remove(checkpoint_path)
+    if not rejected:
+        os.remove(rejects_path)
+    print(f"{written} rows {action}, {rejected} rejected in {time.perf_counter() - started:.1f}s" + " " * 20)
+    if rejected:
+        print(f"rejected rows are in {rejects_path}")
+        sys.exit(1)
+
+
+def _export_value(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def export_products(args):
+    fmt = args.format or "csv" if args.output == "-" else detect_format(args.output, args.format)
+    out = sys.stdout if args.output == "-" else open(args.output, "w", newline="", encoding="utf-8")
+    db = mysql.connector.connect(**db_connect_args())
+    # Unbuffered: rows arrive from the server as they are fetched, never all at once
+    cursor = db.cursor(dictionary=True, buffered=False)
+    exported = 0
+    try:
+        # Stock as sold, escrowed units included, so an export imports back unchanged
+        columns = ", ".join(f"{SELLABLE_STOCK} AS stock" if field == "stock" else field for field in PRODUCT_FIELDS)
+        cursor.execute(f"SELECT id, {columns} FROM products ORDER BY id")
+        writer = None
+        if fmt == "csv":
+            writer = csv.DictWriter(out, fieldnames=("id",) + PRODUCT_FIELDS)
+            writer.writeheader()
+        while True:
+            rows = cursor.fetchmany(args.chunk)
+            if not rows:
+                break
+            if writer is not None:
+                writer.writerows(rows)
+            else:
+                out.write("".join(orjson.dumps(row, default=_export_value).decode("utf-8") + "\n"
+                                  for row in rows))
+            exported += len(rows)
+    finally:
+        cursor.close()
+        db.close()
+        if out is not sys.stdout:
+            out.close()
+    print(f"{exported} products exported", file=sys.stderr)
+
+
+def chunked(total, size):
+    for start in range(0, total, size):
+        yield start, min(size, total - start)
+
+
+def next_id(cursor, table):
+    cursor.execute(f"SELECT COALESCE(MAX(id), 0) + 1 FROM {table}")
+    return cursor.fetchone()[0]
+
+
+def seed_users(db, count, rounds, chunk, unique_salts=False):
+    hashed = bcrypt.hashpw(BENCH_PASSWORD.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+    cursor = db.cursor()
+    first = next_id(cursor, "users")
+    # bcrypt releases the GIL, so per-user hashes spread over one thread per core
+    executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 2) if unique_salts else None
+
+    def hash_one(_):
+        return bcrypt.hashpw(BENCH_PASSWORD.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+    try:
+        for start, size in chunked(count, chunk):
+            hashes = list(executor.map(hash_one, range(size))) if executor else [hashed] * size
+            rows = [(f"bench_user_{first + i}", f"bench_user_{first + i}@example.com", hashes[i - start])
+                    for i in range(start, start + size)]
+            insert_rows(cursor, "users", ("username", "email", "password"), rows)
+            db.commit()
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        cursor.close()
+
+
+def seed_products(db, count, chunk, rng):
+    cursor = db.cursor()
+    first = next_id(cursor, "products")
+    for start, size in chunked(count, chunk):
+        rows = []
+        for i in range(start, start + size):
+            rows.append((f"BENCH-{first + i:08d}", f"Bench Product {first + i}", "Synthetic product for load testing",
+                         round(rng.uniform(5, 500), 2), rng.randint(50, 100000),
+                         f"https://example.com/images/{first + i}.jpg", rng.choice(CATEGORIES)))
+        insert_rows(cursor, "products", ("sku", "name", "description", "price", "stock", "image", "category"), rows)
+        db.commit()
+    cursor.close()
+
+
+def seed_orders(db, count, chunk, days, rng):
+    cursor = db.cursor()
+    cursor.execute("SELECT MIN(id), MAX(id) FROM users")
+    min_user, max_user = cursor.fetchone()
+    cursor.execute("SELECT id, price FROM products")
+    products = cursor.fetchall()
+    if not products or min_user is None:
+        sys.exit("Seed users and products before orders")
+
+    order_id = next_id(cursor, "orders")
+    now = datetime.now()
+    span = days * 86400
+    for _, size in chunked(count, chunk):
+        orders, items = [], []
+        for _ in range(size):
+            lines = rng.sample(products, k=min(len(products), rng.randint(1, 5)))
+            total = 0.0
+            for product_id, price in lines:
+                quantity = rng.randint(1, 3)
+                total += float(price) * quantity
+                items.append((order_id, product_id, quantity, price))
+            order_date = now - timedelta(seconds=rng.randint(0, span))
+            orders.append((order_id, rng.randint(min_user, max_user), round(total, 2),
+                           rng.choice(STATUSES), order_date))
+            order_id += 1
+        insert_rows(cursor, "orders", ("id", "user_id", "total_price", "status", "order_date"), orders)
+        insert_rows(cursor, "order_items", ("order_id", "product_id", "quantity", "price_at_time"), items)
+        db.commit()
+    cursor.close()
+
+
+def truncate(db):
+    cursor = db.cursor()
+    cursor.execute("SET FOREIGN_KEY_CHECKS = 0")
+    for table in ("order_items", "orders", "archived_order_segments", "stock_movements", "stock_escrow",
+                  "idempotency_keys", "cart_items", "carts", "sales_daily", "sales_daily_categories",
+                  "sales_daily_products", "products", "users"):
+        cursor.execute(f"TRUNCATE TABLE {table}")
+    cursor.execute("SET FOREIGN_KEY_CHECKS = 1")
+    db.commit()
+    cursor.close()
+
+
+def generate(args):
+    rng = random.Random(args.seed)
+    db = mysql.connector.connect(**db_connect_args())
+    if args.truncate:
+        truncate(db)
+
+    for label, step in (("users", lambda: seed_users(db, args.users, args.bcrypt_rounds, args.chunk,
+                                                     args.unique_salts)),
+                        ("products", lambda: seed_products(db, args.products, args.chunk, rng)),
+                        ("orders", lambda: seed_orders(db, args.orders, args.chunk, args.days, rng))):
+        started = time.perf_counter()
+        step()
+        print(f"seeded {label} in {time.perf_counter() - started:.1f}s")
+    db.close()
+    print(f"bench users log in with password {BENCH_PASSWORD!r}")
+
+
+def add_generate_arguments(parser):
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--products", type=int, default=1000)
+    parser.add_argument("--orders", type=int, default=100000)
+    parser.add_argument("--days", type=int, default=365, help="spread order dates over this many days")
+    parser.add_argument("--chunk", type=int, default=2000, help="rows per INSERT/commit")
+    parser.add_argument("--bcrypt-rounds", type=int, default=int(os.getenv('BCRYPT_ROUNDS', '12')))
+    parser.add_argument("--unique-salts", action="store_true",
+                        help="hash every user's password separately (slow at production cost factors)")
+    parser.add_argument("--seed", type=int, default=42, help="random seed for reproducible data")
+    parser.add_argument("--truncate", action="store_true", help="empty all tables first")
+
+
+def main(argv=None):
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    importer = commands.add_parser("import", help="load products from a CSV or NDJSON file")
+    importer.add_argument("file")
+    importer.add_argument("--format", choices=["csv", "ndjson"])
+    importer.add_argument("--chunk", type=int, default=5000, help="rows per INSERT and per transaction")
+    importer.add_argument("--upsert", action="store_true", help="update products whose sku already exists")
+    importer.add_argument("--load-data", action="store_true",
+                          help="write chunks with LOAD DATA LOCAL INFILE (server needs local_infile=ON)")
+    importer.add_argument("--resume", action="store_true", help="continue after the last committed chunk")
+    importer.add_argument("--max-errors", type=int, help="stop once more than this many rows are rejected")
+    importer.add_argument("--dry-run", action="store_true", help="validate only, write nothing")
+    importer.set_defaults(handler=import_products)
+
+    exporter = commands.add_parser("export", help="write all products to a CSV or NDJSON file")
+    exporter.add_argument("--output", default="-", help="file path, or - for stdout (CSV unless --format)")
+    exporter.add_argument("--format", choices=["csv", "ndjson"])
+    exporter.add_argument("--chunk", type=int, default=5000, help="rows fetched per round trip")
+    exporter.set_defaults(handler=export_products)
+
+    generator = commands.add_parser("generate", help="insert synthetic users, products and orders")
+    add_generate_arguments(generator)
+    generator.set_defaults(handler=generate)
+
+    args = parser.parse_args(argv)
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
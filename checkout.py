@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+from decimal import Decimal
+
+from catalog_query import SELLABLE_STOCK
+
+
+class CheckoutError(Exception):
+    pass
+
+
+class InvalidOrder(CheckoutError):
+    pass
+
+
+class OutOfStock(CheckoutError):
+    pass
+
+
+def normalize_items(items):
+    if not isinstance(items, list):
+        raise InvalidOrder("items must be a list")
+    # Merge repeated lines for the same product so each row is locked and decremented once
+    quantities = {}
+    for item in items:
+        try:
+            product_id = int(item["product_id"])
+            quantity = int(item["quantity"])
+        except (KeyError, TypeError, ValueError):
+            raise InvalidOrder("Each item needs a numeric product_id and quantity")
+        if quantity <= 0:
+            raise InvalidOrder(f"Invalid quantity for product {product_id}")
+        quantities[product_id] = quantities.get(product_id, 0) + quantity
+    return quantities
+
+
+def place_order_tx(cursor, user_id, items, reserved=False):
+    """Create an order inside the caller's open transaction.
+
+    Uses a constant number of statements regardless of cart size: one locking
+    read of every product, one order insert, one multi-row item insert and one
+    stock update. With ``reserved=True`` the stock was already taken by the
+    reservation engine, so products are read without locks and not updated,
+    and their stock counts what the workers hold in escrow too.
+    Returns (order_id, total_price, quantities, remaining), where remaining
+    maps product id to its name and stock after the order.
+    """
+    quantities = normalize_items(items)
+    product_ids = sorted(quantities)
+    placeholders = ", ".join(["%s"] * len(product_ids))
+
+    if reserved:
+        # Escrowed units, this order's included, are still for sale; they just left the stock column early
+        cursor.execute(f"""
+            SELECT id, name, price, {SELLABLE_STOCK} AS stock FROM products
+            WHERE id IN ({placeholders})
+        """, product_ids)
+    else:
+        # Lock in primary-key order so concurrent checkouts cannot deadlock
+        cursor.execute(f"""
+            SELECT id, name, price, stock FROM products
+            WHERE id IN ({placeholders})
+            ORDER BY id
+            FOR UPDATE
+        """, product_ids)
+    products = {row["id"]: row for row in cursor.fetchall()}
+
+    total_price = Decimal("0")
+    for product_id in product_ids:
+        product = products.get(product_id)
+        if not product or (not reserved and product["stock"] < quantities[product_id]):
+            raise OutOfStock(f"Product {product_id} not available in requested quantity")
+        total_price += product["price"] * quantities[product_id]
+
+    cursor.execute("""
+        INSERT INTO orders (user_id, total_price, status)
+        VALUES (%s, %s, 'pending')
+    """, (user_id, total_price))
+    order_id = cursor.lastrowid
+
+    item_rows = ", ".join(["(%s, %s, %s, %s)"] * len(product_ids))
+    item_params = []
+    for product_id in product_ids:
+        item_params.extend([order_id, product_id, quantities[product_id], products[product_id]["price"]])
+    cursor.execute(f"""
+        INSERT INTO order_items (order_id, product_id, quantity, price_at_time)
+        VALUES {item_rows}
+    """, item_params)
+
+    remaining = {}
+    for product_id in product_ids:
+        remaining[product_id] = {
+            "name": products[product_id]["name"],
+            "stock": int(products[product_id]["stock"]) - quantities[product_id],
+        }
+    if reserved:
+        return order_id, total_price, quantities, remaining
+
+    cases = " ".join(["WHEN %s THEN %s"] * len(product_ids))
+    case_params = []
+    for product_id in product_ids:
+        case_params.extend([product_id, quantities[product_id]])
+    cursor.execute(f"""
+        UPDATE products
+        SET stock = stock - CASE id {cases} END
+        WHERE id IN ({placeholders})
+    """, case_params + product_ids)
+    return order_id, total_price, quantities, remaining
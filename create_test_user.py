@@ -1,5 +1,11 @@
 import mysql.connector
 import logging
+import os
+
+import bcrypt
+from dotenv import load_dotenv
+
+from db_pool import db_connect_args
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -7,20 +13,16 @@ logger = logging.getLogger(__name__)
 
 def create_test_user():
     try:
-        # Connect to MySQL
-        db = mysql.connector.connect(
-            host="localhost",
-            user="root",
-            password="Pringles10@",
-            database="ecommerce"
-        )
+        # Connect with the same DB_* settings as the app
+        load_dotenv()
+        db = mysql.connector.connect(**db_connect_args())
         cursor = db.cursor()
 
         # Test user credentials
         test_user = {
             'username': 'testuser',
             'email': 'testuser@example.com',
-            'password': 'Password123'  # In a real app, this would be hashed
+            'password': 'Password123'
         }
 
         # Check if user already exists
@@ -30,9 +32,11 @@ def create_test_user():
         if cursor.fetchone():
             logger.info("Test user already exists")
         else:
-            # Create test user
+            # Stored as a bcrypt hash at the app's cost factor, exactly like /add_user
+            rounds = int(os.getenv('BCRYPT_ROUNDS', '12'))
+            hashed = bcrypt.hashpw(test_user['password'].encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
             query = "INSERT INTO users (username, email, password) VALUES (%s, %s, %s)"
-            cursor.execute(query, (test_user['username'], test_user['email'], test_user['password']))
+            cursor.execute(query, (test_user['username'], test_user['email'], hashed))
             db.commit()
             logger.info("Test user created successfully")
 
@@ -51,4 +55,4 @@ def create_test_user():
             db.close()
 
 if __name__ == "__main__":
-    create_test_user()
\ No newline at end of file
+    create_test_user()
@@ -1,5 +1,7 @@
 -- Database Schema for E-Commerce Store
 -- Run this SQL script on your Railway/production database
+-- The full current schema for a fresh database. Changes to an existing database
+-- go in migrations/ and are applied with `python migrate.py`.
 
 -- Users table
 CREATE TABLE IF NOT EXISTS users (
@@ -13,13 +15,27 @@ CREATE TABLE IF NOT EXISTS users (
 -- Products table
 CREATE TABLE IF NOT EXISTS products (
     id INT AUTO_INCREMENT PRIMARY KEY,
+    sku VARCHAR(64) NULL,
     name VARCHAR(255) NOT NULL,
     description TEXT,
     price DECIMAL(10, 2) NOT NULL,
     stock INT NOT NULL DEFAULT 0,
     image VARCHAR(500),
     category VARCHAR(50),
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    -- Bulk import upserts by supplier SKU (catalog_tool.py)
+    UNIQUE INDEX idx_products_sku (sku),
+    -- Keyset pagination for /products: one index per (filter, sort) pair, id as tie-breaker
+    INDEX idx_products_category_id (category, id),
+    INDEX idx_products_category_price (category, price, id),
+    INDEX idx_products_category_name (category, name, id),
+    INDEX idx_products_price (price, id),
+    INDEX idx_products_name (name, id),
+    -- Low-stock view: WHERE stock <= threshold
+    INDEX idx_products_stock (stock, id),
+    -- Search index sync: WHERE updated_at >= last sync
+    INDEX idx_products_updated (updated_at)
 );
 
 -- Orders table
@@ -29,6 +45,10 @@ CREATE TABLE IF NOT EXISTS orders (
     total_price DECIMAL(10, 2) NOT NULL,
     status VARCHAR(50) DEFAULT 'pending',
     order_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    -- Order history pages: WHERE user_id = ? ORDER BY order_date DESC, id DESC
+    INDEX idx_orders_user_date (user_id, order_date, id),
+    -- Archive job scan: WHERE order_date < cutoff ORDER BY order_date, id
+    INDEX idx_orders_date (order_date, id),
     FOREIGN KEY (user_id) REFERENCES users(id)
 );
 
@@ -40,10 +60,118 @@ CREATE TABLE IF NOT EXISTS order_items (
     quantity INT NOT NULL,
     price_at_time DECIMAL(10, 2) NOT NULL,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    INDEX idx_order_items_order (order_id),
     FOREIGN KEY (order_id) REFERENCES orders(id) ON DELETE CASCADE,
     FOREIGN KEY (product_id) REFERENCES products(id)
 );
 
+-- Stock movements ledger: append-only history of every stock change
+CREATE TABLE IF NOT EXISTS stock_movements (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    product_id INT NOT NULL,
+    quantity_change INT NOT NULL,
+    movement_type VARCHAR(20) NOT NULL,
+    reason VARCHAR(255),
+    order_id INT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    -- Per-product feed pages: WHERE product_id = ? ORDER BY id DESC
+    INDEX idx_stock_movements_product (product_id, id),
+    FOREIGN KEY (product_id) REFERENCES products(id)
+);
+
+-- Stock taken out of products.stock by each worker's reservation engine (see stock_reservations.py)
+CREATE TABLE IF NOT EXISTS stock_escrow (
+    owner VARCHAR(100) NOT NULL,
+    product_id INT NOT NULL,
+    quantity INT NOT NULL,
+    heartbeat_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (owner, product_id),
+    -- Escrowed units per product for place_order's remaining stock
+    INDEX idx_stock_escrow_product (product_id)
+);
+
+-- Responses to /place_order requests sent with an Idempotency-Key, kept until expires_at
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    user_id INT NOT NULL,
+    idempotency_key VARCHAR(255) NOT NULL,
+    request_hash CHAR(64) NOT NULL,
+    status_code SMALLINT NOT NULL,
+    response_body BLOB NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    expires_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (user_id, idempotency_key),
+    INDEX idx_idempotency_expires (expires_at)
+);
+
+-- Where each user's archived orders live (see order_archive.py): one row per user per segment file
+CREATE TABLE IF NOT EXISTS archived_order_segments (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    user_id INT NOT NULL,
+    segment VARCHAR(255) NOT NULL,
+    byte_offset BIGINT NOT NULL,
+    byte_length INT NOT NULL,
+    order_count INT NOT NULL,
+    first_order_date TIMESTAMP NOT NULL,
+    last_order_date TIMESTAMP NOT NULL,
+    archived_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    -- Archived history pages: WHERE user_id = ? ORDER BY id DESC
+    INDEX idx_archived_segments_user (user_id, id)
+);
+
+-- Server-side carts (see cart_store.py): one row per user, written behind the cart API
+CREATE TABLE IF NOT EXISTS carts (
+    user_id INT PRIMARY KEY,
+    version BIGINT NOT NULL,
+    updated_at TIMESTAMP NOT NULL,
+    reminded_at TIMESTAMP NULL,
+    -- Abandoned-cart pass: WHERE reminded_at IS NULL AND updated_at < cutoff
+    INDEX idx_carts_abandoned (reminded_at, updated_at)
+);
+
+CREATE TABLE IF NOT EXISTS cart_items (
+    user_id INT NOT NULL,
+    product_id INT NOT NULL,
+    quantity INT NOT NULL,
+    price_seen DECIMAL(10, 2) NOT NULL,
+    added_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id, product_id)
+);
+
+-- Daily sales rollups (see sales_analytics.py): per day the orders were placed, maintained by the app
+CREATE TABLE IF NOT EXISTS sales_daily (
+    day DATE PRIMARY KEY,
+    orders INT NOT NULL DEFAULT 0,
+    units INT NOT NULL DEFAULT 0,
+    revenue DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    cancelled_orders INT NOT NULL DEFAULT 0,
+    cancelled_units INT NOT NULL DEFAULT 0,
+    cancelled_revenue DECIMAL(14, 2) NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS sales_daily_categories (
+    day DATE NOT NULL,
+    category VARCHAR(50) NOT NULL,
+    orders INT NOT NULL DEFAULT 0,
+    units INT NOT NULL DEFAULT 0,
+    revenue DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    cancelled_orders INT NOT NULL DEFAULT 0,
+    cancelled_units INT NOT NULL DEFAULT 0,
+    cancelled_revenue DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, category)
+);
+
+CREATE TABLE IF NOT EXISTS sales_daily_products (
+    day DATE NOT NULL,
+    product_id INT NOT NULL,
+    orders INT NOT NULL DEFAULT 0,
+    units INT NOT NULL DEFAULT 0,
+    revenue DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    cancelled_orders INT NOT NULL DEFAULT 0,
+    cancelled_units INT NOT NULL DEFAULT 0,
+    cancelled_revenue DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, product_id)
+);
+
 -- Insert sample products (Optional - remove if you already have products)
 INSERT INTO products (name, description, price, stock, image, category) VALUES
 ('Classic White Shirt', 'Elegant white cotton shirt perfect for any occasion', 49.99, 50, 'https://images.unsplash.com/photo-1596755094514-f87e34085b2c?w=500', 'Men''s'),
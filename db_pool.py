@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import mysql.connector
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+# Callables invoked as listener(statement, params, seconds) after every statement
+query_listeners = []
+
+
+def add_query_listener(listener):
+    query_listeners.append(listener)
+
+
+class TimedCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, operation, params=None, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return self._cursor.execute(operation, params, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            for listener in query_listeners:
+                try:
+                    listener(operation, params, elapsed)
+                except Exception as e:
+                    logger.debug("Query listener failed: %s", e)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._cursor.close()
+
+
+class PooledConnection:
+    """Wraps a MySQL connection checked out of a ConnectionPool.
+
+    Everything is delegated to the underlying connection except close(),
+    which hands the connection back to the pool instead of tearing it down.
+    """
+
+    def __init__(self, pool, raw, created_at):
+        self._pool = pool
+        self._raw = raw
+        self._created_at = created_at
+        self._released = False
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def cursor(self, *args, **kwargs):
+        cursor = self._raw.cursor(*args, **kwargs)
+        return TimedCursor(cursor) if query_listeners else cursor
+
+    def close(self):
+        self._pool.release(self)
+
+
+class ConnectionPool:
+    def __init__(self, connect_args, pool_size=10, max_overflow=5, timeout=5.0,
+                 recycle=1800, idle_timeout=300, ping_after=10.0):
+        self.connect_args = connect_args
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.recycle = recycle
+        self.idle_timeout = idle_timeout
+        self.ping_after = ping_after
+        self.pid = os.getpid()
+
+        self._cond = threading.Condition()
+        # Idle entries are (raw, created_at, last_used); newest on the right
+        self._idle = deque()
+        self._total = 0
+        self._checked_out = 0
+        self._counters = {
+            "connections_created": 0,
+            "connections_closed": 0,
+            "checkouts": 0,
+            "timeouts": 0,
+            "failed_pings": 0,
+            "recycled": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+        }
+
+    def _connect(self):
+        raw = mysql.connector.connect(**self.connect_args)
+        if not raw.is_connected():
+            raise Exception("Failed to connect to database")
+        with self._cond:
+            self._counters["connections_created"] += 1
+        return raw
+
+    def _discard(self, raw):
+        try:
+            raw.close()
+        except Exception as e:
+            logger.debug("Error closing pooled connection: %s", e)
+        with self._cond:
+            self._total -= 1
+            self._counters["connections_closed"] += 1
+            self._cond.notify()
+
+    def _expired(self, created_at, last_used, now):
+        if self.recycle and now - created_at > self.recycle:
+            return True
+        return bool(self.idle_timeout) and now - last_used > self.idle_timeout
+
+    def acquire(self, timeout=None):
+        started = time.monotonic()
+        deadline = started + (self.timeout if timeout is None else timeout)
+
+        while True:
+            entry = None
+            with self._cond:
+                while True:
+                    if self._idle:
+                        entry = self._idle.pop()
+                        break
+                    if self._total < self.pool_size + self.max_overflow:
+                        # Reserve a slot; the connection is opened outside the lock
+                        self._total += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._counters["timeouts"] += 1
+                        raise PoolTimeout(
+                            "Timed out after %.1fs waiting for a database connection" % (time.monotonic() - started))
+                    self._cond.wait(remaining)
+                self._checked_out += 1
+
+            if entry is None:
+                try:
+                    raw = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._checked_out -= 1
+                        self._total -= 1
+                        self._cond.notify()
+                    raise
+                created_at = time.monotonic()
+            else:
+                raw, created_at, last_used = entry
+                now = time.monotonic()
+                if self._expired(created_at, last_used, now):
+                    with self._cond:
+                        self._counters["recycled"] += 1
+                        self._checked_out -= 1
+                    self._discard(raw)
+                    continue
+                if now - last_used > self.ping_after and not self._ping(raw):
+                    with self._cond:
+                        self._checked_out -= 1
+                    self._discard(raw)
+                    continue
+
+            waited = time.monotonic() - started
+            with self._cond:
+                self._counters["checkouts"] += 1
+                self._counters["wait_seconds_total"] += waited
+                self._counters["wait_seconds_max"] = max(self._counters["wait_seconds_max"], waited)
+            return PooledConnection(self, raw, created_at)
+
+    def _ping(self, raw):
+        try:
+            raw.ping(reconnect=False)
+            return True
+        except Exception as e:
+            logger.warning("Discarding dead pooled connection: %s", e)
+            with self._cond:
+                self._counters["failed_pings"] += 1
+            return False
+
+    def release(self, conn):
+        if conn._released:
+            return
+        conn._released = True
+        raw = conn._raw
+
+        healthy = True
+        try:
+            # Never hand the next request an open transaction or a stale snapshot
+            if raw.in_transaction:
+                raw.rollback()
+        except Exception as e:
+            logger.warning("Discarding connection that failed to reset: %s", e)
+            healthy = False
+
+        now = time.monotonic()
+        if healthy and self.recycle and now - conn._created_at > self.recycle:
+            healthy = False
+            with self._cond:
+                self._counters["recycled"] += 1
+
+        stale = []
+        with self._cond:
+            self._checked_out -= 1
+            if healthy and len(self._idle) < self.pool_size:
+                self._idle.append((raw, conn._created_at, now))
+                raw = None
+            # Reap connections that sat idle too long at the cold end of the deque
+            while self._idle and self.idle_timeout and now - self._idle[0][2] > self.idle_timeout:
+                stale.append(self._idle.popleft()[0])
+            self._cond.notify()
+
+        if raw is not None:
+            self._discard(raw)
+        for idle_raw in stale:
+            self._discard(idle_raw)
+
+    def prefill(self, count):
+        # Open connections before the first requests arrive (called once per worker after fork)
+        conns = []
+        try:
+            for _ in range(min(count, self.pool_size)):
+                conns.append(self.acquire())
+        finally:
+            for conn in conns:
+                conn.close()
+        return len(conns)
+
+    def dispose(self):
+        with self._cond:
+            idle = [entry[0] for entry in self._idle]
+            self._idle.clear()
+        for raw in idle:
+            self._discard(raw)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._counters)
+            stats.update({
+                "pid": self.pid,
+                "pool_size": self.pool_size,
+                "max_overflow": self.max_overflow,
+                "open": self._total,
+                "idle": len(self._idle),
+                "checked_out": self._checked_out,
+                "overflow": max(0, self._total - self.pool_size),
+            })
+        return stats
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def db_connect_args():
+    return {
+        "host": os.getenv('DB_HOST', 'localhost'),
+        "user": os.getenv('DB_USER', 'ecommerce_user'),
+        "password": os.getenv('DB_PASSWORD', 'ecommerce123'),
+        "database": os.getenv('DB_NAME', 'ecommerce'),
+        # The C extension blocks gevent's event loop; the pure-Python driver cooperates with it
+        "use_pure": os.getenv('DB_USE_PURE', 'false').lower() == 'true',
+    }
+
+
+def get_pool():
+    # One pool per worker process; a pool inherited across fork() is never reused
+    global _pool
+    pool = _pool
+    if pool is not None and pool.pid == os.getpid():
+        return pool
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid():
+            _pool = ConnectionPool(
+                db_connect_args(),
+                pool_size=int(os.getenv('DB_POOL_SIZE', '10')),
+                max_overflow=int(os.getenv('DB_POOL_MAX_OVERFLOW', '5')),
+                timeout=float(os.getenv('DB_POOL_TIMEOUT', '5')),
+                recycle=float(os.getenv('DB_POOL_RECYCLE', '1800')),
+                idle_timeout=float(os.getenv('DB_POOL_IDLE_TIMEOUT', '300')),
+                ping_after=float(os.getenv('DB_POOL_PING_AFTER', '10')),
+            )
+            logger.info("Created database pool (size=%s, overflow=%s) for pid %s",
+                        _pool.pool_size, _pool.max_overflow, _pool.pid)
+        return _pool
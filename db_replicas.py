@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import threading
+import time
+
+import mysql.connector
+
+import metrics
+from db_pool import ConnectionPool, db_connect_args
+
+logger = logging.getLogger(__name__)
+
+
+class Replica:
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        # Out of rotation until the first lag check says it is replicating and close enough
+        self.in_rotation = False
+        self.lag = None
+        self.checked_at = None
+        self.error = None
+        self.ejections = 0
+
+
+def replication_lag(conn):
+    """Seconds the replica is behind its source, or None if it is not replicating."""
+    cursor = conn.cursor(dictionary=True)
+    try:
+        try:
+            cursor.execute("SHOW REPLICA STATUS")
+            row = cursor.fetchone()
+            column = "Seconds_Behind_Source"
+        except mysql.connector.Error:
+            # Servers older than 8.0.22 only know the old name
+            cursor.execute("SHOW SLAVE STATUS")
+            row = cursor.fetchone()
+            column = "Seconds_Behind_Master"
+        cursor.fetchall()
+    finally:
+        cursor.close()
+    if row is None:
+        return None
+    return row.get(column)
+
+
+class ReplicaRouter:
+    """Spreads read-only queries over replicas that keep up with the primary.
+
+    A background thread measures every replica's lag each
+    ``check_interval`` seconds. Replicas that stop replicating, fall more
+    than ``max_lag`` seconds behind or refuse connections leave the
+    rotation, and rejoin once a check passes again. Reads are handed out
+    round-robin over the replicas in rotation; when there are none the
+    caller reads from the primary instead.
+
+    Users who just wrote something are pinned to the primary for
+    ``pin_seconds`` so they read their own writes whatever the lag.
+    """
+
+    def __init__(self, replicas, max_lag=5.0, check_interval=2.0, pin_seconds=10.0, lag_probe=replication_lag):
+        self.replicas = replicas
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.pin_seconds = pin_seconds
+        self.lag_probe = lag_probe
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._next = 0
+        self._pins = {}
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="replica-lag-checker", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.check_all()
+            self._stop.wait(self.check_interval)
+
+    def check_all(self):
+        for replica in self.replicas:
+            try:
+                conn = replica.pool.acquire(timeout=1.0)
+                try:
+                    lag = self.lag_probe(conn)
+                finally:
+                    conn.close()
+                error = None if lag is not None else "not replicating"
+            except Exception as e:
+                lag, error = None, str(e)
+            self._update(replica, lag, error)
+
+    def _update(self, replica, lag, error=None):
+        healthy = error is None and lag is not None and lag <= self.max_lag
+        with self._lock:
+            was_in_rotation = replica.in_rotation
+            replica.lag, replica.error = lag, error
+            replica.checked_at = time.time()
+            replica.in_rotation = healthy
+            if was_in_rotation and not healthy:
+                replica.ejections += 1
+        if was_in_rotation and not healthy:
+            metrics.inc("db_replica_ejections_total", (replica.name,))
+            logger.warning("Replica %s out of rotation (lag=%s, error=%s)", replica.name, lag, error)
+        elif healthy and not was_in_rotation:
+            logger.info("Replica %s in rotation (lag=%ss)", replica.name, lag)
+
+    def pin(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            self._pins[user_id] = now + self.pin_seconds
+            if len(self._pins) > 10000:
+                self._pins = {key: until for key, until in self._pins.items() if until > now}
+
+    def pinned(self, user_id):
+        until = self._pins.get(user_id)
+        return until is not None and until > time.monotonic()
+
+    def acquire(self):
+        """(connection, replica) from the next replica in rotation, or (None, None)."""
+        self.start()
+        with self._lock:
+            candidates = [replica for replica in self.replicas if replica.in_rotation]
+            start = self._next
+            self._next += 1
+        for offset in range(len(candidates)):
+            replica = candidates[(start + offset) % len(candidates)]
+            try:
+                # Short wait: an exhausted replica pool is a reason to use another, not to queue
+                return replica.pool.acquire(timeout=0.5), replica
+            except Exception as e:
+                self._update(replica, replica.lag, f"acquire failed: {e}")
+        return None, None
+
+    def stats(self):
+        with self._lock:
+            return [{
+                "name": replica.name,
+                "in_rotation": replica.in_rotation,
+                "lag_seconds": replica.lag,
+                "checked_at": replica.checked_at,
+                "error": replica.error,
+                "ejections": replica.ejections,
+                "pool": replica.pool.stats(),
+            } for replica in self.replicas]
+
+
+def parse_replica_hosts(value):
+    replicas = []
+    for entry in (value or "").split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        host, _, port = entry.partition(":")
+        replicas.append((host, int(port) if port else 3306))
+    return replicas
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_replica_router():
+    """This worker's router, or None when DB_REPLICA_HOSTS is not set."""
+    global _router
+    hosts = parse_replica_hosts(os.getenv('DB_REPLICA_HOSTS'))
+    if not hosts:
+        return None
+    router = _router
+    if router is not None and router.pid == os.getpid():
+        return router
+    with _router_lock:
+        if _router is None or _router.pid != os.getpid():
+            replicas = []
+            for host, port in hosts:
+                # Same credentials and schema as the primary; only the server differs
+                connect_args = dict(db_connect_args(), host=host, port=port)
+                pool = ConnectionPool(
+                    connect_args,
+                    pool_size=int(os.getenv('DB_REPLICA_POOL_SIZE', os.getenv('DB_POOL_SIZE', '10'))),
+                    max_overflow=int(os.getenv('DB_POOL_MAX_OVERFLOW', '5')),
+                    recycle=float(os.getenv('DB_POOL_RECYCLE', '1800')),
+                    idle_timeout=float(os.getenv('DB_POOL_IDLE_TIMEOUT', '300')),
+                    ping_after=float(os.getenv('DB_POOL_PING_AFTER', '10')),
+                )
+                replicas.append(Replica(f"{host}:{port}", pool))
+            _router = ReplicaRouter(
+                replicas,
+                max_lag=float(os.getenv('DB_REPLICA_MAX_LAG', '5')),
+                check_interval=float(os.getenv('DB_REPLICA_CHECK_INTERVAL', '2')),
+                pin_seconds=float(os.getenv('DB_READ_YOUR_WRITES_SECONDS', '10')),
+            )
+            logger.info("Routing reads to %s replica(s) for pid %s", len(replicas), _router.pid)
+        return _router
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""Gunicorn settings for production: gunicorn -c gunicorn.conf.py
+
+The app is imported once in the master (preload_app) and forked, so
+workers share its memory copy-on-write. Everything that holds sockets or
+threads (DB pool, mail dispatcher, log listener, caches) is created
+lazily per process; post_fork then opens each worker's connections and
+fills its caches before it accepts requests.
+
+Worker modes (GUNICORN_WORKER_CLASS):
+  gthread  default; WEB_CONCURRENCY processes x GUNICORN_THREADS threads.
+  gevent   many greenlets per process for I/O-bound traffic. Requires
+           `pip install gevent`; switches the MySQL driver to its
+           pure-Python implementation so queries yield to the event loop.
+           bcrypt still holds a worker while it hashes, so keep login
+           traffic on gthread workers if it dominates.
+
+Reloads: `kill -HUP <master>` replaces workers gracefully, but with
+preload_app the code is the master's. To deploy new code without
+dropping connections, send USR2 (starts a new master), then WINCH and
+QUIT to the old one, or set GUNICORN_PRELOAD=false so HUP re-imports it.
+"""
+import multiprocessing
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+wsgi_app = "app:create_app()"
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+workers = int(os.getenv('WEB_CONCURRENCY', min(multiprocessing.cpu_count() * 2 + 1, 8)))
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '200'))
+
+if worker_class == 'gevent':
+    os.environ.setdefault('DB_USE_PURE', 'true')
+
+# gevent patches the standard library in each worker; importing the app before that would
+# leave the master's locks and sockets unpatched
+preload_app = os.getenv('GUNICORN_PRELOAD', 'true').lower() == 'true' and worker_class != 'gevent'
+
+# Recycle workers now and then to bound slow leaks; jitter keeps them from restarting together
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', '5000'))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', '500'))
+
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '30'))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', '30'))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', '5'))
+
+# The app writes its own structured access log
+accesslog = None
+errorlog = "-"
+loglevel = os.getenv('LOG_LEVEL', 'info').lower()
+
+
+def post_fork(server, worker):
+    if not preload_app:
+        # The app is loaded after this hook; warm up once it is
+        return
+    import app as application
+
+    # Returns the app the master already built; warm-up must finish well inside `timeout`
+    application.warm_worker(worker.app.wsgi())
+
+
+def post_worker_init(worker):
+    if preload_app:
+        return
+    import app as application
+
+    application.warm_worker(worker.wsgi)
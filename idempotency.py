@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+import collections
+import hashlib
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import mysql.connector
+import orjson
+
+logger = logging.getLogger(__name__)
+
+MAX_KEY_LENGTH = 255
+
+
+class IdempotencyBusy(Exception):
+    pass
+
+
+class StoredResponse:
+    __slots__ = ("fingerprint", "status", "body", "expires_at")
+
+    def __init__(self, fingerprint, status, body, expires_at):
+        self.fingerprint = fingerprint
+        self.status = status
+        self.body = body
+        self.expires_at = expires_at
+
+
+def request_fingerprint(user_id, body):
+    # Same key with a different request body is a client bug, not a retry. The body as posted, not the
+    # items resolved from it: a cart checkout (no items) must match its retry after the cart was emptied
+    canonical = orjson.dumps({"user_id": user_id, "body": body}, option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha256(canonical).hexdigest()
+
+
+class IdempotencyStore:
+    """Remembers the response to each (user, Idempotency-Key) for ``ttl`` seconds.
+
+    The idempotency_keys table is the source of truth. Its row is inserted
+    inside the order transaction, before any product is locked, so it
+    commits or rolls back with the order. A duplicate that another worker
+    is still processing blocks on that row's primary key and fails with a
+    duplicate-key error once the first commits. It then replays the stored
+    response. If the first rolls back, the duplicate goes ahead as the
+    original. Rejected requests (out of stock, invalid) leave no row, so
+    they can be retried with the same key.
+
+    Completed responses are also kept in a bounded in-process LRU, so
+    retries that reach the same worker skip the lookup. Duplicates that
+    arrive at the same worker while the original is still running wait
+    for it in in_flight().
+    """
+
+    def __init__(self, ttl=86400, max_entries=10000, wait_timeout=30.0, purge_interval=300.0):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.wait_timeout = wait_timeout
+        self.purge_interval = purge_interval
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._flights = {}
+        self._purged_at = time.monotonic()
+        self.stats = {"replayed": 0, "stored": 0, "waited": 0, "raced": 0, "purged": 0}
+
+    @contextmanager
+    def in_flight(self, user_id, key):
+        scope = (user_id, key)
+        while True:
+            with self._lock:
+                flight = self._flights.get(scope)
+                if flight is None:
+                    flight = self._flights[scope] = threading.Event()
+                    break
+                self.stats["waited"] += 1
+            if not flight.wait(self.wait_timeout):
+                raise IdempotencyBusy("A request with this Idempotency-Key is still being processed")
+        try:
+            yield
+        finally:
+            with self._lock:
+                del self._flights[scope]
+            flight.set()
+
+    def _remember(self, user_id, key, stored):
+        with self._lock:
+            self._entries[(user_id, key)] = stored
+            self._entries.move_to_end((user_id, key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def lookup(self, cursor, user_id, key):
+        with self._lock:
+            stored = self._entries.get((user_id, key))
+            if stored is not None and stored.expires_at > time.time():
+                self._entries.move_to_end((user_id, key))
+                self.stats["replayed"] += 1
+                return stored
+        cursor.execute("""
+            SELECT request_hash, status_code, response_body, UNIX_TIMESTAMP(expires_at) AS expires_at
+            FROM idempotency_keys
+            WHERE user_id = %s AND idempotency_key = %s AND expires_at > NOW()
+        """, (user_id, key))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        stored = StoredResponse(row["request_hash"], row["status_code"], bytes(row["response_body"]),
+                                float(row["expires_at"]))
+        self._remember(user_id, key, stored)
+        with self._lock:
+            self.stats["replayed"] += 1
+        return stored
+
+    def claim(self, cursor, user_id, key, fingerprint):
+        """Insert the key's row in the open transaction; False if another request already holds it."""
+        for _ in range(2):
+            try:
+                cursor.execute("""
+                    INSERT INTO idempotency_keys
+                        (user_id, idempotency_key, request_hash, status_code, response_body, expires_at)
+                    VALUES (%s, %s, %s, 0, '', NOW() + INTERVAL %s SECOND)
+                """, (user_id, key, fingerprint, int(self.ttl)))
+                return True
+            except mysql.connector.IntegrityError as e:
+                if e.errno != 1062:
+                    raise
+            # Duplicate: either a live key, or an expired row the purge has not reached yet
+            cursor.execute("""
+                DELETE FROM idempotency_keys
+                WHERE user_id = %s AND idempotency_key = %s AND expires_at <= NOW()
+            """, (user_id, key))
+            if cursor.rowcount == 0:
+                with self._lock:
+                    self.stats["raced"] += 1
+                return False
+        return False
+
+    def complete(self, cursor, user_id, key, fingerprint, status, body):
+        # Still inside the order transaction: the response becomes visible when the order does
+        cursor.execute("""
+            UPDATE idempotency_keys SET status_code = %s, response_body = %s
+            WHERE user_id = %s AND idempotency_key = %s
+        """, (status, body, user_id, key))
+        return StoredResponse(fingerprint, status, body, time.time() + self.ttl)
+
+    def committed(self, user_id, key, stored):
+        self._remember(user_id, key, stored)
+        with self._lock:
+            self.stats["stored"] += 1
+
+    def purge_expired(self, db):
+        # At most once per purge_interval per worker, in small batches on idx_idempotency_expires
+        now = time.monotonic()
+        with self._lock:
+            if now - self._purged_at < self.purge_interval:
+                return
+            self._purged_at = now
+            expired = [scope for scope, stored in self._entries.items() if stored.expires_at <= time.time()]
+            for scope in expired:
+                del self._entries[scope]
+        cursor = db.cursor()
+        try:
+            cursor.execute("DELETE FROM idempotency_keys WHERE expires_at <= NOW() LIMIT 1000")
+            db.commit()
+            with self._lock:
+                self.stats["purged"] += cursor.rowcount
+        except Exception as e:
+            db.rollback()
+            logger.warning("Failed to purge expired idempotency keys: %s", e)
+        finally:
+            cursor.close()
+
+    def info(self):
+        with self._lock:
+            return dict(self.stats, size=len(self._entries), inflight=len(self._flights))
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_idempotency_store():
+    global _store
+    with _store_lock:
+        if _store is None or _store.pid != os.getpid():
+            _store = IdempotencyStore(
+                ttl=float(os.getenv('IDEMPOTENCY_TTL', '86400')),
+                max_entries=int(os.getenv('IDEMPOTENCY_CACHE_SIZE', '10000')),
+                wait_timeout=float(os.getenv('IDEMPOTENCY_WAIT_TIMEOUT', '30')),
+            )
+        return _store
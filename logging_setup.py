@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+from flask import g, has_request_context, request
+
+# Attributes every LogRecord has; anything else was passed via extra= and is emitted as a field
+_RESERVED = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+_handler = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class RequestContextFilter(logging.Filter):
+    """Stamps records with the current request's id and route, and applies sampling.
+
+    Runs on the request thread, so it must stay cheap: it only copies a few
+    attributes. Records below WARNING are dropped when the request was not
+    sampled; warnings and errors are always kept.
+    """
+
+    def filter(self, record):
+        if not has_request_context():
+            return True
+        record.request_id = g.get("request_id")
+        record.route = request.endpoint
+        return record.levelno >= logging.WARNING or g.get("log_sampled", True)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queues records for a listener thread that formats and writes them.
+
+    Threads do not survive fork, so a gunicorn worker that inherits this
+    handler from the master starts its own listener on its first record.
+    """
+
+    def __init__(self, target):
+        super().__init__(queue.SimpleQueue())
+        self.target = target
+        self._listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # Records the parent had not written yet are its business, not ours
+            self.queue = queue.SimpleQueue()
+            self._listener = logging.handlers.QueueListener(self.queue, self.target, respect_handler_level=True)
+            self._listener.start()
+            self._pid = os.getpid()
+            atexit.register(self.stop)
+
+    def stop(self):
+        if self._listener is not None and self._pid == os.getpid():
+            self._listener.stop()
+            self._listener = None
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            self.start()
+        super().emit(record)
+
+    # The stock QueueHandler formats the message before enqueueing; leave that to the listener thread
+    def prepare(self, record):
+        return record
+
+
+def _sample_rates():
+    rates = {}
+    for pair in filter(None, os.getenv('LOG_SAMPLE_RATES', '').split(',')):
+        route, _, rate = pair.partition('=')
+        rates[route.strip()] = float(rate)
+    return rates
+
+
+def configure_logging(app):
+    global _handler
+    development = os.getenv('FLASK_ENV') == 'development'
+    level = os.getenv('LOG_LEVEL', 'DEBUG' if development else 'INFO').upper()
+
+    stream = logging.StreamHandler()
+    if os.getenv('LOG_FORMAT', 'text' if development else 'json') == 'json':
+        stream.setFormatter(JsonFormatter())
+    else:
+        stream.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+
+    if _handler is not None:
+        _handler.stop()
+    _handler = DeferredQueueHandler(stream)
+    _handler.addFilter(RequestContextFilter())
+    _handler.start()
+
+    root = logging.getLogger()
+    root.handlers[:] = [_handler]
+    root.setLevel(level)
+
+    default_rate = float(os.getenv('LOG_SAMPLE_RATE', '1.0'))
+    rates = _sample_rates()
+    access_logger = logging.getLogger("access")
+
+    @app.before_request
+    def start_request_log():
+        g.request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+        g.request_started = time.perf_counter()
+        g.log_sampled = random.random() < rates.get(request.endpoint, default_rate)
+
+    @app.after_request
+    def finish_request_log(response):
+        started = g.get("request_started")
+        if started is None:
+            return response
+        response.headers["X-Request-ID"] = g.request_id
+        # Failed requests are always logged, whatever the sampling decision
+        level = logging.INFO
+        if response.status_code >= 500:
+            level = logging.ERROR
+        elif response.status_code >= 400:
+            level = logging.WARNING
+        access_logger.log(level, "%s %s %s", request.method, request.path, response.status_code, extra={
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+            "duration_ms": round((time.perf_counter() - started) * 1000, 2),
+        })
+        return response
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+import atexit
+import heapq
+import itertools
+import logging
+import os
+import queue
+import smtplib
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class EmailDispatcher:
+    """Sends queued messages from a background thread over one reused SMTP session.
+
+    enqueue() never blocks on the network: it returns False straight away
+    when the bounded queue is full. Failed deliveries are retried with
+    exponential backoff, and stop() drains whatever is still queued.
+    """
+
+    def __init__(self, host, port, username=None, password=None, use_tls=True,
+                 queue_size=1000, max_retries=3, backoff=2.0, max_backoff=60.0,
+                 timeout=10.0, idle_timeout=30.0):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.pid = os.getpid()
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._retries = []
+        self._seq = itertools.count()
+        self._smtp = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._counters = {
+            "enqueued": 0,
+            "rejected": 0,
+            "sent": 0,
+            "retried": 0,
+            "failed": 0,
+            "connections": 0,
+        }
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="email-dispatcher", daemon=True)
+                self._thread.start()
+
+    def enqueue(self, message):
+        self.start()
+        try:
+            self._queue.put_nowait((message, 0))
+        except queue.Full:
+            self._count("rejected")
+            logger.warning("Email queue full, dropping message to %s", message["To"])
+            return False
+        self._count("enqueued")
+        return True
+
+    def stop(self, timeout=10.0):
+        thread = self._thread
+        if thread is None or not thread.is_alive():
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            logger.error("Email queue did not drain before shutdown")
+            return
+        thread.join(timeout)
+
+    def metrics(self):
+        with self._lock:
+            metrics = dict(self._counters)
+        metrics["queued"] = self._queue.qsize()
+        metrics["pending_retries"] = len(self._retries)
+        return metrics
+
+    def _session(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.noop()
+                return self._smtp
+            except smtplib.SMTPException:
+                self._close()
+            except OSError:
+                self._close()
+
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.use_tls:
+                smtp.starttls()
+            if self.username:
+                smtp.login(self.username, self.password)
+        except Exception:
+            smtp.close()
+            raise
+        self._count("connections")
+        self._smtp = smtp
+        return smtp
+
+    def _close(self):
+        smtp, self._smtp = self._smtp, None
+        if smtp is not None:
+            try:
+                smtp.quit()
+            except Exception:
+                smtp.close()
+
+    def _deliver(self, message, attempt):
+        try:
+            self._session().send_message(message)
+            self._count("sent")
+            logger.info("Email sent to %s", message["To"])
+            return
+        except smtplib.SMTPAuthenticationError as e:
+            # Bad credentials will not fix themselves on retry
+            self._close()
+            self._count("failed")
+            logger.error("SMTP authentication failed, check EMAIL_USERNAME/EMAIL_PASSWORD: %s", e)
+            return
+        except (smtplib.SMTPException, OSError) as e:
+            self._close()
+            error = e
+        except Exception as e:
+            # Anything else (e.g. a header that won't encode) is a problem with this message, not the server;
+            # the session may be mid-command, so drop it, and keep the dispatcher thread alive
+            self._close()
+            self._count("failed")
+            logger.error("Giving up on email to %s, it could not be sent: %r", message["To"], e)
+            return
+
+        if attempt < self.max_retries:
+            delay = min(self.max_backoff, self.backoff * (2 ** attempt))
+            heapq.heappush(self._retries, (time.monotonic() + delay, next(self._seq), message, attempt + 1))
+            self._count("retried")
+            logger.warning("Email to %s failed (%s), retrying in %.1fs", message["To"], error, delay)
+        else:
+            self._count("failed")
+            logger.error("Giving up on email to %s after %d attempts: %s", message["To"], attempt + 1, error)
+
+    def _run(self):
+        stopping = False
+        while True:
+            if self._retries:
+                wait = max(0.0, self._retries[0][0] - time.monotonic())
+            else:
+                wait = self.idle_timeout
+            try:
+                job = None if stopping else self._queue.get(timeout=wait)
+            except queue.Empty:
+                job = None
+                if not self._retries:
+                    # Don't keep an idle session open for the server to drop
+                    self._close()
+
+            if job is _STOP:
+                stopping = True
+            elif job is not None:
+                self._deliver(*job)
+
+            while self._retries and (stopping or self._retries[0][0] <= time.monotonic()):
+                _, _, message, attempt = heapq.heappop(self._retries)
+                # While draining, each retry gets one last immediate attempt
+                self._deliver(message, self.max_retries if stopping else attempt)
+
+            if stopping:
+                while True:
+                    try:
+                        job = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if job is not _STOP:
+                        self._deliver(job[0], self.max_retries)
+                self._close()
+                return
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher():
+    # Threads do not survive fork(), so each worker process builds its own dispatcher
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None or _dispatcher.pid != os.getpid():
+            _dispatcher = EmailDispatcher(
+                host=os.getenv('EMAIL_HOST', 'smtp.gmail.com'),
+                port=int(os.getenv('EMAIL_PORT', '587')),
+                username=os.getenv('EMAIL_USERNAME'),
+                password=os.getenv('EMAIL_PASSWORD'),
+                use_tls=os.getenv('EMAIL_USE_TLS', 'true').lower() != 'false',
+                queue_size=int(os.getenv('EMAIL_QUEUE_SIZE', '1000')),
+                max_retries=int(os.getenv('EMAIL_MAX_RETRIES', '3')),
+                backoff=float(os.getenv('EMAIL_RETRY_BACKOFF', '2')),
+            )
+        return _dispatcher
+
+
+@atexit.register
+def _drain_on_exit():
+    dispatcher = _dispatcher
+    if dispatcher is not None and dispatcher.pid == os.getpid():
+        dispatcher.stop(timeout=float(os.getenv('EMAIL_DRAIN_TIMEOUT', '10')))
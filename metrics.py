@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+import atexit
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+from flask import g, request
+
+from db_pool import add_query_listener
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# name -> (type, help, buckets)
+METRICS = {
+    "http_requests_total": ("counter", "HTTP requests by endpoint, method and status.", None),
+    "http_request_duration_seconds": ("histogram", "HTTP request latency by endpoint.", LATENCY_BUCKETS),
+    "db_queries_total": ("counter", "SQL statements executed, by endpoint.", None),
+    "db_query_duration_seconds": ("histogram", "SQL statement latency by endpoint.", DB_BUCKETS),
+    "db_queries_per_request": ("histogram", "SQL statements per request; high counts point at N+1 patterns.",
+                               COUNT_BUCKETS),
+    "db_connection_acquire_seconds": ("histogram", "Time spent waiting for a pooled connection.", DB_BUCKETS),
+    "bcrypt_duration_seconds": ("histogram", "Password hash/verify time including queueing, by operation.",
+                                LATENCY_BUCKETS),
+    "bcrypt_rejected_total": ("counter", "Password operations rejected by admission control.", None),
+    "checkout_outcomes_total": ("counter", "place_order results by outcome.", None),
+    "db_reads_total": ("counter", "Read-only requests by the server that answered them.", None),
+    "db_replica_ejections_total": ("counter", "Times a replica left the read rotation.", None),
+}
+
+
+class Registry:
+    """Per-process metric store. Updates take one short lock; rendering merges all workers."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, tuple(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        buckets = METRICS[name][2]
+        key = (name, tuple(labels))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [[0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    hist[0][i] += 1
+                    break
+            hist[1] += value
+            hist[2] += 1
+
+    def register_collector(self, collector):
+        # collector() returns {gauge_name: {"help": ..., "value": n}} sampled at scrape time
+        if collector not in self._collectors:
+            self._collectors.append(collector)
+
+    def snapshot(self):
+        with self._lock:
+            counters = [[name, list(labels), value] for (name, labels), value in self._counters.items()]
+            histograms = [[name, list(labels), list(h[0]), h[1], h[2]]
+                          for (name, labels), h in self._histograms.items()]
+        gauges = {}
+        for collector in self._collectors:
+            try:
+                gauges.update(collector())
+            except Exception as e:
+                logger.warning("Metrics collector failed: %s", e)
+        return {"pid": os.getpid(), "counters": counters, "histograms": histograms, "gauges": gauges}
+
+
+registry = Registry()
+
+
+def inc(name, labels=(), value=1):
+    registry.inc(name, labels, value)
+
+
+def observe(name, value, labels=()):
+    registry.observe(name, value, labels)
+
+
+def _metrics_dir():
+    return os.getenv('METRICS_DIR')
+
+
+def _write_snapshot():
+    directory = _metrics_dir()
+    if not directory:
+        return
+    path = os.path.join(directory, f"metrics-{os.getpid()}.json")
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(registry.snapshot(), f)
+    os.replace(tmp, path)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+def _merge(total, snapshot, keep_gauges=True):
+    for name, labels, value in snapshot["counters"]:
+        key = (name, tuple(labels))
+        total["counters"][key] = total["counters"].get(key, 0) + value
+    for name, labels, buckets, sum_, count in snapshot["histograms"]:
+        key = (name, tuple(labels))
+        hist = total["histograms"].setdefault(key, [[0] * len(buckets), 0.0, 0])
+        hist[0] = [a + b for a, b in zip(hist[0], buckets)]
+        hist[1] += sum_
+        hist[2] += count
+    if keep_gauges:
+        for name, gauge in snapshot["gauges"].items():
+            total["gauges"].setdefault(name, {"help": gauge["help"], "values": []})
+            total["gauges"][name]["values"].append((str(snapshot["pid"]), gauge["value"]))
+
+
+def _fold_dead_workers(directory):
+    # Counters from exited workers are folded into one file so totals never go backwards
+    with open(os.path.join(directory, "metrics.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        dead_path = os.path.join(directory, "metrics-dead.json")
+        dead = {"counters": {}, "histograms": {}, "gauges": {}}
+        if os.path.exists(dead_path):
+            with open(dead_path) as f:
+                _merge(dead, json.load(f), keep_gauges=False)
+        folded = False
+        for path in glob.glob(os.path.join(directory, "metrics-[0-9]*.json")):
+            pid = int(os.path.basename(path)[8:-5])
+            if pid == os.getpid() or _pid_alive(pid):
+                continue
+            try:
+                with open(path) as f:
+                    _merge(dead, json.load(f), keep_gauges=False)
+                os.remove(path)
+                folded = True
+            except (OSError, ValueError) as e:
+                logger.warning("Could not fold metrics file %s: %s", path, e)
+        if folded:
+            snapshot = {
+                "pid": "dead",
+                "counters": [[n, list(l), v] for (n, l), v in dead["counters"].items()],
+                "histograms": [[n, list(l), h[0], h[1], h[2]] for (n, l), h in dead["histograms"].items()],
+                "gauges": {},
+            }
+            tmp = dead_path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(snapshot, f)
+            os.replace(tmp, dead_path)
+
+
+def collect():
+    total = {"counters": {}, "histograms": {}, "gauges": {}}
+    directory = _metrics_dir()
+    if directory:
+        _fold_dead_workers(directory)
+        for path in glob.glob(os.path.join(directory, "metrics-*.json")):
+            if path.endswith(f"metrics-{os.getpid()}.json"):
+                continue
+            try:
+                with open(path) as f:
+                    _merge(total, json.load(f))
+            except (OSError, ValueError):
+                # A worker may be mid-rename or just exited
+                continue
+    _merge(total, registry.snapshot())
+    return total
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+LABEL_NAMES = {
+    "http_requests_total": ("endpoint", "method", "status"),
+    "http_request_duration_seconds": ("endpoint",),
+    "db_queries_total": ("endpoint",),
+    "db_query_duration_seconds": ("endpoint",),
+    "db_queries_per_request": ("endpoint",),
+    "db_connection_acquire_seconds": (),
+    "bcrypt_duration_seconds": ("op",),
+    "bcrypt_rejected_total": ("op",),
+    "checkout_outcomes_total": ("outcome",),
+    "db_reads_total": ("target",),
+    "db_replica_ejections_total": ("replica",),
+}
+
+
+def render():
+    total = collect()
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        label_names = LABEL_NAMES[name]
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == "counter":
+            for (metric, labels), value in sorted(total["counters"].items()):
+                if metric == name:
+                    lines.append(f"{name}{_format_labels(label_names, labels)} {value}")
+        else:
+            for (metric, labels), (counts, sum_, count) in sorted(total["histograms"].items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, bucket in zip(buckets, counts):
+                    cumulative += bucket
+                    lines.append(f"{name}_bucket{_format_labels(label_names, labels, ('le', bound))} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(label_names, labels, ('le', '+Inf'))} {count}")
+                lines.append(f"{name}_sum{_format_labels(label_names, labels)} {sum_}")
+                lines.append(f"{name}_count{_format_labels(label_names, labels)} {count}")
+    for name, gauge in sorted(total["gauges"].items()):
+        lines.append(f"# HELP {name} {gauge['help']}")
+        lines.append(f"# TYPE {name} gauge")
+        for pid, value in gauge["values"]:
+            lines.append(f'{name}{{pid="{pid}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+
+def _flush_loop(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            _write_snapshot()
+        except Exception as e:
+            logger.warning("Could not write metrics snapshot: %s", e)
+
+
+_flusher_pid = None
+
+
+def start_flusher():
+    # Each worker publishes its snapshot periodically so any worker can answer a scrape
+    global _flusher_pid
+    if not _metrics_dir() or _flusher_pid == os.getpid():
+        return
+    _flusher_pid = os.getpid()
+    os.makedirs(_metrics_dir(), exist_ok=True)
+    interval = float(os.getenv('METRICS_FLUSH_INTERVAL', '5'))
+    threading.Thread(target=_flush_loop, args=(interval,), name="metrics-flush", daemon=True).start()
+
+
+@atexit.register
+def _flush_on_exit():
+    if _flusher_pid == os.getpid():
+        _write_snapshot()
+
+
+def record_query(seconds):
+    endpoint = _current_endpoint()
+    inc("db_queries_total", (endpoint,))
+    observe("db_query_duration_seconds", seconds, (endpoint,))
+    if endpoint != "background":
+        g.db_queries = g.get("db_queries", 0) + 1
+
+
+def _current_endpoint():
+    try:
+        return request.endpoint or "unmatched"
+    except RuntimeError:
+        return "background"
+
+
+def init_app(app):
+    add_query_listener(lambda statement, params, seconds: record_query(seconds))
+
+    @app.before_request
+    def start_request_metrics():
+        start_flusher()
+        g.metrics_started = time.perf_counter()
+        g.db_queries = 0
+
+    @app.after_request
+    def finish_request_metrics(response):
+        started = g.get("metrics_started")
+        if started is None:
+            return response
+        endpoint = request.endpoint or "unmatched"
+        inc("http_requests_total", (endpoint, request.method, str(response.status_code)))
+        observe("http_request_duration_seconds", time.perf_counter() - started, (endpoint,))
+        observe("db_queries_per_request", g.get("db_queries", 0), (endpoint,))
+        return response
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""Apply the versioned SQL files in migrations/ in order.
+
+    python migrate.py            # apply everything not yet applied
+    python migrate.py status     # list applied and pending versions
+    python migrate.py --dry-run  # print the pending statements without running them
+
+Files are named NNNN_description.sql and each is recorded in the
+schema_migrations table once all its statements succeed. Statements that
+only re-create something that already exists (a table, column or index
+that database_schema.sql or an interrupted run created) are skipped, so
+every migration can safely run against any existing database.
+
+MySQL commits DDL implicitly, so a migration is not atomic: if one fails
+halfway, fix it and run again, and the statements that already ran are
+skipped as above. Index changes should be written as
+``ALTER TABLE ... ADD INDEX ..., ALGORITHM=INPLACE, LOCK=NONE`` so the
+table stays readable and writable while the index builds; MySQL refuses
+the statement instead of silently locking the table if it cannot do that.
+"""
+import argparse
+import hashlib
+import os
+import re
+import sys
+
+import mysql.connector
+from dotenv import load_dotenv
+
+from db_pool import db_connect_args
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+LOCK_NAME = "ecommerce_schema_migrations"
+
+# Errors that mean the statement's change is already in place
+ALREADY_APPLIED = {
+    1050: "table exists",
+    1060: "column exists",
+    1061: "index exists",
+    1091: "already dropped",
+    1826: "foreign key exists",
+}
+
+_FILE_RE = re.compile(r"^(\d{4})_(\w+)\.sql$")
+
+
+def discover():
+    migrations = []
+    for filename in sorted(os.listdir(MIGRATIONS_DIR)):
+        match = _FILE_RE.match(filename)
+        if not match:
+            continue
+        with open(os.path.join(MIGRATIONS_DIR, filename), encoding="utf-8") as f:
+            sql = f.read()
+        migrations.append({
+            "version": int(match.group(1)),
+            "name": match.group(2),
+            "sql": sql,
+            "checksum": hashlib.sha256(sql.encode("utf-8")).hexdigest(),
+        })
+    versions = [m["version"] for m in migrations]
+    if len(versions) != len(set(versions)):
+        sys.exit("Two migration files share a version number")
+    return migrations
+
+
+def split_statements(sql):
+    # Migrations are plain DDL/DML; no procedures, so a semicolon always ends a statement
+    lines = [line for line in sql.splitlines() if not line.strip().startswith("--")]
+    return [statement.strip() for statement in "\n".join(lines).split(";") if statement.strip()]
+
+
+def ensure_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INT PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            checksum CHAR(64) NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def applied_versions(cursor):
+    cursor.execute("SELECT version, checksum, applied_at FROM schema_migrations ORDER BY version")
+    return {version: (checksum, applied_at) for version, checksum, applied_at in cursor.fetchall()}
+
+
+def apply(db, cursor, migration):
+    for statement in split_statements(migration["sql"]):
+        try:
+            cursor.execute(statement)
+        except mysql.connector.Error as e:
+            if e.errno not in ALREADY_APPLIED:
+                raise
+            print(f"    skipped ({ALREADY_APPLIED[e.errno]}): {statement.splitlines()[0][:80]}")
+    cursor.execute("INSERT INTO schema_migrations (version, name, checksum) VALUES (%s, %s, %s)",
+                   (migration["version"], migration["name"], migration["checksum"]))
+    db.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", nargs="?", default="up", choices=["up", "status"])
+    parser.add_argument("--dry-run", action="store_true", help="print pending statements without running them")
+    parser.add_argument("--lock-timeout", type=int, default=60,
+                        help="seconds to wait for another migrate run to finish")
+    args = parser.parse_args()
+
+    load_dotenv()
+    migrations = discover()
+    db = mysql.connector.connect(**db_connect_args())
+    cursor = db.cursor()
+    try:
+        # Several instances may start at once on deploy; only one of them migrates
+        cursor.execute("SELECT GET_LOCK(%s, %s)", (LOCK_NAME, args.lock_timeout))
+        if cursor.fetchone()[0] != 1:
+            sys.exit("Another migration run holds the lock")
+        ensure_table(cursor)
+        applied = applied_versions(cursor)
+
+        for migration in migrations:
+            recorded = applied.get(migration["version"])
+            if recorded and recorded[0] != migration["checksum"]:
+                print(f"warning: {migration['version']:04d}_{migration['name']}.sql changed after it was applied; "
+                      f"add a new migration instead of editing it")
+
+        pending = [m for m in migrations if m["version"] not in applied]
+        if args.command == "status":
+            for migration in migrations:
+                recorded = applied.get(migration["version"])
+                state = f"applied {recorded[1]}" if recorded else "pending"
+                print(f"{migration['version']:04d}  {migration['name']:40} {state}")
+            return
+
+        if not pending:
+            print("Schema is up to date")
+            return
+        for migration in pending:
+            print(f"{migration['version']:04d}_{migration['name']}")
+            if args.dry_run:
+                for statement in split_statements(migration["sql"]):
+                    print(f"    {statement};")
+                continue
+            apply(db, cursor, migration)
+        if not args.dry_run:
+            print(f"Applied {len(pending)} migration(s)")
+    finally:
+        cursor.execute("SELECT RELEASE_LOCK(%s)", (LOCK_NAME,))
+        cursor.fetchall()
+        cursor.close()
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,20 @@
+-- Indexes for the queries behind /products, /orders, cancel_order and the low-stock view.
+-- Each ALTER builds one index online: reads and writes continue while it runs.
+
+-- Keyset pagination for /products: one index per (filter, sort) pair, id as tie-breaker
+ALTER TABLE products ADD INDEX idx_products_category_id (category, id), ALGORITHM=INPLACE, LOCK=NONE;
+ALTER TABLE products ADD INDEX idx_products_category_price (category, price, id), ALGORITHM=INPLACE, LOCK=NONE;
+ALTER TABLE products ADD INDEX idx_products_category_name (category, name, id), ALGORITHM=INPLACE, LOCK=NONE;
+ALTER TABLE products ADD INDEX idx_products_price (price, id), ALGORITHM=INPLACE, LOCK=NONE;
+ALTER TABLE products ADD INDEX idx_products_name (name, id), ALGORITHM=INPLACE, LOCK=NONE;
+-- Low-stock view: WHERE stock <= threshold
+ALTER TABLE products ADD INDEX idx_products_stock (stock, id), ALGORITHM=INPLACE, LOCK=NONE;
+
+-- Order history pages: WHERE user_id = ? ORDER BY order_date DESC, id DESC.
+-- It also serves the user_id foreign key, so the index MySQL created for that is dropped.
+ALTER TABLE orders ADD INDEX idx_orders_user_date (user_id, order_date, id), ALGORITHM=INPLACE, LOCK=NONE;
+ALTER TABLE orders DROP INDEX user_id, ALGORITHM=INPLACE, LOCK=NONE;
+
+-- Items for a page of orders: WHERE order_id IN (...); replaces the implicit foreign key index
+ALTER TABLE order_items ADD INDEX idx_order_items_order (order_id), ALGORITHM=INPLACE, LOCK=NONE;
+ALTER TABLE order_items DROP INDEX order_id, ALGORITHM=INPLACE, LOCK=NONE;
@@ -0,0 +1,14 @@
+-- Append-only history of every stock change (see stock_ledger.py)
+
+CREATE TABLE IF NOT EXISTS stock_movements (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    product_id INT NOT NULL,
+    quantity_change INT NOT NULL,
+    movement_type VARCHAR(20) NOT NULL,
+    reason VARCHAR(255),
+    order_id INT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    -- Per-product feed pages: WHERE product_id = ? ORDER BY id DESC
+    INDEX idx_stock_movements_product (product_id, id),
+    FOREIGN KEY (product_id) REFERENCES products(id)
+);
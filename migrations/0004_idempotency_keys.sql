@@ -0,0 +1,14 @@
+-- Responses to /place_order requests sent with an Idempotency-Key (see idempotency.py)
+
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    user_id INT NOT NULL,
+    idempotency_key VARCHAR(255) NOT NULL,
+    request_hash CHAR(64) NOT NULL,
+    status_code SMALLINT NOT NULL,
+    response_body BLOB NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    expires_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (user_id, idempotency_key),
+    -- Purge of expired keys: WHERE expires_at <= NOW()
+    INDEX idx_idempotency_expires (expires_at)
+);
@@ -0,0 +1,5 @@
+-- Supplier SKU: the key catalog_tool.py import --upsert matches products on.
+-- Nullable so existing products need no backfill; UNIQUE allows any number of NULLs.
+
+ALTER TABLE products ADD COLUMN sku VARCHAR(64) NULL AFTER id, ALGORITHM=INPLACE, LOCK=NONE;
+ALTER TABLE products ADD UNIQUE INDEX idx_products_sku (sku), ALGORITHM=INPLACE, LOCK=NONE;
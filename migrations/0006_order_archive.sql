@@ -0,0 +1,20 @@
+-- Order archiving (see order_archive.py)
+
+-- Archive job scan: WHERE order_date < cutoff ORDER BY order_date, id
+ALTER TABLE orders ADD INDEX idx_orders_date (order_date, id), ALGORITHM=INPLACE, LOCK=NONE;
+
+-- Where each user's archived orders live: one row per user per segment file,
+-- pointing at the gzip member inside the file that holds that user's orders
+CREATE TABLE IF NOT EXISTS archived_order_segments (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    user_id INT NOT NULL,
+    segment VARCHAR(255) NOT NULL,
+    byte_offset BIGINT NOT NULL,
+    byte_length INT NOT NULL,
+    order_count INT NOT NULL,
+    first_order_date TIMESTAMP NOT NULL,
+    last_order_date TIMESTAMP NOT NULL,
+    archived_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    -- Archived history pages: WHERE user_id = ? ORDER BY id DESC
+    INDEX idx_archived_segments_user (user_id, id)
+);
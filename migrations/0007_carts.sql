@@ -0,0 +1,21 @@
+-- Server-side carts, written behind the cart API by cart_store.py
+
+CREATE TABLE IF NOT EXISTS carts (
+    user_id INT PRIMARY KEY,
+    -- Microsecond timestamp of the change this row reflects; a worker never overwrites a newer one
+    version BIGINT NOT NULL,
+    updated_at TIMESTAMP NOT NULL,
+    reminded_at TIMESTAMP NULL,
+    -- Abandoned-cart pass: WHERE reminded_at IS NULL AND updated_at < cutoff
+    INDEX idx_carts_abandoned (reminded_at, updated_at)
+);
+
+CREATE TABLE IF NOT EXISTS cart_items (
+    user_id INT NOT NULL,
+    product_id INT NOT NULL,
+    quantity INT NOT NULL,
+    -- Price when added, lowered after each PRICE_DROP alert
+    price_seen DECIMAL(10, 2) NOT NULL,
+    added_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id, product_id)
+);
@@ -0,0 +1,35 @@
+-- Daily sales rollups (see sales_analytics.py), kept up to date as orders are placed and cancelled
+
+CREATE TABLE IF NOT EXISTS sales_daily (
+    day DATE PRIMARY KEY,
+    orders INT NOT NULL DEFAULT 0,
+    units INT NOT NULL DEFAULT 0,
+    revenue DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    cancelled_orders INT NOT NULL DEFAULT 0,
+    cancelled_units INT NOT NULL DEFAULT 0,
+    cancelled_revenue DECIMAL(14, 2) NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS sales_daily_categories (
+    day DATE NOT NULL,
+    category VARCHAR(50) NOT NULL,
+    orders INT NOT NULL DEFAULT 0,
+    units INT NOT NULL DEFAULT 0,
+    revenue DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    cancelled_orders INT NOT NULL DEFAULT 0,
+    cancelled_units INT NOT NULL DEFAULT 0,
+    cancelled_revenue DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, category)
+);
+
+CREATE TABLE IF NOT EXISTS sales_daily_products (
+    day DATE NOT NULL,
+    product_id INT NOT NULL,
+    orders INT NOT NULL DEFAULT 0,
+    units INT NOT NULL DEFAULT 0,
+    revenue DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    cancelled_orders INT NOT NULL DEFAULT 0,
+    cancelled_units INT NOT NULL DEFAULT 0,
+    cancelled_revenue DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, product_id)
+);
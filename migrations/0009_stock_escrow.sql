@@ -0,0 +1,12 @@
+-- Stock each worker's reservation engine has taken out of products.stock (see stock_reservations.py),
+-- so the escrow of a worker that was killed can be returned by the others
+
+CREATE TABLE IF NOT EXISTS stock_escrow (
+    owner VARCHAR(100) NOT NULL,
+    product_id INT NOT NULL,
+    quantity INT NOT NULL,
+    heartbeat_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (owner, product_id),
+    -- Escrowed units per product for place_order's remaining stock
+    INDEX idx_stock_escrow_product (product_id)
+);
@@ -0,0 +1,6 @@
+-- Last change to each product, so the search index (see product_search.py) can sync
+-- new, renamed and repriced products without rebuilding
+
+ALTER TABLE products ADD COLUMN updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP AFTER created_at, ALGORITHM=INPLACE, LOCK=NONE;
+-- Search index sync: WHERE updated_at >= last sync
+ALTER TABLE products ADD INDEX idx_products_updated (updated_at), ALGORITHM=INPLACE, LOCK=NONE;
@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+"""Move old, finished orders out of MySQL into compressed NDJSON segments.
+
+    python order_archive.py run                 # archive everything past the cutoff, then exit
+    python order_archive.py run --every 3600    # keep running, one pass an hour
+    python order_archive.py partition           # print the ALTERs that partition the order tables
+    python order_archive.py partition --execute
+    python order_archive.py partitions          # add upcoming months, drop emptied old ones
+
+run moves orders older than ORDER_ARCHIVE_AFTER_DAYS whose status is one
+of ORDER_ARCHIVE_STATUSES, with their items, into gzip NDJSON files under
+ORDER_ARCHIVE_DIR. It works --batch orders at a time with a --pause in
+between. Each batch locks only its own rows, by primary key, for as long
+as it takes to write one segment. The segment is written and fsynced
+first. The rows are then deleted in the same transaction that records the
+segment in archived_order_segments, so a crash at any point either loses
+nothing or leaves a file that nothing refers to. A segment holds one gzip
+member per user, and the index row records where that member starts, so
+/orders?archived=1 reads back only the requesting user's bytes.
+
+partition converts orders and order_items to monthly RANGE partitions on
+order_date and order_items.created_at. MySQL does not allow foreign keys
+on partitioned tables, and every unique key must contain the partitioning
+column. So it drops the foreign keys between users, orders, order_items
+and products, and widens each primary key to (id, date). The conversion
+copies both tables and blocks writes to them while it runs, so it is a
+one-off step for a maintenance window and is not a migration. Afterwards
+run and partitions keep --months-ahead partitions ready past this month and
+drop old months once archiving has emptied them.
+"""
+import argparse
+import gzip
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+import mysql.connector
+import orjson
+from dotenv import load_dotenv
+
+from db_pool import db_connect_args
+
+LOCK_NAME = "ecommerce_order_archive"
+PARTITIONED_TABLES = {"orders": "order_date", "order_items": "created_at"}
+
+
+def archive_dir():
+    path = os.getenv('ORDER_ARCHIVE_DIR', 'archive')
+    if os.path.isabs(path):
+        return path
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+
+
+def archive_statuses():
+    return tuple(status.strip() for status in os.getenv('ORDER_ARCHIVE_STATUSES', 'completed,cancelled').split(",")
+                 if status.strip())
+
+
+def _encode_order(order, items):
+    return orjson.dumps({
+        "id": order["id"],
+        "user_id": order["user_id"],
+        "total_price": str(order["total_price"]),
+        "status": order["status"],
+        "created_at": order["order_date"].isoformat() if order["order_date"] else None,
+        "items": [{
+            "product_id": item["product_id"],
+            "quantity": item["quantity"],
+            "price": str(item["price_at_time"]),
+        } for item in items],
+    })
+
+
+def write_segment(name, orders, items_by_order):
+    """Write one segment file; returns its index rows, one per user.
+
+    Orders are grouped by user and each group is compressed as a separate
+    gzip member. Concatenated members are still one valid .gz file, so the
+    whole segment can be read with zcat, but a single user's member can be
+    read back on its own from (byte_offset, byte_length).
+    """
+    by_user = {}
+    for order in orders:
+        by_user.setdefault(order["user_id"], []).append(order)
+
+    path = os.path.join(archive_dir(), name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    entries = []
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        for user_id in sorted(by_user):
+            # Newest first, the order /orders returns them in
+            user_orders = sorted(by_user[user_id], key=lambda o: (o["order_date"], o["id"]), reverse=True)
+            lines = b"".join(_encode_order(order, items_by_order.get(order["id"], [])) + b"\n"
+                             for order in user_orders)
+            member = gzip.compress(lines, compresslevel=6, mtime=0)
+            entries.append({
+                "user_id": user_id,
+                "byte_offset": f.tell(),
+                "byte_length": len(member),
+                "order_count": len(user_orders),
+                "first_order_date": user_orders[-1]["order_date"],
+                "last_order_date": user_orders[0]["order_date"],
+            })
+            f.write(member)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return entries
+
+
+def read_member(segment, byte_offset, byte_length):
+    """The archived orders in one index entry, newest first, shaped like /orders rows."""
+    with open(os.path.join(archive_dir(), segment), "rb") as f:
+        f.seek(byte_offset)
+        member = f.read(byte_length)
+    if len(member) != byte_length:
+        raise OSError(f"Archive segment {segment} is truncated")
+    orders = []
+    for line in gzip.decompress(member).splitlines():
+        order = orjson.loads(line)
+        order["total_price"] = Decimal(order["total_price"])
+        for item in order["items"]:
+            item["price"] = Decimal(item["price"])
+        orders.append(order)
+    return orders
+
+
+def _placeholders(values):
+    return ", ".join(["%s"] * len(values))
+
+
+def archive_batch(db, older_than_days, batch_size, after=None):
+    """Archive the next batch of orders past ``after``; returns (archived, new after, scanned)."""
+    statuses = archive_statuses()
+    cursor = db.cursor(dictionary=True)
+    try:
+        # Candidates first, without locks: pending orders in the same range are skipped over, not locked
+        where = f"order_date < NOW() - INTERVAL %s DAY AND status IN ({_placeholders(statuses)})"
+        params = [older_than_days, *statuses]
+        if after is not None:
+            where += " AND (order_date > %s OR (order_date = %s AND id > %s))"
+            params.extend([after[0], after[0], after[1]])
+        params.append(batch_size)
+        cursor.execute(f"""
+            SELECT id, order_date FROM orders
+            WHERE {where}
+            ORDER BY order_date, id
+            LIMIT %s
+        """, params)
+        candidates = cursor.fetchall()
+        if not candidates:
+            return 0, after, 0
+        next_after = (candidates[-1]["order_date"], candidates[-1]["id"])
+        ids = [row["id"] for row in candidates]
+
+        cursor.execute("START TRANSACTION")
+        # Re-read under row locks: only what is still finished gets written out and deleted
+        cursor.execute(f"""
+            SELECT id, user_id, total_price, status, order_date FROM orders
+            WHERE id IN ({_placeholders(ids)}) AND status IN ({_placeholders(statuses)})
+            FOR UPDATE
+        """, [*ids, *statuses])
+        orders = cursor.fetchall()
+        if not orders:
+            db.rollback()
+            return 0, next_after, len(candidates)
+        ids = [order["id"] for order in orders]
+        cursor.execute(f"""
+            SELECT order_id, product_id, quantity, price_at_time FROM order_items
+            WHERE order_id IN ({_placeholders(ids)})
+            ORDER BY order_id, id
+            FOR UPDATE
+        """, ids)
+        items_by_order = {}
+        for item in cursor.fetchall():
+            items_by_order.setdefault(item["order_id"], []).append(item)
+
+        first = min(orders, key=lambda o: (o["order_date"], o["id"]))
+        name = f"{first['order_date']:%Y/%m}/orders-{min(ids)}-{max(ids)}.ndjson.gz"
+        entries = write_segment(name, orders, items_by_order)
+
+        cursor.executemany("""
+            INSERT INTO archived_order_segments
+                (user_id, segment, byte_offset, byte_length, order_count, first_order_date, last_order_date)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+        """, [(entry["user_id"], name, entry["byte_offset"], entry["byte_length"], entry["order_count"],
+               entry["first_order_date"], entry["last_order_date"]) for entry in entries])
+        cursor.execute(f"DELETE FROM order_items WHERE order_id IN ({_placeholders(ids)})", ids)
+        cursor.execute(f"DELETE FROM orders WHERE id IN ({_placeholders(ids)})", ids)
+        db.commit()
+        return len(orders), next_after, len(candidates)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def archive_orders(db, older_than_days, batch_size, pause, max_batches=None):
+    after, archived, batches = None, 0, 0
+    started = time.monotonic()
+    while max_batches is None or batches < max_batches:
+        count, after, scanned = archive_batch(db, older_than_days, batch_size, after)
+        if not scanned:
+            break
+        archived += count
+        batches += 1
+        print(f"\r  archived {archived} orders in {batches} batches", end="", flush=True)
+        if pause:
+            time.sleep(pause)
+    if batches:
+        print()
+    print(f"Archived {archived} orders older than {older_than_days} days in {time.monotonic() - started:.1f}s")
+    return archived
+
+
+def _month_start(value):
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _add_months(value, months):
+    month = value.month - 1 + months
+    return value.replace(year=value.year + month // 12, month=month % 12 + 1)
+
+
+def _partition(month):
+    # pYYYYMM holds that month: everything before the first second of the next, UTC
+    bound = int(_add_months(month, 1).timestamp())
+    return f"PARTITION p{month:%Y%m} VALUES LESS THAN ({bound})"
+
+
+def partition_info(cursor, table):
+    """[(name, upper bound as a unix timestamp or None for MAXVALUE)], or [] if not partitioned."""
+    cursor.execute("""
+        SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL
+        ORDER BY PARTITION_ORDINAL_POSITION
+    """, (table,))
+    return [(name, None if bound == "MAXVALUE" else int(bound)) for name, bound in cursor.fetchall()]
+
+
+def partition_statements(cursor, months_ahead):
+    """ALTERs that turn orders and order_items into monthly partitions, oldest data month first."""
+    now = _month_start(datetime.now(timezone.utc))
+    statements = []
+    cursor.execute("""
+        SELECT TABLE_NAME, CONSTRAINT_NAME FROM information_schema.REFERENTIAL_CONSTRAINTS
+        WHERE CONSTRAINT_SCHEMA = DATABASE()
+          AND (TABLE_NAME IN ('orders', 'order_items') OR REFERENCED_TABLE_NAME IN ('orders', 'order_items'))
+        ORDER BY TABLE_NAME = 'orders', TABLE_NAME
+    """)
+    for table, constraint in cursor.fetchall():
+        statements.append(f"ALTER TABLE {table} DROP FOREIGN KEY {constraint}")
+
+    for table, column in PARTITIONED_TABLES.items():
+        if partition_info(cursor, table):
+            continue
+        cursor.execute(f"SELECT MIN({column}) FROM {table}")
+        oldest = cursor.fetchone()[0]
+        month = _month_start(oldest.replace(tzinfo=timezone.utc)) if oldest else now
+        partitions = []
+        while month <= _add_months(now, months_ahead):
+            partitions.append(_partition(month))
+            month = _add_months(month, 1)
+        partitions.append("PARTITION p_future VALUES LESS THAN MAXVALUE")
+        statements.append(
+            f"ALTER TABLE {table}\n"
+            f"    MODIFY {column} TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,\n"
+            f"    DROP PRIMARY KEY, ADD PRIMARY KEY (id, {column})\n"
+            f"    PARTITION BY RANGE (UNIX_TIMESTAMP({column})) (\n        "
+            + ",\n        ".join(partitions) + "\n    )"
+        )
+    return statements
+
+
+def maintain_partitions(db, months_ahead, older_than_days):
+    """Split upcoming months off p_future and drop emptied months older than the archive cutoff."""
+    cursor = db.cursor()
+    try:
+        now = _month_start(datetime.now(timezone.utc))
+        cutoff = (datetime.now(timezone.utc) - timedelta(days=older_than_days)).timestamp()
+        for table in PARTITIONED_TABLES:
+            partitions = partition_info(cursor, table)
+            if not partitions:
+                continue
+            bounds = [bound for _, bound in partitions if bound is not None]
+            month = datetime.fromtimestamp(max(bounds), timezone.utc) if bounds else now
+            upcoming = []
+            while month <= _add_months(now, months_ahead):
+                upcoming.append(_partition(month))
+                month = _add_months(month, 1)
+            if upcoming:
+                # p_future is empty until the clock passes the last month, so this is a metadata change
+                cursor.execute(f"ALTER TABLE {table} REORGANIZE PARTITION p_future INTO ("
+                               + ", ".join(upcoming) + ", PARTITION p_future VALUES LESS THAN MAXVALUE)")
+                print(f"{table}: added {len(upcoming)} partition(s)")
+
+            droppable = []
+            # Never the newest bounded partition, so there is always one to reorganize into
+            for name, bound in partitions[:-2]:
+                if bound is None or bound > cutoff:
+                    break
+                cursor.execute(f"SELECT 1 FROM {table} PARTITION ({name}) LIMIT 1")
+                if cursor.fetchone() is None:
+                    droppable.append(name)
+            if droppable:
+                cursor.execute(f"ALTER TABLE {table} DROP PARTITION {', '.join(droppable)}")
+                print(f"{table}: dropped empty partition(s) {', '.join(droppable)}")
+    finally:
+        cursor.close()
+
+
+def _connect_locked():
+    db = mysql.connector.connect(**db_connect_args())
+    cursor = db.cursor()
+    # One archiver at a time; a second run exits instead of racing the first over the same rows
+    cursor.execute("SELECT GET_LOCK(%s, 0)", (LOCK_NAME,))
+    if cursor.fetchone()[0] != 1:
+        sys.exit("Another order_archive run holds the lock")
+    cursor.close()
+    return db
+
+
+def run(args):
+    db = _connect_locked()
+    try:
+        while True:
+            try:
+                archive_orders(db, args.older_than_days, args.batch, args.pause, args.max_batches)
+                # After archiving, so the months it just emptied can go in the same pass
+                maintain_partitions(db, args.months_ahead, args.older_than_days)
+            except mysql.connector.Error as e:
+                if not args.every:
+                    raise
+                print(f"pass failed, retrying in {args.every:.0f}s: {e}")
+            if not args.every:
+                return
+            time.sleep(args.every)
+    finally:
+        db.close()
+
+
+def partition(args):
+    db = _connect_locked()
+    cursor = db.cursor()
+    try:
+        statements = partition_statements(cursor, args.months_ahead)
+        if not statements:
+            print("orders and order_items are already partitioned")
+            return
+        for statement in statements:
+            print(f"{statement};")
+            if args.execute:
+                started = time.monotonic()
+                cursor.execute(statement)
+                print(f"-- done in {time.monotonic() - started:.1f}s")
+        if not args.execute:
+            print("-- not executed; rerun with --execute during a maintenance window")
+    finally:
+        cursor.close()
+        db.close()
+
+
+def partitions(args):
+    db = _connect_locked()
+    try:
+        maintain_partitions(db, args.months_ahead, args.older_than_days)
+    finally:
+        db.close()
+
+
+def main(argv=None):
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--older-than-days", type=int, default=int(os.getenv('ORDER_ARCHIVE_AFTER_DAYS', '365')),
+                        help="archive orders placed more than this many days ago")
+    parser.add_argument("--months-ahead", type=int, default=3, help="partitions to keep ready past this month")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    runner = commands.add_parser("run", help="archive old finished orders")
+    runner.add_argument("--batch", type=int, default=int(os.getenv('ORDER_ARCHIVE_BATCH', '500')),
+                        help="orders per segment and per transaction")
+    runner.add_argument("--pause", type=float, default=float(os.getenv('ORDER_ARCHIVE_PAUSE', '0.5')),
+                        help="seconds to sleep between batches")
+    runner.add_argument("--max-batches", type=int, help="stop after this many batches")
+    runner.add_argument("--every", type=float, help="repeat every this many seconds instead of exiting")
+    runner.set_defaults(handler=run)
+
+    partitioner = commands.add_parser("partition", help="convert orders and order_items to monthly partitions")
+    partitioner.add_argument("--execute", action="store_true", help="run the ALTERs instead of printing them")
+    partitioner.set_defaults(handler=partition)
+
+    maintainer = commands.add_parser("partitions", help="add upcoming partitions and drop emptied ones")
+    maintainer.set_defaults(handler=partitions)
+
+    args = parser.parse_args(argv)
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
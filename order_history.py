@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+import base64
+import json
+import os
+from datetime import datetime
+
+import order_archive
+from catalog_query import InvalidQuery
+
+DEFAULT_PAGE_SIZE = int(os.getenv('ORDERS_PAGE_SIZE', '50'))
+MAX_PAGE_SIZE = int(os.getenv('ORDERS_MAX_PAGE_SIZE', '200'))
+
+
+def encode_cursor(order):
+    raw = json.dumps([order["order_date"].isoformat(), order["id"]], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        order_date, order_id = json.loads(raw)
+        return datetime.fromisoformat(order_date), int(order_id)
+    except (ValueError, TypeError):
+        raise InvalidQuery("Invalid cursor")
+
+
+def encode_archive_cursor(entry_id, skip):
+    raw = json.dumps(["archived", entry_id, skip], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_archive_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        kind, entry_id, skip = json.loads(raw)
+        if kind != "archived":
+            raise ValueError(kind)
+        return int(entry_id), int(skip)
+    except (ValueError, TypeError):
+        raise InvalidQuery("Invalid cursor")
+
+
+def parse_history_args(args, archived=False):
+    try:
+        limit = int(args.get("limit") or DEFAULT_PAGE_SIZE)
+    except ValueError:
+        raise InvalidQuery("limit must be an integer")
+    if limit < 1:
+        raise InvalidQuery("limit must be positive")
+    decode = decode_archive_cursor if archived else decode_cursor
+    after = decode(args["cursor"]) if args.get("cursor") else None
+    return min(limit, MAX_PAGE_SIZE), after
+
+
+def fetch_order_history(cursor, user_id, limit, after=None):
+    """Return one page of a user's orders (newest first) and the next cursor.
+
+    Two queries per page no matter how many orders it holds: the page of
+    orders by (order_date, id), then all of their items in one IN-list.
+    """
+    where = "user_id = %s"
+    params = [user_id]
+    if after is not None:
+        where += " AND (order_date < %s OR (order_date = %s AND id < %s))"
+        params.extend([after[0], after[0], after[1]])
+    params.append(limit + 1)
+
+    cursor.execute(f"""
+        SELECT id, total_price, status, order_date
+        FROM orders
+        WHERE {where}
+        ORDER BY order_date DESC, id DESC
+        LIMIT %s
+    """, params)
+    orders = cursor.fetchall()
+
+    next_cursor = None
+    if len(orders) > limit:
+        orders = orders[:limit]
+        next_cursor = encode_cursor(orders[-1])
+
+    items_by_order = {order["id"]: [] for order in orders}
+    if orders:
+        placeholders = ", ".join(["%s"] * len(orders))
+        cursor.execute(f"""
+            SELECT order_id, product_id, quantity, price_at_time
+            FROM order_items
+            WHERE order_id IN ({placeholders})
+            ORDER BY order_id, id
+        """, list(items_by_order))
+        for item in cursor.fetchall():
+            items_by_order[item["order_id"]].append({
+                "product_id": item["product_id"],
+                "quantity": item["quantity"],
+                "price": item["price_at_time"]
+            })
+
+    formatted_orders = []
+    for order in orders:
+        formatted_orders.append({
+            "id": order["id"],
+            "user_id": user_id,
+            "total_price": order["total_price"],
+            "status": order["status"],
+            "created_at": order["order_date"].isoformat() if order["order_date"] else None,
+            "items": items_by_order[order["id"]]
+        })
+    return formatted_orders, next_cursor
+
+
+def iter_order_history(cursor, user_id, page_size=500):
+    # Every order a user has, one keyset page at a time, for streamed responses
+    after = None
+    while True:
+        orders, next_cursor = fetch_order_history(cursor, user_id, page_size, after)
+        yield orders
+        if next_cursor is None:
+            return
+        after = decode_cursor(next_cursor)
+
+
+def fetch_archived_history(cursor, user_id, limit, after=None):
+    """Return one page of a user's archived orders (newest first) and the next cursor.
+
+    One query for the user's archive index entries, then only the gzip
+    members the page needs are read from the segment files. The cursor is
+    (entry id, orders of that entry already returned).
+    """
+    where = "user_id = %s"
+    params = [user_id]
+    if after is not None:
+        where += " AND id <= %s"
+        params.append(after[0])
+    # Every entry holds at least one order, so limit + 1 entries always fill the page and show whether more follow
+    params.append(limit + 1)
+    cursor.execute(f"""
+        SELECT id, segment, byte_offset, byte_length
+        FROM archived_order_segments
+        WHERE {where}
+        ORDER BY id DESC
+        LIMIT %s
+    """, params)
+    entries = cursor.fetchall()
+
+    page = []
+    for position, entry in enumerate(entries):
+        skip = after[1] if after is not None and entry["id"] == after[0] else 0
+        orders = order_archive.read_member(entry["segment"], entry["byte_offset"], entry["byte_length"])[skip:]
+        room = limit - len(page)
+        if len(orders) > room:
+            page.extend(orders[:room])
+            return page, encode_archive_cursor(entry["id"], skip + room)
+        page.extend(orders)
+        if len(page) == limit:
+            following = entries[position + 1:]
+            return page, encode_archive_cursor(following[0]["id"], 0) if following else None
+    return page, None
+
+
+def iter_archived_history(cursor, user_id, page_size=500):
+    after = None
+    while True:
+        orders, next_cursor = fetch_archived_history(cursor, user_id, page_size, after)
+        yield orders
+        if next_cursor is None:
+            return
+        after = decode_archive_cursor(next_cursor)
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+import bcrypt
+
+import metrics
+
+
+class HashingBusy(Exception):
+    pass
+
+
+class PasswordHasher:
+    """Runs bcrypt on a small dedicated thread pool with admission control.
+
+    bcrypt releases the GIL while hashing, so a few threads keep the CPUs
+    busy without starving request threads. At most ``workers + max_queue``
+    jobs are admitted; anything beyond that fails fast with HashingBusy
+    instead of piling up behind a login storm.
+    """
+
+    def __init__(self, workers=2, max_queue=8, rounds=12, timeout=10.0):
+        self.rounds = rounds
+        self.timeout = timeout
+        self.pid = os.getpid()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self._slots = threading.BoundedSemaphore(workers + max_queue)
+
+    def _run(self, op, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            metrics.inc("bcrypt_rejected_total", (op,))
+            raise HashingBusy("Too many password operations in progress")
+        started = time.perf_counter()
+        try:
+            future = self._executor.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(self.timeout)
+        except FutureTimeout:
+            metrics.inc("bcrypt_rejected_total", (op,))
+            raise HashingBusy("Timed out waiting for a password worker")
+        finally:
+            metrics.observe("bcrypt_duration_seconds", time.perf_counter() - started, (op,))
+
+    def hash(self, password):
+        hashed = self._run("hash", bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt(self.rounds))
+        return hashed.decode('utf-8')
+
+    def verify(self, password, hashed):
+        return self._run("verify", bcrypt.checkpw, password.encode('utf-8'), hashed.encode('utf-8'))
+
+    def needs_rehash(self, hashed):
+        # Hashes look like $2b$12$<salt+digest>; the second field is the cost factor
+        try:
+            return int(hashed.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+
+_hasher = None
+_hasher_lock = threading.Lock()
+
+
+def get_hasher():
+    global _hasher
+    with _hasher_lock:
+        if _hasher is None or _hasher.pid != os.getpid():
+            _hasher = PasswordHasher(
+                workers=int(os.getenv('BCRYPT_WORKERS', str(os.cpu_count() or 2))),
+                max_queue=int(os.getenv('BCRYPT_MAX_QUEUE', '16')),
+                rounds=int(os.getenv('BCRYPT_ROUNDS', '12')),
+                timeout=float(os.getenv('BCRYPT_TIMEOUT', '10')),
+            )
+        return _hasher
@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+import bisect
+import heapq
+import logging
+import math
+import os
+import re
+import threading
+import time
+import unicodedata
+
+from catalog_query import InvalidQuery, PRODUCT_COLUMNS, SELLABLE_STOCK, parse_price
+from db_pool import get_pool
+from stock_ledger import changed_products, last_movement_id
+
+logger = logging.getLogger(__name__)
+
+MAX_RESULTS = int(os.getenv('SEARCH_MAX_RESULTS', '100'))
+
+# Where a term appears decides how much a match is worth
+FIELD_WEIGHTS = (("name", 3.0), ("category", 2.0), ("description", 1.0))
+PREFIX_FACTOR = 0.8
+FUZZY_FACTOR = 0.6
+MAX_PREFIX_TERMS = 50
+MIN_SIMILARITY = 0.35
+# Bounds on one query's work: the walk over token matches grows with the product of their counts
+MAX_QUERY_TOKENS = 8
+MAX_COMBINATIONS = 200
+# Rows whose updated_at is this close to the last sync are read again, in case their transaction
+# committed after that sync had already looked
+UPDATED_LOOKBACK_SECONDS = 5
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    if not text:
+        return []
+    # Fold accents so "café" matches "cafe"
+    folded = unicodedata.normalize("NFKD", text.lower())
+    folded = "".join(ch for ch in folded if not unicodedata.combining(ch))
+    return _TOKEN_RE.findall(folded)
+
+
+def trigrams(term):
+    padded = f"  {term} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def parse_search_args(args):
+    query = (args.get("q") or "").strip()
+    if not query:
+        raise InvalidQuery("q is required")
+    if len(set(tokenize(query))) > MAX_QUERY_TOKENS:
+        raise InvalidQuery(f"q must have at most {MAX_QUERY_TOKENS} words")
+    try:
+        limit = int(args.get("limit") or 20)
+    except ValueError:
+        raise InvalidQuery("limit must be an integer")
+    if limit < 1:
+        raise InvalidQuery("limit must be positive")
+    return {
+        "q": query,
+        "category": args.get("category") or None,
+        "min_price": parse_price(args.get("min_price"), "min_price"),
+        "max_price": parse_price(args.get("max_price"), "max_price"),
+        "limit": min(limit, MAX_RESULTS),
+    }
+
+
+class SearchIndex:
+    """Process-local inverted index over product name, category and description.
+
+    Each query token matches exact terms, then (for the token still being
+    typed) up to MAX_PREFIX_TERMS terms that start with it, and when neither
+    exists, terms that share enough trigrams with it to be a likely typo.
+    Every token must match for a product to be returned. Scores are
+    field-weighted and idf-scaled. Filters are applied only to the matching
+    candidates, so the catalog is never scanned. Queries are cut to
+    MAX_QUERY_TOKENS words and the walk over their matches to
+    MAX_COMBINATIONS steps, outside the index lock.
+
+    upsert() and remove() keep the index current with this worker's
+    changes. Every ``sync_interval`` seconds a background thread pulls
+    stock changes made by other workers from the stock ledger, and new or
+    edited products (a catalog import, a price change) by their
+    updated_at. A full rebuild every ``rebuild_interval`` seconds, on the
+    same thread, drops deleted products. Requests never wait for either;
+    only the very first build, when there is nothing to serve yet, runs
+    on a request.
+    """
+
+    def __init__(self, sync_interval=5.0, rebuild_interval=600.0):
+        self.sync_interval = sync_interval
+        self.rebuild_interval = rebuild_interval
+        self.pid = os.getpid()
+        self._lock = threading.RLock()
+        self._refresh_lock = threading.Lock()
+        self._docs = {}
+        self._doc_terms = {}
+        self._postings = {}
+        self._vocabulary = []
+        self._trigrams = {}
+        self._bulk = False
+        self._built_at = None
+        self._synced_at = 0.0
+        self._last_movement_id = 0
+        self._recent_movements = set()
+        self._updated_after = None
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def __len__(self):
+        return len(self._docs)
+
+    def _add_term(self, term):
+        if self._bulk:
+            # Sorted once at the end of a full build instead of on every insert
+            self._vocabulary.append(term)
+        else:
+            bisect.insort(self._vocabulary, term)
+        for gram in trigrams(term):
+            self._trigrams.setdefault(gram, set()).add(term)
+
+    def _drop_term(self, term):
+        del self._postings[term]
+        index = bisect.bisect_left(self._vocabulary, term)
+        if index < len(self._vocabulary) and self._vocabulary[index] == term:
+            del self._vocabulary[index]
+        for gram in trigrams(term):
+            terms = self._trigrams.get(gram)
+            if terms is not None:
+                terms.discard(term)
+                if not terms:
+                    del self._trigrams[gram]
+
+    def _unindex(self, product_id):
+        for term, weight in self._doc_terms.pop(product_id, {}).items():
+            tiers = self._postings.get(term)
+            if tiers is None:
+                continue
+            tier = tiers.get(weight)
+            if tier is not None:
+                tier = tier - {product_id}
+                if tier:
+                    tiers[weight] = tier
+                else:
+                    del tiers[weight]
+            if not tiers:
+                self._drop_term(term)
+
+    def upsert(self, product):
+        weights = {}
+        for field, weight in FIELD_WEIGHTS:
+            for term in tokenize(product.get(field)):
+                weights[term] = max(weights.get(term, 0.0), weight)
+        with self._lock:
+            self._unindex(product["id"])
+            self._docs[product["id"]] = product
+            self._doc_terms[product["id"]] = weights
+            for term, weight in weights.items():
+                tiers = self._postings.get(term)
+                if tiers is None:
+                    tiers = self._postings[term] = {}
+                    self._add_term(term)
+                if self._bulk:
+                    tiers.setdefault(weight, set()).add(product["id"])
+                else:
+                    # Replaced, never changed in place: a search may be walking the old set
+                    tiers[weight] = tiers.get(weight, frozenset()) | {product["id"]}
+
+    def remove(self, product_id):
+        with self._lock:
+            self._unindex(product_id)
+            self._docs.pop(product_id, None)
+
+    def get(self, product_id):
+        return self._docs.get(product_id)
+
+    def _apply(self, product):
+        current = self._docs.get(product["id"])
+        if current is not None and all(current.get(field) == product.get(field) for field, _ in FIELD_WEIGHTS):
+            # Only price, stock or image changed: nothing to re-tokenize
+            with self._lock:
+                self._docs[product["id"]] = product
+        else:
+            self.upsert(product)
+
+    def update_stock(self, product_id, stock):
+        # Stock is only a filter, so there is nothing to re-tokenize
+        with self._lock:
+            product = self._docs.get(product_id)
+            if product is not None:
+                self._docs[product_id] = dict(product, stock=stock)
+
+    def _rebuild(self, cursor):
+        started = time.perf_counter()
+        last_id = last_movement_id(cursor)
+        updated_after = _database_now(cursor)
+        cursor.execute(f"SELECT {PRODUCT_COLUMNS} FROM products")
+        rows = cursor.fetchall()
+        # Build a fresh index off to the side and swap it in, so searches keep working meanwhile
+        fresh = SearchIndex(self.sync_interval, self.rebuild_interval)
+        fresh._bulk = True
+        for row in rows:
+            fresh.upsert(row)
+        fresh._vocabulary.sort()
+        with self._lock:
+            self._docs, self._doc_terms, self._postings = fresh._docs, fresh._doc_terms, fresh._postings
+            self._vocabulary, self._trigrams = fresh._vocabulary, fresh._trigrams
+        self._last_movement_id = last_id
+        self._recent_movements = set()
+        self._updated_after = updated_after
+        self._built_at = self._synced_at = time.monotonic()
+        logger.info("Search index built: %s products, %s terms in %.0f ms",
+                    len(rows), len(fresh._postings), (time.perf_counter() - started) * 1000)
+
+    def _sync(self, cursor):
+        changed, self._last_movement_id, self._recent_movements = changed_products(
+            cursor, self._last_movement_id, self._recent_movements)
+        updated_after = _database_now(cursor)
+        cursor.execute(f"""
+            SELECT {PRODUCT_COLUMNS} FROM products
+            WHERE updated_at >= %s - INTERVAL %s SECOND
+        """, (self._updated_after, UPDATED_LOOKBACK_SECONDS))
+        edited = cursor.fetchall()
+        for row in edited:
+            self._apply(row)
+        self._updated_after = updated_after
+        self._synced_at = time.monotonic()
+
+        changed = sorted(set(changed) - {row["id"] for row in edited})
+        if not changed:
+            return
+        placeholders = ", ".join(["%s"] * len(changed))
+        cursor.execute(f"SELECT id, {SELLABLE_STOCK} AS stock FROM products WHERE id IN ({placeholders})", changed)
+        for row in cursor.fetchall():
+            self.update_stock(row["id"], row["stock"])
+
+    def built(self):
+        return self._built_at is not None
+
+    def ensure_built(self, cursor):
+        # Concurrent first requests wait for one build rather than each running their own
+        with self._refresh_lock:
+            if self._built_at is None:
+                self._rebuild(cursor)
+
+    def refresh(self, cursor):
+        with self._refresh_lock:
+            now = time.monotonic()
+            if self._built_at is None or now - self._built_at >= self.rebuild_interval:
+                self._rebuild(cursor)
+            elif now - self._synced_at >= self.sync_interval:
+                self._sync(cursor)
+
+    def start(self):
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="search-index-refresher", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.sync_interval):
+            try:
+                db = get_pool().acquire()
+                cursor = db.cursor(dictionary=True)
+                try:
+                    self.refresh(cursor)
+                finally:
+                    cursor.close()
+                    db.close()
+            except Exception as e:
+                # The index keeps serving its last copy; the next pass retries
+                logger.error("Failed to refresh search index: %s", e)
+
+    def _expand(self, token, is_last):
+        """Map a query token to {term: factor} over the indexed vocabulary."""
+        matches = {}
+        if token in self._postings:
+            matches[token] = 1.0
+        if is_last:
+            start = bisect.bisect_left(self._vocabulary, token)
+            for term in self._vocabulary[start:start + MAX_PREFIX_TERMS + 1]:
+                if not term.startswith(token):
+                    break
+                matches.setdefault(term, PREFIX_FACTOR)
+        if matches or len(token) < 3:
+            return matches
+
+        grams = trigrams(token)
+        shared = {}
+        for gram in grams:
+            for term in self._trigrams.get(gram, ()):
+                shared[term] = shared.get(term, 0) + 1
+        for term, count in shared.items():
+            similarity = count / (len(grams) + len(trigrams(term)) - count)
+            if similarity >= MIN_SIMILARITY:
+                matches[term] = FUZZY_FACTOR * similarity
+        return matches
+
+    def _groups(self, token, is_last, total):
+        """[(score, product ids)] for one query token, best first.
+
+        Postings are split by field weight, so every product in a group
+        scores the same for this token and its best score is that of the
+        first group it appears in. Writers replace id sets rather than
+        change them, so the caller can use them without holding the lock.
+        """
+        groups = []
+        for term, factor in self._expand(token, is_last).items():
+            tiers = self._postings[term]
+            idf = math.log(1 + total / sum(len(tier) for tier in tiers.values()))
+            for weight, product_ids in tiers.items():
+                groups.append((weight * factor * idf, product_ids))
+        groups.sort(key=lambda group: group[0], reverse=True)
+        return groups
+
+    def _accepts(self, product, category, min_price, max_price):
+        if product["stock"] <= 0:
+            return False
+        if category and (product.get("category") or "").lower() != category:
+            return False
+        if min_price is not None and product["price"] < min_price:
+            return False
+        if max_price is not None and product["price"] > max_price:
+            return False
+        return True
+
+    def search(self, query, category=None, min_price=None, max_price=None, limit=20):
+        tokens = list(dict.fromkeys(tokenize(query)))[:MAX_QUERY_TOKENS]
+        if not tokens:
+            return []
+        category = category.lower() if category else None
+        # Only picking the matching postings holds the lock; writers don't wait for the walk
+        with self._lock:
+            total = max(len(self._docs), 1)
+            groups = [self._groups(token, i == len(tokens) - 1, total) for i, token in enumerate(tokens)]
+        if not all(groups):
+            return []
+        docs = self._docs
+
+        # Visit combinations of one group per token in order of total score. A product
+        # first shows up in its best combination, so the walk can stop once the page is
+        # full and the next combination scores lower than the last hit. When filters
+        # reject most matches it stops after MAX_COMBINATIONS with what it has.
+        first = (0,) * len(groups)
+        heap = [(-sum(token_groups[0][0] for token_groups in groups), first)]
+        queued = {first}
+        results, seen = [], set()
+        visited = 0
+        while heap and visited < MAX_COMBINATIONS:
+            negative, combination = heapq.heappop(heap)
+            visited += 1
+            score = -negative
+            if len(results) >= limit and score < results[-1][0]:
+                break
+            sets = sorted((groups[t][i][1] for t, i in enumerate(combination)), key=len)
+            matched = sets[0].intersection(*sets[1:]) - seen
+            seen |= matched
+            # Same score throughout, so newest first and only as many as the page still needs
+            for pid in sorted(matched, reverse=True):
+                if len(results) >= limit:
+                    break
+                product = docs.get(pid)
+                if product is not None and self._accepts(product, category, min_price, max_price):
+                    results.append((score, product))
+            for t, i in enumerate(combination):
+                if i + 1 < len(groups[t]):
+                    successor = combination[:t] + (i + 1,) + combination[t + 1:]
+                    if successor not in queued:
+                        queued.add(successor)
+                        successor_score = score - groups[t][i][0] + groups[t][i + 1][0]
+                        heapq.heappush(heap, (-successor_score, successor))
+        return [product for _, product in results[:limit]]
+
+
+def _database_now(cursor):
+    # The database's clock, the one updated_at is set by
+    cursor.execute("SELECT NOW() AS now")
+    return cursor.fetchone()["now"]
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_search_index():
+    global _index
+    with _index_lock:
+        if _index is None or _index.pid != os.getpid():
+            _index = SearchIndex(
+                sync_interval=float(os.getenv('SEARCH_SYNC_INTERVAL', '5')),
+                rebuild_interval=float(os.getenv('SEARCH_REBUILD_INTERVAL', '600')),
+            )
+        return _index
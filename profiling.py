@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+"""On-demand request profiles and a slow-query log.
+
+A request is profiled when it carries a valid X-Debug-Profile header, or
+at random for PROFILE_SAMPLE_RATE of all requests. The header value is
+``<expiry unix time>.<hex HMAC-SHA256 of the expiry under PROFILE_SECRET>``;
+print one with
+
+    python profiling.py sign --ttl 600
+
+Profiled responses carry an X-Profile-Id header. Download the profile from
+/admin/profiles/<id>, or with ?format=folded as collapsed stacks for
+flamegraph.pl or speedscope.
+"""
+import argparse
+import collections
+import hashlib
+import hmac
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from datetime import date, datetime
+from decimal import Decimal
+
+from flask import g, request
+
+from db_pool import add_query_listener, get_pool
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = "X-Debug-Profile"
+EXPLAINABLE = ("SELECT", "UPDATE", "DELETE", "INSERT", "REPLACE")
+
+
+def sign_token(secret, expires):
+    expires = str(int(expires))
+    digest = hmac.new(secret.encode("utf-8"), expires.encode("ascii"), hashlib.sha256).hexdigest()
+    return f"{expires}.{digest}"
+
+
+def verify_token(secret, value, max_ttl=3600):
+    # Valid only until its expiry, and never for more than max_ttl from now, so a leaked header ages out
+    expires, _, digest = (value or "").partition(".")
+    if not secret or not expires.isdigit():
+        return False
+    expected = sign_token(secret, expires).partition(".")[2]
+    now = time.time()
+    return hmac.compare_digest(digest, expected) and now < int(expires) <= now + max_ttl
+
+
+def _current_route():
+    try:
+        return request.endpoint or "unmatched"
+    except RuntimeError:
+        return "background"
+
+
+def _shape(value):
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, (str, bytes, bytearray)):
+        return f"{type(value).__name__}({len(value)})"
+    if isinstance(value, (list, tuple, set)):
+        return f"list({len(value)})"
+    if isinstance(value, Decimal):
+        return "decimal"
+    if isinstance(value, datetime):
+        return "datetime"
+    if isinstance(value, date):
+        return "date"
+    return type(value).__name__
+
+
+def params_shape(params):
+    """Types and lengths of a statement's parameters, never their values; runs of one type are folded."""
+    if params is None:
+        return None
+    if isinstance(params, dict):
+        return {key: _shape(value) for key, value in params.items()}
+    shape = []
+    for value in params:
+        kind = _shape(value)
+        if shape and shape[-1][0] == kind:
+            shape[-1][1] += 1
+        else:
+            shape.append([kind, 1])
+    return [kind if count == 1 else f"{kind}*{count}" for kind, count in shape]
+
+
+def normalize(statement):
+    if isinstance(statement, (bytes, bytearray)):
+        statement = statement.decode("utf-8", "replace")
+    statement = re.sub(r"\s+", " ", statement).strip()
+    # One IN-list of any length is the same statement
+    return re.sub(r"%s(?:, %s)+", "%s, ...", statement)
+
+
+class StackSampler:
+    """Samples the stacks of the threads being profiled every ``interval`` seconds.
+
+    One daemon thread per worker, and it only runs while at least one
+    request is being profiled. Samples are kept as collapsed stacks
+    ("outer;inner;leaf" -> count).
+    """
+
+    def __init__(self, interval=0.005, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self._lock = threading.Lock()
+        self._active = {}
+        self._wake = threading.Event()
+        self._thread = None
+
+    def begin(self, thread_id):
+        with self._lock:
+            self._active[thread_id] = collections.Counter()
+            # Threads don't survive a fork, so a worker starts its own
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+                self._thread.start()
+            self._wake.set()
+
+    def end(self, thread_id):
+        with self._lock:
+            return self._active.pop(thread_id, collections.Counter())
+
+    def _collapse(self, frame):
+        names = []
+        while frame is not None and len(names) < self.max_depth:
+            code = frame.f_code
+            names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            with self._lock:
+                thread_ids = list(self._active)
+                # Under the lock, so a begin() between the check and the clear can't lose its wake-up
+                if not thread_ids:
+                    self._wake.clear()
+            if not thread_ids:
+                continue
+            frames = sys._current_frames()
+            stacks = {thread_id: self._collapse(frames[thread_id]) for thread_id in thread_ids if thread_id in frames}
+            with self._lock:
+                for thread_id, stack in stacks.items():
+                    counter = self._active.get(thread_id)
+                    if counter is not None:
+                        counter[stack] += 1
+            time.sleep(self.interval)
+
+
+class ProfileStore:
+    """The last ``capacity`` profiles.
+
+    In memory by default, so each worker only lists its own. With a
+    ``directory`` (PROFILE_DIR) every worker writes its profiles there and
+    serves everyone's; the oldest files beyond ``capacity`` are removed.
+    """
+
+    def __init__(self, capacity=50, directory=None):
+        self.capacity = capacity
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._profiles = collections.OrderedDict()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def add(self, profile):
+        if not self.directory:
+            with self._lock:
+                self._profiles[profile["id"]] = profile
+                while len(self._profiles) > self.capacity:
+                    self._profiles.popitem(last=False)
+            return
+        path = os.path.join(self.directory, f"profile-{profile['id']}.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(profile, f, default=str)
+        os.replace(path + ".tmp", path)
+        files = sorted((entry for entry in os.scandir(self.directory) if entry.name.startswith("profile-")
+                        and entry.name.endswith(".json")), key=lambda entry: entry.stat().st_mtime)
+        for entry in files[:-self.capacity]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+    def get(self, profile_id):
+        if not re.fullmatch(r"[0-9a-f]{32}", profile_id or ""):
+            return None
+        if not self.directory:
+            with self._lock:
+                return self._profiles.get(profile_id)
+        try:
+            with open(os.path.join(self.directory, f"profile-{profile_id}.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def summaries(self):
+        if not self.directory:
+            with self._lock:
+                profiles = list(self._profiles.values())
+        else:
+            profiles = []
+            for entry in os.scandir(self.directory):
+                if entry.name.startswith("profile-") and entry.name.endswith(".json"):
+                    profile = self.get(entry.name[8:-5])
+                    if profile is not None:
+                        profiles.append(profile)
+        summaries = [{key: value for key, value in profile.items() if key not in ("stacks", "queries")}
+                     for profile in profiles]
+        return sorted(summaries, key=lambda summary: summary["started_at"], reverse=True)
+
+
+class SlowQueryLog:
+    """Ring buffer of statements that took at least ``threshold`` seconds.
+
+    Each entry has the normalized statement, its parameters' shape, the
+    route that issued it and, once the background thread has run it, its
+    EXPLAIN plan. EXPLAIN runs on a separate pooled connection, because
+    the original one still has the statement's results to read. Plans are
+    cached per statement for ``explain_ttl`` seconds, and the EXPLAIN
+    queue is bounded, so a burst of slow queries costs a few EXPLAINs.
+    """
+
+    def __init__(self, threshold=0.2, capacity=200, explain_ttl=300.0):
+        self.threshold = threshold
+        self.explain_ttl = explain_ttl
+        self._lock = threading.Lock()
+        self._entries = collections.deque(maxlen=capacity)
+        self._plans = {}
+        self._explain_queue = queue.Queue(maxsize=100)
+        self._thread = None
+
+    def record(self, statement, params, seconds):
+        if seconds < self.threshold:
+            return
+        sql = normalize(statement)
+        if sql.upper().startswith("EXPLAIN"):
+            return
+        route = _current_route()
+        entry = {
+            "at": time.time(),
+            "seconds": round(seconds, 6),
+            "route": route,
+            "request_id": g.get("request_id") if route != "background" else None,
+            "statement": sql[:4000],
+            "params": params_shape(params),
+            "plan": None,
+        }
+        with self._lock:
+            self._entries.append(entry)
+            cached = self._plans.get(sql)
+        logger.warning("Slow query (%.3fs) in %s: %s", seconds, entry["route"], entry["statement"][:500])
+        if cached is not None and time.monotonic() - cached[0] < self.explain_ttl:
+            entry["plan"] = cached[1]
+        elif sql.upper().startswith(EXPLAINABLE):
+            self._start()
+            try:
+                self._explain_queue.put_nowait((entry, statement, params))
+            except queue.Full:
+                entry["plan"] = "skipped: EXPLAIN queue full"
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="slow-query-explain", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            entry, statement, params = self._explain_queue.get()
+            sql = normalize(statement)
+            with self._lock:
+                cached = self._plans.get(sql)
+            if cached is not None and time.monotonic() - cached[0] < self.explain_ttl:
+                entry["plan"] = cached[1]
+                continue
+            try:
+                conn = get_pool().acquire(timeout=1.0)
+                cursor = conn.cursor(dictionary=True)
+                try:
+                    cursor.execute(f"EXPLAIN {statement}", params)
+                    plan = cursor.fetchall()
+                    conn.rollback()
+                finally:
+                    cursor.close()
+                    conn.close()
+            except Exception as e:
+                entry["plan"] = f"EXPLAIN failed: {e}"
+                continue
+            entry["plan"] = plan
+            with self._lock:
+                self._plans[sql] = (time.monotonic(), plan)
+                if len(self._plans) > 1000:
+                    self._plans.clear()
+
+    def entries(self):
+        with self._lock:
+            return list(reversed(self._entries))
+
+
+profiles = ProfileStore(
+    capacity=int(os.getenv('PROFILE_BUFFER_SIZE', '50')),
+    directory=os.getenv('PROFILE_DIR') or None,
+)
+sampler = StackSampler(interval=float(os.getenv('PROFILE_SAMPLE_INTERVAL', '0.005')))
+slow_queries = SlowQueryLog(
+    threshold=float(os.getenv('SLOW_QUERY_SECONDS', '0.2')),
+    capacity=int(os.getenv('SLOW_QUERY_LOG_SIZE', '200')),
+)
+
+
+def _should_profile():
+    if verify_token(os.getenv('PROFILE_SECRET'), request.headers.get(PROFILE_HEADER)):
+        return "header"
+    rate = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+    if rate > 0 and random.random() < rate:
+        return "sampled"
+    return None
+
+
+def _record_profile_query(statement, params, seconds):
+    try:
+        queries = g.get("profile_queries")
+    except RuntimeError:
+        return
+    if queries is not None and len(queries) < 1000:
+        queries.append({"statement": normalize(statement)[:1000], "seconds": round(seconds, 6)})
+
+
+def init_app(app):
+    add_query_listener(slow_queries.record)
+    add_query_listener(_record_profile_query)
+
+    @app.before_request
+    def start_profile():
+        trigger = _should_profile()
+        if trigger is None:
+            return
+        g.profile = {
+            "id": uuid.uuid4().hex,
+            "trigger": trigger,
+            "method": request.method,
+            "path": request.full_path.rstrip("?"),
+            "pid": os.getpid(),
+            "started_at": time.time(),
+            "perf_started": time.perf_counter(),
+            "thread_id": threading.get_ident(),
+        }
+        g.profile_queries = []
+        sampler.begin(g.profile["thread_id"])
+
+    @app.after_request
+    def finish_profile(response):
+        profile = g.pop("profile", None)
+        if profile is None:
+            return response
+        profile.update(route=request.endpoint or "unmatched", status=response.status_code,
+                       request_id=g.get("request_id"), queries=g.pop("profile_queries", []))
+        response.headers["X-Profile-Id"] = profile["id"]
+
+        # Streamed bodies are generated after this hook, so sampling stops when the response is closed
+        def close():
+            stacks = sampler.end(profile["thread_id"])
+            profile["duration_ms"] = round((time.perf_counter() - profile.pop("perf_started")) * 1000, 2)
+            profile["samples"] = sum(stacks.values())
+            profile["sample_interval"] = sampler.interval
+            profile["stacks"] = dict(stacks.most_common())
+            try:
+                profiles.add(profile)
+            except OSError as e:
+                logger.warning("Could not store profile %s: %s", profile["id"], e)
+        response.call_on_close(close)
+        return response
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Print an X-Debug-Profile header value")
+    commands = parser.add_subparsers(dest="command", required=True)
+    signer = commands.add_parser("sign", help="sign a header that is valid for --ttl seconds")
+    signer.add_argument("--ttl", type=int, default=600)
+    args = parser.parse_args(argv)
+
+    secret = os.getenv('PROFILE_SECRET')
+    if not secret:
+        sys.exit("Set PROFILE_SECRET to the value the app runs with")
+    print(f"{PROFILE_HEADER}: {sign_token(secret, time.time() + args.ttl)}")
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+    main()
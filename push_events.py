@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class EventPublisher:
+    """Forwards events to the push gateway from a background thread.
+
+    publish() only appends to a bounded in-memory queue, so a slow or
+    missing gateway never delays a request; when the queue is full the
+    event is dropped and counted. Push notifications are best effort.
+    """
+
+    def __init__(self, host, port, queue_size=10000, reconnect_delay=1.0):
+        self.host = host
+        self.port = port
+        self.reconnect_delay = reconnect_delay
+        self.pid = os.getpid()
+        self.dropped = 0
+        self.sent = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._sock = None
+        self._thread = threading.Thread(target=self._run, name="push-publisher", daemon=True)
+        self._thread.start()
+
+    def publish(self, topic, event_type, payload):
+        try:
+            self._queue.put_nowait({"topic": topic, "type": event_type, "payload": payload})
+        except queue.Full:
+            self.dropped += 1
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=5)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            # Coalesce whatever else is already waiting into one write
+            while len(batch) < 500:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            data = "".join(json.dumps(event, default=str) + "\n" for event in batch).encode("utf-8")
+            try:
+                if self._sock is None:
+                    self._sock = self._connect()
+                self._sock.sendall(data)
+                self.sent += len(batch)
+            except OSError as e:
+                logger.warning("Push gateway unavailable, dropped %s events: %s", len(batch), e)
+                self.dropped += len(batch)
+                if self._sock is not None:
+                    self._sock.close()
+                    self._sock = None
+                time.sleep(self.reconnect_delay)
+
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+
+def get_publisher():
+    global _publisher
+    if os.getenv('PUSH_ENABLED', 'false').lower() != 'true':
+        return None
+    with _publisher_lock:
+        if _publisher is None or _publisher.pid != os.getpid():
+            _publisher = EventPublisher(os.getenv('PUSH_PUBLISH_HOST', '127.0.0.1'),
+                                        int(os.getenv('PUSH_PUBLISH_PORT', '5002')))
+        return _publisher
+
+
+def publish(topic, event_type, payload):
+    publisher = get_publisher()
+    if publisher is not None:
+        publisher.publish(topic, event_type, payload)
+
+
+def order_status_changed(user_id, order_id, status):
+    publish(f"user:{user_id}", "ORDER_STATUS_UPDATE", {"orderId": order_id, "status": status})
+
+
+def stock_changed(remaining):
+    # remaining: {product_id: {"name": ..., "stock": ...}} after a committed change
+    threshold = int(os.getenv('STOCK_ALERT_THRESHOLD', '5'))
+    for product_id, product in remaining.items():
+        payload = {"productId": product_id, "productName": product["name"], "quantity": product["stock"]}
+        # Every client follows "products", so a low-stock alert there already reaches product followers
+        if 0 < product["stock"] <= threshold:
+            publish("products", "STOCK_ALERT", payload)
+        else:
+            publish(f"product:{product_id}", "STOCK_ALERT", payload)
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""WebSocket push gateway for the /ws/<userId> channel used by the frontend.
+
+Runs as its own asyncio process next to the Flask workers:
+
+    python push_gateway.py
+
+Browsers connect to ws://<host>:PUSH_PORT/ws/<userId>. Each connection is
+subscribed to its own ``user:<id>`` topic and to the catalog-wide
+``products`` topic, and may send {"action": "subscribe", "topic":
+"product:<id>"} to follow a single product. The Flask workers publish
+newline-delimited JSON events to PUSH_PUBLISH_PORT (see push_events.py),
+and each event is serialized once and fanned out to every subscriber of
+its topic.
+
+Every connection has a bounded send queue drained by its own task. A
+client that falls PUSH_SEND_QUEUE messages behind is disconnected rather
+than allowed to buffer without limit.
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+import signal
+
+import websockets
+from dotenv import load_dotenv
+
+logger = logging.getLogger("push_gateway")
+
+PATH_RE = re.compile(r"^/ws/(\d+)/?$")
+TOPIC_RE = re.compile(r"^(products|product:\d+)$")
+
+
+class Connection:
+    __slots__ = ("websocket", "user_id", "queue", "topics", "sender")
+
+    def __init__(self, websocket, user_id, queue_size):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.topics = set()
+        self.sender = None
+
+
+class Hub:
+    def __init__(self, queue_size=64):
+        self.queue_size = queue_size
+        self.topics = {}
+        self.stats = {"connections": 0, "published": 0, "delivered": 0, "evicted": 0}
+
+    def subscribe(self, conn, topic):
+        self.topics.setdefault(topic, set()).add(conn)
+        conn.topics.add(topic)
+
+    def remove(self, conn):
+        for topic in conn.topics:
+            subscribers = self.topics.get(topic)
+            if subscribers is not None:
+                subscribers.discard(conn)
+                if not subscribers:
+                    del self.topics[topic]
+        conn.topics.clear()
+
+    def publish(self, topic, message):
+        subscribers = self.topics.get(topic)
+        self.stats["published"] += 1
+        if not subscribers:
+            return 0
+        slow = []
+        for conn in subscribers:
+            try:
+                conn.queue.put_nowait(message)
+            except asyncio.QueueFull:
+                slow.append(conn)
+        for conn in slow:
+            self.evict(conn)
+        delivered = len(subscribers)
+        self.stats["delivered"] += delivered
+        return delivered
+
+    def evict(self, conn):
+        # Slow consumer: drop it rather than let its backlog grow without bound
+        self.stats["evicted"] += 1
+        self.remove(conn)
+        asyncio.ensure_future(conn.websocket.close(code=1013, reason="Too slow, reconnect"))
+
+
+async def _sender(conn):
+    try:
+        while True:
+            message = await conn.queue.get()
+            await conn.websocket.send(message)
+    except websockets.ConnectionClosed:
+        pass
+
+
+async def handle_client(hub, websocket):
+    match = PATH_RE.match(websocket.path)
+    if not match:
+        await websocket.close(code=1008, reason="Unknown path")
+        return
+    conn = Connection(websocket, int(match.group(1)), hub.queue_size)
+    hub.subscribe(conn, f"user:{conn.user_id}")
+    hub.subscribe(conn, "products")
+    hub.stats["connections"] += 1
+    conn.sender = asyncio.ensure_future(_sender(conn))
+    try:
+        async for raw in websocket:
+            try:
+                request = json.loads(raw)
+            except ValueError:
+                continue
+            topic = request.get("topic", "") if isinstance(request, dict) else ""
+            if not TOPIC_RE.match(topic):
+                continue
+            if request.get("action") == "subscribe":
+                hub.subscribe(conn, topic)
+            elif request.get("action") == "unsubscribe" and topic in conn.topics:
+                hub.topics.get(topic, set()).discard(conn)
+                conn.topics.discard(topic)
+    except websockets.ConnectionClosed:
+        pass
+    finally:
+        hub.stats["connections"] -= 1
+        hub.remove(conn)
+        conn.sender.cancel()
+
+
+async def handle_publisher(hub, reader, writer):
+    # Internal ingress: one JSON event per line from the Flask workers
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                event = json.loads(line)
+                topic = event["topic"]
+                message = json.dumps({"type": event["type"], "payload": event.get("payload", {})})
+            except (ValueError, KeyError, TypeError):
+                logger.warning("Dropping malformed event: %r", line[:200])
+                continue
+            hub.publish(topic, message)
+    except (asyncio.CancelledError, ConnectionError):
+        # Gateway shutting down or the worker went away; it reconnects on its own
+        pass
+    finally:
+        writer.close()
+
+
+async def report_stats(hub, interval):
+    while True:
+        await asyncio.sleep(interval)
+        logger.info("push gateway: %s connections, %s topics, %s published, %s delivered, %s evicted",
+                    hub.stats["connections"], len(hub.topics), hub.stats["published"],
+                    hub.stats["delivered"], hub.stats["evicted"])
+
+
+async def main():
+    hub = Hub(queue_size=int(os.getenv('PUSH_SEND_QUEUE', '64')))
+    host = os.getenv('PUSH_HOST', '0.0.0.0')
+    port = int(os.getenv('PUSH_PORT', '5001'))
+    publish_host = os.getenv('PUSH_PUBLISH_HOST', '127.0.0.1')
+    publish_port = int(os.getenv('PUSH_PUBLISH_PORT', '5002'))
+
+    stop = asyncio.get_running_loop().create_future()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(sig, stop.set_result, None)
+
+    # Idle sockets dominate, so keep per-connection memory small: no compression, tiny inbound limits
+    async with websockets.serve(lambda ws: handle_client(hub, ws), host, port,
+                                compression=None, max_size=4096, max_queue=4,
+                                ping_interval=30, ping_timeout=30, close_timeout=5):
+        publisher = await asyncio.start_server(lambda r, w: handle_publisher(hub, r, w),
+                                               publish_host, publish_port)
+        stats_task = asyncio.ensure_future(report_stats(hub, float(os.getenv('PUSH_STATS_INTERVAL', '60'))))
+        logger.info("Push gateway listening on ws://%s:%s, publish port %s:%s", host, port, publish_host, publish_port)
+        await stop
+        stats_task.cancel()
+        publisher.close()
+        await publisher.wait_closed()
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper(), format="%(asctime)s - %(levelname)s - %(message)s")
+    asyncio.run(main())
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+import gzip
+import logging
+import os
+import zlib
+from decimal import Decimal
+
+import orjson
+from flask import current_app, request, stream_with_context
+from flask.json.provider import JSONProvider
+
+try:
+    import brotli
+except ImportError:  # optional: without it only gzip is offered
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', '1024'))
+GZIP_LEVEL = int(os.getenv('GZIP_LEVEL', '6'))
+BROTLI_QUALITY = int(os.getenv('BROTLI_QUALITY', '5'))
+COMPRESSIBLE_TYPES = {"application/json", "application/x-ndjson", "text/plain", "text/html", "text/csv"}
+STREAM_BATCH_SIZE = int(os.getenv('STREAM_BATCH_SIZE', '500'))
+
+
+def _default(value):
+    # Prices are DECIMAL columns; the frontend treats them as numbers
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode("utf-8")
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(obj):
+    """Serialize straight to bytes; datetimes come out as ISO 8601."""
+    return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+class OrjsonProvider(JSONProvider):
+    mimetype = "application/json"
+
+    def dumps(self, obj, **kwargs):
+        return dumps(obj).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Skip the bytes -> str -> bytes round trip jsonify would otherwise do
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps(obj), mimetype=self.mimetype)
+
+
+def negotiate_encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"]:
+        return "br"
+    if accepted["gzip"]:
+        return "gzip"
+    return None
+
+
+def compress(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    # mtime=0 keeps the output identical for identical input
+    return gzip.compress(body, GZIP_LEVEL, mtime=0)
+
+
+def compress_stream(chunks, encoding):
+    # Flush after every chunk so the client can start decoding before the stream ends
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            yield compressor.process(chunk) + compressor.flush()
+        yield compressor.finish()
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+
+
+def cached_response(entry, mimetype="application/json"):
+    """Response for a cached entry (anything with ``body``, ``etag`` and an ``encoded`` dict).
+
+    Each encoding is compressed once per entry and reused until the entry
+    is replaced. Compressed variants get a weak ETag, since their bytes differ.
+    """
+    encoding = negotiate_encoding() if len(entry.body) >= COMPRESS_MIN_SIZE else None
+    if request.if_none_match.contains_weak(entry.etag):
+        response = current_app.response_class(status=304)
+    elif encoding:
+        body = entry.encoded.get(encoding)
+        if body is None:
+            body = entry.encoded[encoding] = compress(entry.body, encoding)
+        response = current_app.response_class(body, mimetype=mimetype)
+        response.headers["Content-Encoding"] = encoding
+    else:
+        response = current_app.response_class(entry.body, mimetype=mimetype)
+    response.set_etag(entry.etag, weak=encoding is not None)
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def stream_format():
+    """"ndjson" or "json" when the client asked for a streamed collection, else None."""
+    if request.args.get("format") == "ndjson" or request.accept_mimetypes.best == "application/x-ndjson":
+        return "ndjson"
+    if request.args.get("stream", "").lower() in ("1", "true"):
+        return "json"
+    return None
+
+
+def cursor_batches(cursor, transform=None, batch_size=None):
+    """Yield lists of rows from an executed unbuffered cursor, closing it at the end."""
+    try:
+        while True:
+            rows = cursor.fetchmany(batch_size or STREAM_BATCH_SIZE)
+            if not rows:
+                break
+            yield [transform(row) for row in rows] if transform else rows
+    finally:
+        cursor.close()
+
+
+def _encode_stream(batches, fmt):
+    try:
+        if fmt == "ndjson":
+            for batch in batches:
+                if batch:
+                    yield b"".join(dumps(row) + b"\n" for row in batch)
+            return
+        yield b"["
+        first = True
+        for batch in batches:
+            if not batch:
+                continue
+            chunk = b",".join(dumps(row) for row in batch)
+            yield chunk if first else b"," + chunk
+            first = False
+        yield b"]"
+    except Exception as e:
+        # Headers are already sent; all we can do is end the body early
+        logger.error("Streaming response aborted: %s", e)
+        raise
+
+
+def streamed_response(batches, fmt):
+    """Chunked JSON array or NDJSON built from an iterable of row batches.
+
+    Only one batch is held in memory at a time, however large the
+    collection is.
+    """
+    mimetype = "application/x-ndjson" if fmt == "ndjson" else "application/json"
+    return current_app.response_class(stream_with_context(_encode_stream(batches, fmt)), mimetype=mimetype)
+
+
+def init_app(app):
+    app.json = OrjsonProvider(app)
+
+    @app.after_request
+    def compress_response(response):
+        if response.mimetype not in COMPRESSIBLE_TYPES:
+            return response
+        response.vary.add("Accept-Encoding")
+        if (response.status_code < 200 or response.status_code in (204, 206, 304)
+                or "Content-Encoding" in response.headers or request.method == "HEAD"):
+            return response
+        encoding = negotiate_encoding()
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = compress_stream(response.response, encoding)
+            response.headers.pop("Content-Length", None)
+        else:
+            body = response.get_data()
+            if len(body) < COMPRESS_MIN_SIZE:
+                return response
+            response.set_data(compress(body, encoding))
+        response.headers["Content-Encoding"] = encoding
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+"""Daily sales rollups for the /admin/analytics endpoints.
+
+    python sales_analytics.py backfill                          # rebuild every day still in `orders`
+    python sales_analytics.py backfill --since 2024-01-01 --until 2024-07-01
+
+sales_daily, sales_daily_categories and sales_daily_products hold, per day
+the order was placed, how many orders, units and how much revenue were
+placed and how much of that was later cancelled. The app keeps them up to
+date without touching the checkout transaction: after an order commits (or
+is cancelled) its id is buffered, and a background writer adds each batch
+of orders to the rollups with one INSERT ... SELECT per table. Reports then
+read a row per day, category or product instead of every order.
+
+Buffered ids are lost if a worker dies, and a category change only applies
+to orders counted after it, so backfill rebuilds a range of days from
+`orders` and `order_items`, a chunk of days per transaction. By default it
+starts after the last day order_archive.py moved orders out of, because
+rebuilding a day whose orders are archived would drop them from the
+totals. It never rebuilds today: the running app still has today's
+orders buffered, and adding them after the rebuild had counted them
+would count them twice. For the same reason a cancellation buffered
+during the second or so before a day is rebuilt is counted twice, so
+rebuild older days while cancellations are quiet.
+"""
+import argparse
+import atexit
+import os
+import sys
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+import mysql.connector
+from dotenv import load_dotenv
+
+from batch_writer import BatchWriter
+from catalog_query import InvalidQuery
+from db_pool import db_connect_args, get_pool
+
+LOCK_NAME = "ecommerce_sales_backfill"
+MAX_RANGE_DAYS = int(os.getenv('ANALYTICS_MAX_DAYS', '366'))
+DEFAULT_RANGE_DAYS = 30
+MAX_TOP_PRODUCTS = 100
+
+# Rollup table -> its key columns and the expressions they are computed from
+ROLLUPS = {
+    "sales_daily": (("day",), ("DATE(o.order_date)",)),
+    "sales_daily_categories": (("day", "category"), ("DATE(o.order_date)", "COALESCE(p.category, '')")),
+    "sales_daily_products": (("day", "product_id"), ("DATE(o.order_date)", "oi.product_id")),
+}
+MEASURES = ("orders", "units", "revenue", "cancelled_orders", "cancelled_units", "cancelled_revenue")
+
+PLACED = {
+    "orders": "COUNT(DISTINCT o.id)",
+    "units": "SUM(oi.quantity)",
+    "revenue": "SUM(oi.quantity * oi.price_at_time)",
+}
+CANCELLED = {
+    "cancelled_orders": "COUNT(DISTINCT o.id)",
+    "cancelled_units": "SUM(oi.quantity)",
+    "cancelled_revenue": "SUM(oi.quantity * oi.price_at_time)",
+}
+# Backfill counts both in one pass over each order's items
+REBUILT = dict(PLACED, **{
+    "cancelled_orders": "COUNT(DISTINCT CASE WHEN o.status = 'cancelled' THEN o.id END)",
+    "cancelled_units": "SUM(CASE WHEN o.status = 'cancelled' THEN oi.quantity ELSE 0 END)",
+    "cancelled_revenue": "SUM(CASE WHEN o.status = 'cancelled' THEN oi.quantity * oi.price_at_time ELSE 0 END)",
+})
+
+
+def rollup_statement(table, measures, where):
+    """INSERT ... SELECT that adds the orders matching ``where`` to ``table``'s rows."""
+    keys, key_exprs = ROLLUPS[table]
+    join = "LEFT JOIN products p ON p.id = oi.product_id" if table == "sales_daily_categories" else ""
+    columns = ", ".join(keys + tuple(measures))
+    select = ", ".join([f"{expr} AS {key}" for expr, key in zip(key_exprs, keys)]
+                       + [f"{expr} AS {column}" for column, expr in measures.items()])
+    updates = ", ".join(f"{column} = {table}.{column} + new.{column}" for column in measures)
+    # Rows are upserted in key order so concurrent flushes from several workers cannot deadlock
+    return f"""
+        INSERT INTO {table} ({columns})
+        SELECT * FROM (
+            SELECT {select}
+            FROM orders o
+            JOIN order_items oi ON oi.order_id = o.id
+            {join}
+            WHERE {where}
+            GROUP BY {', '.join(key_exprs)}
+        ) AS new
+        ORDER BY {', '.join(keys)}
+        ON DUPLICATE KEY UPDATE {updates}
+    """
+
+
+def add_orders(cursor, order_ids, cancelled=False):
+    placeholders = ", ".join(["%s"] * len(order_ids))
+    measures = CANCELLED if cancelled else PLACED
+    for table in ROLLUPS:
+        cursor.execute(rollup_statement(table, measures, f"o.id IN ({placeholders})"), list(order_ids))
+
+
+def _flush_events(events):
+    placed = sorted({order_id for kind, order_id in events if kind == "placed"})
+    cancelled = sorted({order_id for kind, order_id in events if kind == "cancelled"})
+    db = get_pool().acquire()
+    cursor = db.cursor()
+    try:
+        if placed:
+            add_orders(cursor, placed)
+        if cancelled:
+            add_orders(cursor, cancelled, cancelled=True)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        cursor.close()
+        db.close()
+
+
+_writer = None
+_writer_pid = None
+_writer_lock = threading.Lock()
+
+
+def get_rollup_writer():
+    global _writer, _writer_pid
+    with _writer_lock:
+        if _writer is None or _writer_pid != os.getpid():
+            _writer = BatchWriter(
+                _flush_events, "sales-rollups",
+                max_batch=int(os.getenv('ANALYTICS_FLUSH_BATCH', '500')),
+                interval=float(os.getenv('ANALYTICS_FLUSH_INTERVAL', '1.0')),
+            )
+            _writer_pid = os.getpid()
+            atexit.register(_writer.stop)
+        return _writer
+
+
+def record_order(order_id):
+    # Called after the order commits, so a rolled-back checkout is never counted
+    get_rollup_writer().add(("placed", order_id))
+
+
+def record_cancellation(order_id):
+    get_rollup_writer().add(("cancelled", order_id))
+
+
+def rollup_stats():
+    if _writer is None or _writer_pid != os.getpid():
+        return {"pending": 0, "written": 0, "dropped": 0}
+    return dict(_writer.stats, pending=_writer.pending())
+
+
+def parse_range(args):
+    """Inclusive ``from``/``to`` days (YYYY-MM-DD) from the query string; the last 30 days by default."""
+    try:
+        until = date.fromisoformat(args["to"]) if args.get("to") else date.today()
+        since = date.fromisoformat(args["from"]) if args.get("from") else until - timedelta(days=DEFAULT_RANGE_DAYS - 1)
+    except ValueError:
+        raise InvalidQuery("from and to must be dates like 2024-01-31")
+    if since > until:
+        raise InvalidQuery("from must not be after to")
+    if (until - since).days >= MAX_RANGE_DAYS:
+        raise InvalidQuery(f"The range can span at most {MAX_RANGE_DAYS} days")
+    return since, until
+
+
+def _totals(row):
+    # SUM() of integers comes back as a Decimal; only revenue should be one
+    totals = {column: row.get(column) or 0 for column in MEASURES}
+    for column in ("orders", "units", "cancelled_orders", "cancelled_units"):
+        totals[column] = int(totals[column])
+    totals["net_revenue"] = totals["revenue"] - totals["cancelled_revenue"]
+    totals["cancellation_rate"] = (round(totals["cancelled_orders"] / totals["orders"], 4)
+                                   if totals["orders"] else 0.0)
+    return totals
+
+
+def _sums():
+    return ", ".join(f"SUM({column}) AS {column}" for column in MEASURES)
+
+
+def daily_sales(cursor, since, until):
+    cursor.execute(f"""
+        SELECT day, {', '.join(MEASURES)} FROM sales_daily
+        WHERE day BETWEEN %s AND %s
+        ORDER BY day
+    """, (since, until))
+    rows = {row["day"]: row for row in cursor.fetchall()}
+    # Days without orders have no row; report them as zeros so charts have no gaps
+    days = []
+    day = since
+    while day <= until:
+        days.append(dict(_totals(rows.get(day, {})), day=day.isoformat()))
+        day += timedelta(days=1)
+    return days
+
+
+def sales_summary(cursor, since, until):
+    cursor.execute(f"SELECT {_sums()} FROM sales_daily WHERE day BETWEEN %s AND %s", (since, until))
+    return dict(_totals(cursor.fetchone()), **{"from": since.isoformat(), "to": until.isoformat()})
+
+
+def category_sales(cursor, since, until):
+    cursor.execute(f"""
+        SELECT category, {_sums()} FROM sales_daily_categories
+        WHERE day BETWEEN %s AND %s
+        GROUP BY category
+        ORDER BY SUM(revenue - cancelled_revenue) DESC
+    """, (since, until))
+    return [dict(_totals(row), category=row["category"] or None) for row in cursor.fetchall()]
+
+
+def top_products(cursor, since, until, limit=10, by="revenue"):
+    order = "SUM(units - cancelled_units)" if by == "units" else "SUM(revenue - cancelled_revenue)"
+    cursor.execute(f"""
+        SELECT product_id, {_sums()} FROM sales_daily_products
+        WHERE day BETWEEN %s AND %s
+        GROUP BY product_id
+        ORDER BY {order} DESC, product_id
+        LIMIT %s
+    """, (since, until, limit))
+    rows = cursor.fetchall()
+    names = {}
+    if rows:
+        placeholders = ", ".join(["%s"] * len(rows))
+        cursor.execute(f"SELECT id, name FROM products WHERE id IN ({placeholders})",
+                       [row["product_id"] for row in rows])
+        names = {row["id"]: row["name"] for row in cursor.fetchall()}
+    return [dict(_totals(row), product_id=row["product_id"], name=names.get(row["product_id"])) for row in rows]
+
+
+def parse_top_args(args):
+    try:
+        limit = int(args.get("limit", 10))
+    except ValueError:
+        raise InvalidQuery("limit must be an integer")
+    if not 1 <= limit <= MAX_TOP_PRODUCTS:
+        raise InvalidQuery(f"limit must be between 1 and {MAX_TOP_PRODUCTS}")
+    by = args.get("by", "revenue")
+    if by not in ("revenue", "units"):
+        raise InvalidQuery("by must be revenue or units")
+    return limit, by
+
+
+def rebuild_days(db, since, until):
+    """Replace the rollups for days in [since, until) with totals recomputed from the order tables."""
+    cursor = db.cursor()
+    try:
+        for table in ROLLUPS:
+            cursor.execute(f"DELETE FROM {table} WHERE day >= %s AND day < %s", (since, until))
+        # Range scan on idx_orders_date; one set-based aggregate per table for the whole chunk
+        for table in ROLLUPS:
+            cursor.execute(rollup_statement(table, REBUILT, "o.order_date >= %s AND o.order_date < %s"),
+                           (since, until))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def default_range(db):
+    cursor = db.cursor()
+    try:
+        cursor.execute("SELECT DATE(MIN(order_date)) FROM orders")
+        (first,) = cursor.fetchone()
+        cursor.execute("SELECT DATE(MAX(last_order_date)) FROM archived_order_segments")
+        (archived,) = cursor.fetchone()
+    finally:
+        cursor.close()
+    if first is not None and archived is not None:
+        first = max(first, archived + timedelta(days=1))
+    return first, date.today()
+
+
+def backfill(args):
+    db = mysql.connector.connect(**db_connect_args())
+    cursor = db.cursor()
+    cursor.execute("SELECT GET_LOCK(%s, 0)", (LOCK_NAME,))
+    if cursor.fetchone()[0] != 1:
+        sys.exit("Another backfill holds the lock")
+    cursor.close()
+    try:
+        since, until = default_range(db)
+        since = args.since or since
+        until = args.until or until
+        if until > date.today():
+            sys.exit("--until must not be after today: today's orders are still being added by the app")
+        if since is None or since >= until:
+            print("nothing to rebuild")
+            return
+        started = time.monotonic()
+        day = since
+        while day < until:
+            chunk_end = min(day + timedelta(days=args.chunk_days), until)
+            rebuild_days(db, day, chunk_end)
+            print(f"rebuilt {day} .. {chunk_end - timedelta(days=1)}")
+            day = chunk_end
+            if day < until:
+                time.sleep(args.pause)
+        print(f"rebuilt {(until - since).days} day(s) in {time.monotonic() - started:.1f}s")
+    finally:
+        db.close()
+
+
+def _day(value):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not a date like 2024-01-31: {value}")
+
+
+def main(argv=None):
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    rebuilder = commands.add_parser("backfill", help="rebuild the daily rollups from the order tables")
+    rebuilder.add_argument("--since", type=_day, help="first day to rebuild (default: oldest unarchived day)")
+    rebuilder.add_argument("--until", type=_day,
+                           help="day to stop before, at most today, whose orders the app is still adding "
+                                "(default: today)")
+    rebuilder.add_argument("--chunk-days", type=int, default=int(os.getenv('ANALYTICS_BACKFILL_CHUNK_DAYS', '7')),
+                           help="days rebuilt per transaction")
+    rebuilder.add_argument("--pause", type=float, default=float(os.getenv('ANALYTICS_BACKFILL_PAUSE', '0.5')),
+                           help="seconds to sleep between chunks")
+    rebuilder.set_defaults(handler=backfill)
+
+    args = parser.parse_args(argv)
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+import atexit
+import base64
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from batch_writer import BatchWriter
+from catalog_query import InvalidQuery, PRODUCT_COLUMNS, SELLABLE_STOCK
+from db_pool import get_pool
+
+logger = logging.getLogger(__name__)
+
+MOVEMENT_TYPES = ("in", "out", "adjustment")
+DEFAULT_PAGE_SIZE = int(os.getenv('STOCK_MOVEMENTS_PAGE_SIZE', '100'))
+MAX_PAGE_SIZE = int(os.getenv('STOCK_MOVEMENTS_MAX_PAGE_SIZE', '1000'))
+
+# Ids below the ledger high-water mark read again by changed_products(): a few writer batches
+# (STOCK_LEDGER_BATCH rows each) from other workers can still be committing behind it
+MOVEMENT_LOOKBACK_IDS = int(os.getenv('STOCK_LEDGER_LOOKBACK_IDS', '2000'))
+MOVEMENT_COLUMNS = "id, product_id, quantity_change, movement_type, reason, order_id, created_at"
+
+
+def movement(product_id, quantity_change, movement_type, reason="", order_id=None):
+    # Timestamped when the stock changed, not when the buffered row reaches the table
+    return (product_id, quantity_change, movement_type, reason[:255], order_id, datetime.now())
+
+
+def insert_movements(cursor, movements):
+    rows = ", ".join(["(%s, %s, %s, %s, %s, %s)"] * len(movements))
+    params = [value for row in movements for value in row]
+    cursor.execute(f"""
+        INSERT INTO stock_movements
+            (product_id, quantity_change, movement_type, reason, order_id, created_at)
+        VALUES {rows}
+    """, params)
+
+
+def _flush_movements(movements):
+    db = get_pool().acquire()
+    cursor = db.cursor()
+    try:
+        insert_movements(cursor, movements)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        cursor.close()
+        db.close()
+
+
+_writer = None
+_writer_pid = None
+_writer_lock = threading.Lock()
+
+
+def get_ledger_writer():
+    global _writer, _writer_pid
+    with _writer_lock:
+        if _writer is None or _writer_pid != os.getpid():
+            _writer = BatchWriter(
+                _flush_movements, "stock-ledger",
+                max_batch=int(os.getenv('STOCK_LEDGER_BATCH', '500')),
+                interval=float(os.getenv('STOCK_LEDGER_FLUSH_INTERVAL', '0.5')),
+            )
+            _writer_pid = os.getpid()
+            atexit.register(_writer.stop)
+        return _writer
+
+
+def record_order(order_id, quantities, movement_type="out", reason="order"):
+    # Checkout path: buffered, so the ledger adds no statements to the order transaction
+    sign = -1 if movement_type == "out" else 1
+    get_ledger_writer().extend([movement(product_id, sign * quantity, movement_type, reason, order_id)
+                                for product_id, quantity in sorted(quantities.items())])
+
+
+def drain(timeout=5.0):
+    if _writer is not None and _writer_pid == os.getpid():
+        _writer.drain(timeout)
+
+
+def encode_cursor(movement_id):
+    raw = json.dumps([movement_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        (movement_id,) = json.loads(base64.urlsafe_b64decode(padded))
+        return int(movement_id)
+    except (ValueError, TypeError):
+        raise InvalidQuery("Invalid cursor")
+
+
+def parse_movement_args(args):
+    try:
+        limit = int(args.get("limit", DEFAULT_PAGE_SIZE))
+        product_id = int(args["product_id"]) if args.get("product_id") else None
+    except ValueError:
+        raise InvalidQuery("limit and product_id must be integers")
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise InvalidQuery(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    before = decode_cursor(args["cursor"]) if args.get("cursor") else None
+    return limit, product_id, before
+
+
+def movements_query(product_id=None, before=None, limit=None):
+    # Newest first on the primary key (or (product_id, id)), so every page is an index range scan
+    clauses, params = [], []
+    if product_id is not None:
+        clauses.append("product_id = %s")
+        params.append(product_id)
+    if before is not None:
+        clauses.append("id < %s")
+        params.append(before)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    sql = f"SELECT {MOVEMENT_COLUMNS} FROM stock_movements {where} ORDER BY id DESC"
+    if limit is not None:
+        sql += " LIMIT %s"
+        params.append(limit)
+    return sql, params
+
+
+def format_movement(row):
+    return {
+        "id": row["id"],
+        "productId": row["product_id"],
+        "quantity": row["quantity_change"],
+        "type": row["movement_type"],
+        "reason": row["reason"] or "",
+        "orderId": row["order_id"],
+        "createdAt": row["created_at"].isoformat() if row["created_at"] else None,
+    }
+
+
+def fetch_movements(cursor, limit, product_id=None, before=None):
+    sql, params = movements_query(product_id, before, limit + 1)
+    cursor.execute(sql, params)
+    rows = cursor.fetchall()
+    next_cursor = encode_cursor(rows[limit - 1]["id"]) if len(rows) > limit else None
+    return [format_movement(row) for row in rows[:limit]], next_cursor
+
+
+def last_movement_id(cursor):
+    cursor.execute("SELECT COALESCE(MAX(id), 0) AS last_id FROM stock_movements")
+    return cursor.fetchone()["last_id"]
+
+
+def changed_products(cursor, after_id, seen=frozenset()):
+    """Products with ledger rows not seen yet, the new high-water mark, and the ids seen near it.
+
+    Lets per-worker in-memory views catch up with stock changes made by
+    other workers by reading only the tail of the ledger. Batches of
+    movements commit concurrently, so a row can become visible after a
+    higher id already moved the mark past it: the last
+    MOVEMENT_LOOKBACK_IDS ids below the mark are read again every time,
+    and ``seen``, returned by the previous call, keeps them from being
+    reported twice.
+    """
+    cursor.execute("SELECT id, product_id FROM stock_movements WHERE id > %s",
+                   (max(after_id - MOVEMENT_LOOKBACK_IDS, 0),))
+    rows = [row for row in cursor.fetchall() if row["id"] not in seen]
+    mark = max([after_id] + [row["id"] for row in rows])
+    recent = {movement_id for movement_id in seen if movement_id > mark - MOVEMENT_LOOKBACK_IDS}
+    recent.update(row["id"] for row in rows if row["id"] > mark - MOVEMENT_LOOKBACK_IDS)
+    return sorted({row["product_id"] for row in rows}), mark, recent
+
+
+class LowStockIndex:
+    """Products at or below ``threshold`` units, kept in memory and updated incrementally.
+
+    The first read loads the low rows once through idx_products_stock.
+    Changes made by this worker are applied via note(). Changes from other
+    workers are picked up from the ledger: every ``sync_interval`` seconds
+    the index re-reads only the products that have movements newer than
+    the last ledger id it saw. Stock can also move without a ledger row
+    (catalog imports, manual SQL), so a full reload every
+    ``rebuild_interval`` seconds bounds any drift.
+    """
+
+    def __init__(self, threshold=5, sync_interval=5.0, rebuild_interval=300.0):
+        self.threshold = threshold
+        self.sync_interval = sync_interval
+        self.rebuild_interval = rebuild_interval
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._rows = {}
+        self._dirty = set()
+        self._last_movement_id = 0
+        self._recent_movements = set()
+        self._built_at = None
+        self._synced_at = 0.0
+        self.stats = {"rebuilds": 0, "syncs": 0, "refetched": 0}
+
+    def note(self, product_id, stock):
+        with self._lock:
+            if stock <= self.threshold:
+                # Needs its full row, fetched on the next read
+                self._dirty.add(product_id)
+            else:
+                self._rows.pop(product_id, None)
+                self._dirty.discard(product_id)
+
+    def mark_changed(self, product_ids):
+        # New stock unknown to the caller (e.g. restored by a cancellation): re-read on the next get()
+        with self._lock:
+            self._dirty.update(product_ids)
+
+    def _rebuild(self, cursor):
+        last_id = last_movement_id(cursor)
+        # The stock column is never above the sellable stock, so its index narrows the rows to check
+        cursor.execute(f"""
+            SELECT {PRODUCT_COLUMNS}
+            FROM products WHERE stock <= %s AND {SELLABLE_STOCK} <= %s
+        """, (self.threshold, self.threshold))
+        rows = {row["id"]: row for row in cursor.fetchall()}
+        with self._lock:
+            self._rows = rows
+        self._last_movement_id = last_id
+        self._recent_movements = set()
+        self._built_at = self._synced_at = time.monotonic()
+        self.stats["rebuilds"] += 1
+
+    def _sync(self, cursor):
+        changed, self._last_movement_id, self._recent_movements = changed_products(
+            cursor, self._last_movement_id, self._recent_movements)
+        with self._lock:
+            self._dirty.update(changed)
+        self._synced_at = time.monotonic()
+        self.stats["syncs"] += 1
+
+    def _refetch(self, cursor, product_ids):
+        placeholders = ", ".join(["%s"] * len(product_ids))
+        cursor.execute(f"SELECT {PRODUCT_COLUMNS} FROM products WHERE id IN ({placeholders})", product_ids)
+        found = {row["id"]: row for row in cursor.fetchall()}
+        with self._lock:
+            for product_id in product_ids:
+                row = found.get(product_id)
+                if row is not None and row["stock"] <= self.threshold:
+                    self._rows[product_id] = row
+                else:
+                    self._rows.pop(product_id, None)
+        self.stats["refetched"] += len(product_ids)
+
+    def get(self, cursor):
+        # One reader refreshes at a time; note() only ever waits on the short _lock
+        with self._refresh_lock:
+            now = time.monotonic()
+            if self._built_at is None or now - self._built_at >= self.rebuild_interval:
+                self._rebuild(cursor)
+            elif now - self._synced_at >= self.sync_interval:
+                self._sync(cursor)
+            with self._lock:
+                dirty, self._dirty = sorted(self._dirty), set()
+            if dirty:
+                self._refetch(cursor, dirty)
+            with self._lock:
+                return sorted(self._rows.values(), key=lambda row: (row["stock"], row["id"]))
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_low_stock_index():
+    global _index
+    with _index_lock:
+        if _index is None or _index.pid != os.getpid():
+            _index = LowStockIndex(
+                threshold=int(os.getenv('STOCK_ALERT_THRESHOLD', '5')),
+                sync_interval=float(os.getenv('LOW_STOCK_SYNC_INTERVAL', '5')),
+                rebuild_interval=float(os.getenv('LOW_STOCK_REBUILD_INTERVAL', '300')),
+            )
+        return _index
@@ -0,0 +1,481 @@
+# -*- coding: utf-8 -*-
+import atexit
+import itertools
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+from checkout import OutOfStock
+from db_pool import ConnectionPool, db_connect_args
+
+logger = logging.getLogger(__name__)
+
+
+def restock(cursor, returns):
+    """Add ``returns`` (product id -> units) back to products.stock in one statement on ``cursor``."""
+    product_ids = sorted(returns)
+    cases = " ".join(["WHEN %s THEN %s"] * len(product_ids))
+    params = []
+    for product_id in product_ids:
+        params.extend([product_id, returns[product_id]])
+    placeholders = ", ".join(["%s"] * len(product_ids))
+    cursor.execute(f"""
+        UPDATE products
+        SET stock = stock + CASE id {cases} END
+        WHERE id IN ({placeholders})
+    """, params + product_ids)
+
+
+def take_escrow(cursor, product_id, held, quantity):
+    """Remove ``quantity`` units of ``product_id`` from escrow rows the caller has locked.
+
+    ``held`` is [(owner, units)]. For a manual removal larger than
+    products.stock: the engine that owned the units finds out when its
+    next consume() of them fails, and drops its local copy.
+    """
+    for owner, units in held:
+        if quantity <= 0:
+            break
+        taken = min(units, quantity)
+        cursor.execute("""
+            UPDATE stock_escrow SET quantity = quantity - %s
+            WHERE owner = %s AND product_id = %s
+        """, (taken, owner, product_id))
+        quantity -= taken
+
+
+class MySQLStockStore:
+    """Moves stock between the products table and a worker's local escrow.
+
+    Every unit a worker holds is also recorded in stock_escrow under the
+    worker's ``owner`` id, in the same transaction that moves it, and a
+    sale takes it off that row inside the order transaction. The sweeper
+    heartbeats the owner's rows, and reconcile() hands the escrow of an
+    owner that stopped heartbeating (a worker killed by a timeout,
+    SIGKILL or the OOM killer) back to the products table.
+
+    Uses its own two-connection pool so a request that already holds a
+    connection can never deadlock waiting for a second one.
+    """
+
+    def __init__(self, pool=None, owner=None):
+        self.pool = pool or ConnectionPool(db_connect_args(), pool_size=2, max_overflow=0)
+        self.owner = owner or f"{socket.gethostname()[:60]}:{os.getpid()}:{uuid.uuid4().hex[:12]}"
+
+    def _transaction(self, work):
+        db = self.pool.acquire()
+        cursor = db.cursor()
+        try:
+            cursor.execute("START TRANSACTION")
+            result = work(cursor)
+            db.commit()
+            return result
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            cursor.close()
+            db.close()
+
+    def claim(self, product_id, wanted, fair_share):
+        # Short transaction: the row lock lasts three statements, not a whole checkout
+        def work(cursor):
+            cursor.execute("SELECT stock FROM products WHERE id = %s FOR UPDATE", (product_id,))
+            row = cursor.fetchone()
+            if row is None or row[0] <= 0:
+                return 0
+            stock = row[0]
+            # Take at least what the checkout needs, more only while plenty is left for other workers
+            granted = min(stock, max(wanted, min(fair_share, stock // 4)))
+            cursor.execute("UPDATE products SET stock = stock - %s WHERE id = %s", (granted, product_id))
+            cursor.execute("""
+                INSERT INTO stock_escrow (owner, product_id, quantity, heartbeat_at)
+                VALUES (%s, %s, %s, NOW())
+                ON DUPLICATE KEY UPDATE quantity = quantity + VALUES(quantity), heartbeat_at = NOW()
+            """, (self.owner, product_id, granted))
+            return granted
+        return self._transaction(work)
+
+    def consume(self, cursor, quantities):
+        """Take sold units off this owner's escrow rows inside the caller's order transaction.
+
+        Returns False if a row no longer covers the sale, which means
+        reconcile() gave this worker's escrow back while it was stalled,
+        or a manual removal took part of it (take_escrow()).
+        """
+        for product_id in sorted(quantities):
+            cursor.execute("""
+                UPDATE stock_escrow SET quantity = quantity - %s
+                WHERE owner = %s AND product_id = %s AND quantity >= %s
+            """, (quantities[product_id], self.owner, product_id, quantities[product_id]))
+            if cursor.rowcount != 1:
+                return False
+        return True
+
+    def release(self, returns):
+        # Group commit: every product's surplus goes back in one statement
+        if not returns:
+            return
+
+        def work(cursor):
+            product_ids = sorted(returns)
+            placeholders = ", ".join(["%s"] * len(product_ids))
+            # Products first, then escrow rows: the same lock order as claim()
+            cursor.execute(f"SELECT id FROM products WHERE id IN ({placeholders}) ORDER BY id FOR UPDATE",
+                           product_ids)
+            cursor.fetchall()
+            cursor.execute(f"""
+                SELECT product_id, quantity FROM stock_escrow
+                WHERE owner = %s AND product_id IN ({placeholders})
+                ORDER BY product_id
+                FOR UPDATE
+            """, [self.owner] + product_ids)
+            held = dict(cursor.fetchall())
+            # Never return more than the escrow rows still hold, so a reconciled escrow is not returned twice
+            returned = {pid: min(quantity, held.get(pid, 0)) for pid, quantity in returns.items()}
+            returned = {pid: quantity for pid, quantity in returned.items() if quantity > 0}
+            if returned:
+                restock(cursor, returned)
+            for product_id, quantity in sorted(returned.items()):
+                cursor.execute("""
+                    UPDATE stock_escrow SET quantity = quantity - %s WHERE owner = %s AND product_id = %s
+                """, (quantity, self.owner, product_id))
+            cursor.execute("DELETE FROM stock_escrow WHERE owner = %s AND quantity <= 0", (self.owner,))
+        self._transaction(work)
+
+    def heartbeat(self):
+        """Mark this owner alive; returns the product ids it still has escrow rows for."""
+        def work(cursor):
+            cursor.execute("UPDATE stock_escrow SET heartbeat_at = NOW() WHERE owner = %s", (self.owner,))
+            cursor.execute("SELECT product_id FROM stock_escrow WHERE owner = %s", (self.owner,))
+            return {row[0] for row in cursor.fetchall()}
+        return self._transaction(work)
+
+    def reconcile(self, stale_after):
+        """Return the escrow of every owner that has not heartbeated for ``stale_after`` seconds."""
+        db = self.pool.acquire()
+        cursor = db.cursor()
+        try:
+            cursor.execute("""
+                SELECT owner FROM stock_escrow
+                WHERE owner <> %s
+                GROUP BY owner
+                HAVING MAX(heartbeat_at) < NOW() - INTERVAL %s SECOND
+            """, (self.owner, int(stale_after)))
+            owners = [row[0] for row in cursor.fetchall()]
+            db.rollback()
+        finally:
+            cursor.close()
+            db.close()
+
+        recovered = {}
+        for owner in owners:
+            def work(cursor, owner=owner):
+                # Re-checked under the row locks: a worker that was only slow may have heartbeated since
+                cursor.execute("""
+                    SELECT product_id, quantity FROM stock_escrow
+                    WHERE owner = %s AND heartbeat_at < NOW() - INTERVAL %s SECOND
+                    ORDER BY product_id
+                    FOR UPDATE
+                """, (owner, int(stale_after)))
+                rows = {product_id: quantity for product_id, quantity in cursor.fetchall() if quantity > 0}
+                if rows:
+                    restock(cursor, rows)
+                cursor.execute("""
+                    DELETE FROM stock_escrow WHERE owner = %s AND heartbeat_at < NOW() - INTERVAL %s SECOND
+                """, (owner, int(stale_after)))
+                return rows
+            rows = self._transaction(work)
+            if rows:
+                logger.warning("Returned %s escrowed units of dead worker %s to stock",
+                               sum(rows.values()), owner)
+            for product_id, quantity in rows.items():
+                recovered[product_id] = recovered.get(product_id, 0) + quantity
+        return recovered
+
+
+class _Bucket:
+    __slots__ = ("lock", "available", "last_used", "empty_until", "claimed_at")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.available = 0
+        self.last_used = time.monotonic()
+        self.empty_until = 0.0
+        self.claimed_at = 0.0
+
+
+class ReservationEngine:
+    """Serves checkouts from stock escrowed out of the products table in chunks.
+
+    A worker claims ``chunk_size`` units of a product with one short
+    conditional decrement and then hands them out to checkouts from
+    memory, so a hot SKU costs one row lock per chunk instead of one per
+    order. Reservations that are neither confirmed nor cancelled within
+    ``ttl`` seconds go back to the escrow, and escrow that sits idle is
+    returned to the table in batches. Stock can only leave the table
+    through claim(), which never takes more than is there, so concurrent
+    workers cannot oversell. The escrow is recorded in the database as
+    well (see MySQLStockStore), so the sweeper heartbeats it every
+    ``heartbeat_interval`` seconds and, on start and every half
+    ``stale_after``, returns the escrow of workers that stopped doing so.
+    """
+
+    def __init__(self, store, chunk_size=20, ttl=30.0, idle_release=5.0, sweep_interval=1.0,
+                 empty_backoff=0.5, heartbeat_interval=5.0, stale_after=60.0):
+        self.store = store
+        self.heartbeat_interval = heartbeat_interval
+        self.stale_after = stale_after
+        self.empty_backoff = empty_backoff
+        self.chunk_size = chunk_size
+        self.ttl = ttl
+        self.idle_release = idle_release
+        self.sweep_interval = sweep_interval
+        self.pid = os.getpid()
+
+        self._buckets = {}
+        self._buckets_lock = threading.Lock()
+        self._reservations = {}
+        self._reservations_lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._sweeper = None
+        self._stopped = threading.Event()
+        self._stats_lock = threading.Lock()
+        self.stats = {"reserved": 0, "confirmed": 0, "cancelled": 0, "expired": 0, "claims": 0,
+                      "rejected": 0, "lost": 0, "recovered": 0}
+
+    def _count(self, name, amount=1):
+        with self._stats_lock:
+            self.stats[name] += amount
+
+    def _bucket(self, product_id):
+        bucket = self._buckets.get(product_id)
+        if bucket is None:
+            with self._buckets_lock:
+                bucket = self._buckets.setdefault(product_id, _Bucket())
+        return bucket
+
+    def _take(self, product_id, quantity):
+        bucket = self._bucket(product_id)
+        with bucket.lock:
+            now = bucket.last_used = time.monotonic()
+            if bucket.available < quantity and now >= bucket.empty_until:
+                # Only the thread holding this product's lock refills it; others queue briefly in memory
+                granted = self.store.claim(product_id, quantity - bucket.available, self.chunk_size)
+                self._count("claims")
+                bucket.available += granted
+                bucket.claimed_at = time.monotonic()
+                if bucket.available < quantity:
+                    # Sold out in the table too; don't hit it again on every request for a moment
+                    bucket.empty_until = now + self.empty_backoff
+            if bucket.available < quantity:
+                return False
+            bucket.available -= quantity
+            return True
+
+    def _give_back(self, quantities):
+        for product_id, quantity in quantities.items():
+            bucket = self._bucket(product_id)
+            with bucket.lock:
+                bucket.available += quantity
+
+    def reserve(self, quantities):
+        self.start()
+        taken = {}
+        try:
+            for product_id in sorted(quantities):
+                if not self._take(product_id, quantities[product_id]):
+                    self._count("rejected")
+                    raise OutOfStock(f"Product {product_id} not available in requested quantity")
+                taken[product_id] = quantities[product_id]
+        except Exception:
+            self._give_back(taken)
+            raise
+
+        reservation_id = next(self._ids)
+        with self._reservations_lock:
+            self._reservations[reservation_id] = (taken, time.monotonic() + self.ttl)
+        self._count("reserved")
+        return reservation_id
+
+    def commit(self, reservation_id, cursor, commit):
+        """Turn a reservation into a sale by running ``commit`` (the order transaction's commit).
+
+        The reservation is taken out of the expiry sweep before committing,
+        so a slow checkout can never have its units handed to someone else
+        after its order is already durable. The units come off this
+        worker's escrow rows on ``cursor``, inside the order transaction.
+        If the commit fails, the units go back to the escrow.
+        """
+        with self._reservations_lock:
+            entry = self._reservations.pop(reservation_id, None)
+        if entry is None:
+            raise OutOfStock("Stock reservation expired, please try again")
+        try:
+            consumed = self.store.consume(cursor, entry[0])
+        except Exception:
+            self._give_back(entry[0])
+            raise
+        if not consumed:
+            # Another worker reclaimed this escrow as a dead one's, or a manual removal took part of it:
+            # what is left locally is no longer backed, and whatever the rows still hold goes back to stock
+            self._count("lost")
+            dropped = self._forget(entry[0])
+            try:
+                self.store.release(dropped)
+            except Exception as e:
+                logger.error("Failed to return escrowed stock: %s", e)
+            raise OutOfStock("Stock reservation expired, please try again")
+        try:
+            commit()
+        except Exception:
+            self._give_back(entry[0])
+            raise
+        # The units already left the products table when they were claimed
+        self._count("confirmed")
+
+    def _forget(self, product_ids, claimed_before=None):
+        # Returns the units dropped per product
+        dropped = {}
+        for product_id in product_ids:
+            bucket = self._bucket(product_id)
+            with bucket.lock:
+                if bucket.available and (claimed_before is None or bucket.claimed_at < claimed_before):
+                    dropped[product_id] = bucket.available
+                    bucket.available = 0
+        return dropped
+
+    def restocked(self, product_ids):
+        # Units went back to the table (a cancelled order): let the next checkout claim them right away
+        for product_id in product_ids:
+            bucket = self._bucket(product_id)
+            with bucket.lock:
+                bucket.empty_until = 0.0
+
+    def heartbeat(self):
+        started = time.monotonic()
+        backed = self.store.heartbeat()
+        with self._buckets_lock:
+            held = [product_id for product_id, bucket in self._buckets.items() if bucket.available]
+        # Escrow held here but gone from the table was returned by reconcile() while this worker stalled
+        lost = [product_id for product_id in held if product_id not in backed]
+        if lost:
+            logger.warning("Escrow for products %s was reclaimed, dropping the local copy", lost)
+            self._forget(lost, claimed_before=started)
+
+    def reconcile(self):
+        recovered = self.store.reconcile(self.stale_after)
+        self._count("recovered", sum(recovered.values()))
+        return recovered
+
+    def cancel(self, reservation_id):
+        with self._reservations_lock:
+            entry = self._reservations.pop(reservation_id, None)
+        if entry is not None:
+            self._give_back(entry[0])
+            self._count("cancelled")
+        return entry is not None
+
+    def sweep(self, release_all=False):
+        now = time.monotonic()
+        with self._reservations_lock:
+            expired = [rid for rid, (_, expires_at) in self._reservations.items() if expires_at <= now]
+            entries = [self._reservations.pop(rid) for rid in expired]
+        for taken, _ in entries:
+            self._give_back(taken)
+        self._count("expired", len(entries))
+
+        returns = {}
+        with self._buckets_lock:
+            buckets = list(self._buckets.items())
+        for product_id, bucket in buckets:
+            with bucket.lock:
+                # Also return leftovers too small for recent demand, so other workers can use them
+                starved = bucket.empty_until > now
+                if bucket.available and (release_all or starved or now - bucket.last_used >= self.idle_release):
+                    returns[product_id] = bucket.available
+                    bucket.available = 0
+        if returns:
+            try:
+                self.store.release(returns)
+            except Exception as e:
+                logger.error("Failed to return escrowed stock, keeping it local: %s", e)
+                self._give_back(returns)
+        return returns
+
+    def escrowed(self):
+        with self._buckets_lock:
+            buckets = list(self._buckets.items())
+        held = {pid: b.available for pid, b in buckets if b.available}
+        with self._reservations_lock:
+            for taken, _ in self._reservations.values():
+                for pid, quantity in taken.items():
+                    held[pid] = held.get(pid, 0) + quantity
+        return held
+
+    def _sweep_loop(self):
+        # Reconcile straight away, so stock a killed worker held comes back when its replacement starts
+        next_heartbeat = next_reconcile = 0.0
+        while True:
+            now = time.monotonic()
+            if now >= next_reconcile:
+                next_reconcile = now + self.stale_after / 2
+                try:
+                    self.reconcile()
+                except Exception as e:
+                    logger.error("Stock escrow reconcile failed: %s", e)
+            if now >= next_heartbeat:
+                next_heartbeat = now + self.heartbeat_interval
+                try:
+                    self.heartbeat()
+                except Exception as e:
+                    logger.error("Stock escrow heartbeat failed: %s", e)
+            if self._stopped.wait(self.sweep_interval):
+                return
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error("Stock reservation sweep failed: %s", e)
+
+    def start(self):
+        if self._sweeper is None:
+            with self._buckets_lock:
+                if self._sweeper is None:
+                    self._sweeper = threading.Thread(target=self._sweep_loop, name="stock-sweeper", daemon=True)
+                    self._sweeper.start()
+
+    def stop(self):
+        # Hand every unsold unit back to the products table
+        self._stopped.set()
+        with self._reservations_lock:
+            entries = list(self._reservations.values())
+            self._reservations.clear()
+        for taken, _ in entries:
+            self._give_back(taken)
+        self.sweep(release_all=True)
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_reservation_engine():
+    # Disabled unless STOCK_RESERVATIONS is on; place_order then locks rows directly
+    global _engine
+    if os.getenv('STOCK_RESERVATIONS', 'false').lower() != 'true':
+        return None
+    with _engine_lock:
+        if _engine is None or _engine.pid != os.getpid():
+            _engine = ReservationEngine(
+                MySQLStockStore(),
+                chunk_size=int(os.getenv('STOCK_RESERVATION_CHUNK', '20')),
+                ttl=float(os.getenv('STOCK_RESERVATION_TTL', '30')),
+                idle_release=float(os.getenv('STOCK_RESERVATION_IDLE_RELEASE', '5')),
+                heartbeat_interval=float(os.getenv('STOCK_ESCROW_HEARTBEAT', '5')),
+                stale_after=float(os.getenv('STOCK_ESCROW_STALE_AFTER', '60')),
+            )
+            atexit.register(_engine.stop)
+        return _engine